@@ -0,0 +1,209 @@
+"""Admission control: turn away work the server can't do in time.
+
+Without it, a burst of requests just waits in line, and every request
+(however cheap) waits behind every bulk dump ahead of it. Instead,
+each process keeps the total estimated cost of the requests it is
+working on. Each route has a cost in ``cfg.ADMISSION_COSTS``, so a
+request for ``/all`` or ``/image`` counts for much more than one for
+``/metar/<id>``.
+
+* A cheap request (cost of at most ``cfg.ADMISSION_CHEAP_COST``) is
+  started if the total stays within ``cfg.ADMISSION_MAX_COST``.
+* Any other request is only started if the total stays within
+  ``cfg.ADMISSION_BULK_SHARE`` of that, so there is always room for
+  cheap lookups.
+* A request that can't be started waits in a queue of at most
+  ``cfg.ADMISSION_QUEUE_SIZE`` requests, cheapest first, for up to
+  ``cfg.ADMISSION_QUEUE_TIMEOUT`` seconds.
+* Otherwise it gets HTTP status 503 at once, with a ``Retry-After``
+  header.
+
+A request is always started if nothing else is running, so gunicorn's
+sync workers (which handle one request at a time) never turn anything
+away. Their queue is the listen backlog, set by ``backlog`` in
+``gunicorn.conf.py``. With threaded workers and ``asgi.py``, the
+limits are per process. ``asgi.py`` never queues requests.
+
+This is off by default (``cfg.ADMISSION_CONTROL``).
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+from flask import jsonify
+from flask import request
+
+import fisb_restConfig as cfg
+
+# Set in the WSGI environment to the cost of an admitted request, or
+# to 0 by 'asgi.py' for requests it admitted itself.
+ENVIRON_KEY = 'fisb_rest.admission'
+
+# Total cost of the requests running, and the queue (a heap of
+# (cost, sequence number)).
+_running = 0
+_waiting = []
+_sequence = itertools.count()
+
+_condition = threading.Condition()
+
+def isEnabled():
+    """Check if admission control is turned on.
+
+    Returns:
+        bool: ``True`` if ``cfg.ADMISSION_CONTROL`` is ``True``.
+    """
+    return cfg.ADMISSION_CONTROL
+
+def routeCost(route):
+    """Return the estimated cost of a request.
+
+    Args:
+        route (str): Route, such as ``'/metar/<id>'``.
+
+    Returns:
+        int: The route's cost in ``cfg.ADMISSION_COSTS``. Routes not
+        listed cost ``'ONE'`` if they have a variable part (they return
+        one object), and ``'DEFAULT'`` otherwise. ``0`` means the
+        request isn't counted, and is always started.
+    """
+    costs = cfg.ADMISSION_COSTS
+
+    if route in costs:
+        return costs[route]
+    if '<' in route:
+        return costs['ONE']
+
+    return costs['DEFAULT']
+
+def _fits(cost):
+    """Check if there is room to start a request now.
+
+    Must be called with ``_condition`` held.
+
+    Args:
+        cost (int): Cost of the request.
+
+    Returns:
+        bool: ``True`` if the request can be started.
+    """
+    if _running == 0:
+        return True
+
+    limit = cfg.ADMISSION_MAX_COST
+    if cost > cfg.ADMISSION_CHEAP_COST:
+        limit *= cfg.ADMISSION_BULK_SHARE
+
+    return _running + cost <= limit
+
+def admit(cost, timeout):
+    """Start a request, waiting for room if needed.
+
+    Call ``release()`` with the same cost when the request is done
+    (only if this returned ``True``).
+
+    Args:
+        cost (int): Cost of the request, from ``routeCost()``.
+        timeout (float): Longest time to wait in the queue. ``0``
+            to not wait.
+
+    Returns:
+        bool: ``True`` if the request can go ahead.
+    """
+    global _running
+
+    with _condition:
+        # Only requests at least as cheap go first.
+        if ((len(_waiting) == 0) or (_waiting[0][0] > cost)) and _fits(cost):
+            _running += cost
+            return True
+
+        if (timeout <= 0) or (len(_waiting) >= cfg.ADMISSION_QUEUE_SIZE):
+            return False
+
+        entry = (cost, next(_sequence))
+        heapq.heappush(_waiting, entry)
+        deadline = time.monotonic() + timeout
+
+        while True:
+            if (_waiting[0] == entry) and _fits(cost):
+                heapq.heappop(_waiting)
+                _running += cost
+
+                # The next in line may fit as well.
+                _condition.notify_all()
+                return True
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            _condition.wait(remaining)
+
+        _waiting.remove(entry)
+        heapq.heapify(_waiting)
+        _condition.notify_all()
+
+        return False
+
+def release(cost):
+    """Finish a request started by ``admit()``.
+
+    Args:
+        cost (int): Cost given to ``admit()``.
+    """
+    global _running
+
+    with _condition:
+        _running -= cost
+        _condition.notify_all()
+
+def busyResponse():
+    """Return the response sent to requests that are turned away.
+
+    Returns:
+        obj: JSON error response with HTTP status 503 and a
+        ``Retry-After`` header.
+    """
+    response = jsonify({'status': -1, 'error': 'Server busy.'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(cfg.ADMISSION_RETRY_AFTER)
+
+    return response
+
+def beforeRequest():
+    """Start a Flask request, or turn it away.
+
+    Registered with ``app.before_request()``.
+
+    Returns:
+        obj: ``busyResponse()`` if the request was turned away,
+        otherwise ``None``.
+    """
+    if (not isEnabled()) or (ENVIRON_KEY in request.environ):
+        return None
+
+    route = request.url_rule.rule if request.url_rule is not None else 'none'
+    cost = routeCost(route)
+    if cost == 0:
+        return None
+
+    if not admit(cost, cfg.ADMISSION_QUEUE_TIMEOUT):
+        return busyResponse()
+
+    request.environ[ENVIRON_KEY] = cost
+    return None
+
+def teardownRequest(exception):
+    """Finish a Flask request started by ``beforeRequest()``.
+
+    Registered with ``app.teardown_request()``.
+
+    Args:
+        exception (obj): Exception raised by the request, if any.
+    """
+    cost = request.environ.pop(ENVIRON_KEY, 0)
+    if cost > 0:
+        release(cost)
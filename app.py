@@ -1,15 +1,67 @@
 from flask import Flask
 from flask import request
 from flask import jsonify
+from pymongo import errors
 
 import fisb_restConfig as cfg
 import utilities as util
+import eventstream
+import compression
+import metrics
+import admission
+import profiler
+import slowquery
 
 app = Flask(__name__, static_url_path='')
 
 # Create database connection to mongo
 util.createDbConn()
 
+# Measure each request. Registered before compression, so the
+# compressed size is counted ('after_request' functions run in
+# reverse order).
+app.before_request(metrics.beforeRequest)
+app.after_request(metrics.afterRequest)
+
+# Turn away requests when too busy. Registered after metrics, so
+# requests turned away are counted.
+app.before_request(admission.beforeRequest)
+app.teardown_request(admission.teardownRequest)
+
+# Profile requests that ask for it. Registered before compression,
+# so compressing is in the profile.
+app.before_request(profiler.beforeRequest)
+app.after_request(profiler.afterRequest)
+
+# Compress responses if the client accepts it.
+app.after_request(compression.compressResponse)
+
+@app.errorhandler(errors.ExecutionTimeout)
+def queryTimeout(e):
+    """Sent when a query takes longer than ``cfg.MONGO_QUERY_TIMEOUT``.
+
+    Args:
+        e (obj): Exception.
+
+    Returns:
+        str: JSON error response with HTTP status 503.
+    """
+    return jsonify({'status': -1, 'error': 'Database query took too long.'}), 503
+
+@app.errorhandler(errors.ConnectionFailure)
+def databaseUnavailable(e):
+    """Sent when Mongo can't be reached, or the circuit breaker is open
+    (see ``breaker``), and there is no last good response to send
+    instead.
+
+    Args:
+        e (obj): Exception.
+
+    Returns:
+        str: JSON error response with HTTP status 503.
+    """
+    return jsonify({'status': -1, 'error': 'Database unavailable.'}), 503
+
 @app.route("/")
 def root():
     """Root web page. Shows ``static/index.html``.
@@ -607,6 +659,24 @@ def imageId(id):
     id = id.replace('-','_')
     return util.returnOne({'type': 'IMAGE', 'unique_name': id}, request)
 
+@app.route("/batch", methods=['POST'])
+def batch():
+    """Sends the results of several single object queries.
+
+    Returns:
+        str: JSON response.
+    """
+    return util.returnBatch(request)
+
+@app.route("/stream")
+def stream():
+    """Sends new messages as they arrive as Server-Sent Events.
+
+    Returns:
+        str: ``text/event-stream`` response.
+    """
+    return eventstream.returnStream(request)
+
 @app.route("/static/legend")
 def staticLegend():
     """Sends object contain colors and legend information for images.
@@ -615,3 +685,22 @@ def staticLegend():
         str: JSON response.
     """
     return util.returnStaticOne({'_id': 'LEGEND'}, request)
+
+@app.route("/metrics")
+def metricsRoute():
+    """Sends request metrics in Prometheus text format.
+
+    Returns:
+        str: ``text/plain`` response.
+    """
+    return metrics.returnMetrics()
+
+@app.route("/debug/explain")
+def debugExplain():
+    """Sends the Mongo query plan of the route given by ``route=``.
+    Only answered for requests from the server itself.
+
+    Returns:
+        str: JSON response.
+    """
+    return slowquery.returnExplain(app, request)
@@ -0,0 +1,943 @@
+"""ASGI entry point: the same routes as ``app.py``, served asynchronously.
+
+With gunicorn's sync workers, each request holds a worker for as long
+as it takes Mongo to answer and the client to read the response, so
+a few slow clients (or long polls using ``wait=``) can stop the
+server answering anyone else. This module serves the same routes with
+the same responses, but with asyncio and the asynchronous Mongo
+driver (``pymongo.AsyncMongoClient``), so one process can have
+hundreds of requests in flight. Run it with any ASGI server, such as::
+
+  uvicorn asgi:application --host 0.0.0.0 --port 7214
+
+Routes answered by ``utilities.returnOne()`` and
+``utilities.returnMany()``, and ``/stream``, are handled here:
+
+* Queries to ``MSG`` are made with the asynchronous driver (or the
+  in-memory snapshot, if enabled).
+* CPU-heavy work (polygon tests, building responses) is done in a
+  pool of ``cfg.ASGI_THREADS`` threads, so it doesn't hold up the
+  event loop.
+* ``wait=`` and ``/stream`` wait on the event loop, not in a thread.
+* Streamed responses are sent as Mongo returns the messages (see
+  ``PoolMsgs``), so memory use doesn't depend on the size of the
+  result.
+* Identical ``utilities.returnMany()`` requests in flight share one
+  response (see ``coalesce``).
+* Requests are turned away with HTTP status 503 when the process is
+  too busy (see ``admission``), without waiting in a queue.
+
+Everything else (the web page, static files, ``STATIC_ITEMS`` routes,
+and requests with errors in their query string) is passed to the
+Flask application in the thread pool. The routes themselves are
+taken from ``app.py`` using ``utilities.describeRoute()``, so there is
+only one list of routes.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import io
+import sys
+import time
+
+import flask
+from pymongo import AsyncMongoClient
+from pymongo import errors
+from werkzeug.wrappers import Request
+
+import fisb_restConfig as cfg
+import utilities as util
+import app as flaskapp
+import eventstream
+import admission
+import breaker
+import coalesce
+import compression
+import fragcache
+import httpcache
+import lastgood
+import metrics
+import slowquery
+import notifier
+import snapshot
+
+# Thread pool for CPU-heavy and blocking work.
+_pool = concurrent.futures.ThreadPoolExecutor(max_workers=cfg.ASGI_THREADS, \
+    thread_name_prefix='asgi')
+
+# Asynchronous handle to the 'fisb' database. Created on first use,
+# since the client must be created in the event loop.
+_db = None
+
+# Set (and replaced) each time new messages arrive.
+_arrival = None
+_notifierStarted = False
+
+async def application(scope, receive, send):
+    """ASGI application.
+
+    Args:
+        scope (dict): Connection scope.
+        receive (function): Coroutine returning the next event from
+            the client.
+        send (function): Coroutine sending an event to the client.
+    """
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    if scope['type'] != 'http':
+        return
+
+    environ = await toEnviron(scope, receive)
+
+    if not metrics.isEnabled():
+        await handle(scope, receive, send, environ)
+        return
+
+    # Measured here, not by Flask, so time spent waiting on the event
+    # loop is counted.
+    environ[metrics.ENVIRON_KEY] = True
+    stats = metrics.startRequest()
+    sent = {'status': 500}
+
+    async def measuredSend(event):
+        if event['type'] == 'http.response.start':
+            sent['status'] = event['status']
+        elif event['type'] == 'http.response.body':
+            metrics.add('response_bytes', len(event.get('body', b'')))
+        await send(event)
+
+    try:
+        await handle(scope, receive, measuredSend, environ)
+    finally:
+        metrics.finishRequest(stats, routeName(scope['path']), sent['status'])
+
+def routeName(path):
+    """Return the route a path matches, for metrics and admission control.
+
+    Args:
+        path (str): Path part of a URL, such as ``'/metar/KIND'``.
+
+    Returns:
+        str: Route, such as ``'/metar/<id>'``, or ``'none'``.
+    """
+    try:
+        rule, _ = flaskapp.app.url_map.bind('localhost').match(path, \
+            return_rule=True)
+    except Exception:
+        return 'none'
+
+    return rule.rule
+
+async def handle(scope, receive, send, environ):
+    """Answer an HTTP request, unless ``admission`` turns it away.
+
+    Args:
+        scope (dict): Connection scope.
+        receive (function): Coroutine returning the next event from
+            the client.
+        send (function): Coroutine sending an event to the client.
+        environ (dict): WSGI environment of the request.
+    """
+    route = routeName(scope['path'])
+    slowquery.setRoute(route)
+
+    cost = 0
+    if admission.isEnabled():
+        cost = admission.routeCost(route)
+
+        # Flask mustn't count the request again.
+        environ[admission.ENVIRON_KEY] = 0
+
+    if cost > 0:
+        if not admission.admit(cost, 0):
+            await sendResponse(environ, send, \
+                lambda _: admission.busyResponse())
+            return
+
+        try:
+            await handleAdmitted(scope, receive, send, environ)
+        finally:
+            admission.release(cost)
+        return
+
+    await handleAdmitted(scope, receive, send, environ)
+
+async def handleAdmitted(scope, receive, send, environ):
+    """Answer an HTTP request let in by ``admission``.
+
+    Args:
+        scope (dict): Connection scope.
+        receive (function): Coroutine returning the next event from
+            the client.
+        send (function): Coroutine sending an event to the client.
+        environ (dict): WSGI environment of the request.
+    """
+    described = None
+    if scope['method'] == 'GET':
+        described = util.describeRoute(flaskapp.app, scope['path'])
+
+    if described is None:
+        await sendWsgi(flaskapp.app, environ, send)
+        return
+
+    kind, findArg1 = described
+
+    try:
+        if kind == util.ROUTE_ONE:
+            await handleOne(findArg1, environ, send)
+        elif kind == util.ROUTE_MANY:
+            await handleMany(findArg1, environ, send)
+        elif kind == util.ROUTE_STREAM:
+            await handleStream(environ, receive, send)
+        else:
+            await sendWsgi(flaskapp.app, environ, send)
+
+    except errors.ExecutionTimeout as e:
+        await sendResponse(environ, send, \
+            lambda _: flaskapp.app.make_response(flaskapp.queryTimeout(e)))
+
+    except errors.ConnectionFailure as e:
+        await sendResponse(environ, send, lambda _: \
+            flaskapp.app.make_response(flaskapp.databaseUnavailable(e)))
+
+async def lifespan(receive, send):
+    """Handle server startup and shutdown events.
+
+    Args:
+        receive (function): Coroutine returning the next event.
+        send (function): Coroutine sending an event.
+    """
+    while True:
+        event = await receive()
+
+        if event['type'] == 'lifespan.startup':
+            getDb()
+            await send({'type': 'lifespan.startup.complete'})
+
+        elif event['type'] == 'lifespan.shutdown':
+            if _db is not None:
+                await _db.client.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+def getDb():
+    """Return the asynchronous handle to the ``fisb`` database.
+
+    Returns:
+        obj: ``AsyncDatabase``.
+    """
+    global _db
+
+    if _db is None:
+        _db = AsyncMongoClient(cfg.MONGO_URI, **util.mongoClientOptions()).fisb
+
+    return _db
+
+async def runInPool(func, *args):
+    """Run a function in the thread pool.
+
+    The function is run in a copy of the current ``contextvars``
+    context, so it adds to the metrics of the current request.
+
+    Args:
+        func (function): Function to run.
+        *args: Arguments to ``func``.
+
+    Returns:
+        obj: Result of ``func``.
+    """
+    context = contextvars.copy_context()
+
+    return await asyncio.get_running_loop().run_in_executor(_pool, \
+        context.run, func, *args)
+
+async def toEnviron(scope, receive):
+    """Build a WSGI environment from an ASGI request.
+
+    The request body is read in full.
+
+    Args:
+        scope (dict): Connection scope.
+        receive (function): Coroutine returning the next event.
+
+    Returns:
+        dict: WSGI environment.
+    """
+    body = b''
+    while True:
+        event = await receive()
+        if event['type'] != 'http.request':
+            break
+
+        body += event.get('body', b'')
+        if not event.get('more_body', False):
+            break
+
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+
+        if name == 'CONTENT_LENGTH':
+            continue
+        if name != 'CONTENT_TYPE':
+            name = 'HTTP_' + name
+
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+
+    return environ
+
+async def sendWsgi(wsgiApp, environ, send, context=None):
+    """Send the response of a WSGI application.
+
+    The application is called, and its response read, in the
+    thread pool. Streamed responses are sent as they are produced.
+
+    Args:
+        wsgiApp (obj): WSGI application, such as the Flask application
+            or a Flask response.
+        environ (dict): WSGI environment.
+        send (function): Coroutine sending an event to the client.
+        context (obj): ``contextvars.Context`` to run the application
+            in. Streamed Flask responses need the one they were
+            built in.
+    """
+    if context is None:
+        context = contextvars.copy_context()
+
+    started = {}
+
+    def startResponse(status, headers, excInfo=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    def start():
+        body = wsgiApp(environ, startResponse)
+        iterator = iter(body)
+        return body, iterator, next(iterator, None)
+
+    body, iterator, chunk = await runInPool(context.run, start)
+
+    try:
+        await send({'type': 'http.response.start', \
+            'status': started['status'], \
+            'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) \
+                for k, v in started['headers']]})
+
+        while chunk is not None:
+            if len(chunk) > 0:
+                await send({'type': 'http.response.body', 'body': chunk, \
+                    'more_body': True})
+            chunk = await runInPool(context.run, next, iterator, None)
+
+        await send({'type': 'http.response.body', 'body': b''})
+
+    finally:
+        if hasattr(body, 'close'):
+            await runInPool(context.run, body.close)
+
+async def sendResponse(environ, send, respond):
+    """Build a Flask response in the thread pool and send it.
+
+    The response is compressed as Flask would (see ``compression``).
+
+    Args:
+        environ (dict): WSGI environment.
+        send (function): Coroutine sending an event to the client.
+        respond (function): Function taking the Flask request and
+            returning a Flask response. Called in a request context.
+    """
+    context = contextvars.copy_context()
+
+    def build():
+        with flaskapp.app.request_context(environ):
+            return compression.compressResponse(respond(flask.request))
+
+    response = await runInPool(context.run, build)
+    await sendWsgi(response, environ, send, context)
+
+async def findMsgs(findArg1, limit, filters=[], copyMsgs=True, keysOnly=False):
+    """Asynchronous version of ``utilities.findMsgs()``.
+
+    Args:
+        findArg1 (dict): Query.
+        limit (int): Maximum number of messages to return.
+        filters (list): Filters from ``utilities.pointFilter()`` or
+            ``utilities.altFilter()``.
+        copyMsgs (bool): If ``False``, messages from the snapshot are
+            not copied, and must not be altered by the caller.
+        keysOnly (bool): If ``True``, messages from Mongo may only
+            contain ``_id``, ``insert_time``, and ``digest``.
+
+    Returns:
+        list: Messages sorted by ``util.SORT_ORDER``.
+    """
+    batches, tests = await findMsgBatches(findArg1, limit, filters, \
+        copyMsgs, keysOnly)
+
+    msgs = []
+    try:
+        async for batch in batches:
+            if len(tests) > 0:
+                batch = await runInPool(util.passingMsgs, batch, tests)
+
+            msgs.extend(batch)
+            if len(msgs) >= limit:
+                break
+
+    finally:
+        await batches.aclose()
+
+    return msgs[0:limit]
+
+async def findMsgBatches(findArg1, limit, filters=[], copyMsgs=True, \
+        keysOnly=False):
+    """Start finding the messages matching a query.
+
+    Work done in the thread pool (snapshot lookups, building queries
+    from filters) is done here, before any batch is read, so batches
+    can be read from a pool thread (see ``PoolMsgs``) without waiting
+    for another one.
+
+    Args:
+        findArg1 (dict): Query.
+        limit (int): Maximum number of messages wanted.
+        filters (list): Filters from ``utilities.pointFilter()`` or
+            ``utilities.altFilter()``.
+        copyMsgs (bool): If ``False``, messages from the snapshot are
+            not copied, and must not be altered by the caller.
+        keysOnly (bool): If ``True``, messages from Mongo may only
+            contain ``_id``, ``insert_time``, and ``digest``.
+
+    Returns:
+        tuple: Tuple containing:
+
+        1. (obj) Asynchronous generator of lists of messages, sorted
+           by ``util.SORT_ORDER``. Must be closed with ``aclose()``.
+        2. (list) Tests (for ``utilities.passingMsgs()``) the messages
+           must still pass. Only the first ``limit`` messages passing
+           them are wanted.
+    """
+    tests = [f[0] for f in filters]
+
+    if snapshot.isReady():
+        def fromSnapshot():
+            msgs = snapshot.find(findArg1, limit, tests, copyMsgs)
+            return None if msgs is None else list(msgs)
+
+        msgs = await runInPool(fromSnapshot)
+        if msgs is not None:
+            if len(tests) == 0:
+                metrics.add('documents_scanned', len(msgs))
+            return listBatches(msgs), []
+
+    queries = [findArg1]
+    tests = []
+
+    for test, mongoQuery in filters:
+        # Building the geo query may use MSG_GEO with the blocking driver.
+        query = None if mongoQuery is None else await runInPool(mongoQuery)
+
+        if query is None:
+            tests.append(test)
+        else:
+            queries.append(query)
+
+    if len(queries) > 1:
+        findArg1 = {'$and': queries}
+
+    projection = None
+    if keysOnly:
+        projection = {'insert_time': 1, 'digest': 1}
+        if len(tests) > 0:
+            projection['geojson'] = 1
+
+    breaker.check()
+
+    return cursorBatches(findArg1, projection, limit, tests), tests
+
+async def listBatches(msgs):
+    """Asynchronous generator of a list of messages, as one batch.
+
+    Args:
+        msgs (list): Messages.
+
+    Yields:
+        list: ``msgs``.
+    """
+    yield msgs
+
+async def cursorBatches(findArg1, projection, limit, tests):
+    """Read the messages matching a query from Mongo, a batch at a time.
+
+    Args:
+        findArg1 (dict): Query.
+        projection (dict): Projection, or ``None``.
+        limit (int): Maximum number of messages wanted.
+        tests (list): Tests the messages must still pass. If there
+            are any, ``limit`` is left to the reader.
+
+    Yields:
+        list: Up to ``cfg.FILTER_BATCH_SIZE`` messages.
+    """
+    cursor = getDb().MSG.find(findArg1, projection).sort(util.SORT_ORDER) \
+        .max_time_ms(util.queryTimeoutMs())
+    if len(tests) == 0:
+        cursor = cursor.limit(limit)
+
+    batch = []
+    scanned = 0
+    failed = False
+
+    # Only the time waiting on the cursor counts as Mongo time.
+    mongoSeconds = 0.0
+    firstSeconds = None
+
+    try:
+        start = time.perf_counter()
+        async for msg in cursor:
+            mongoSeconds += time.perf_counter() - start
+            if firstSeconds is None:
+                firstSeconds = mongoSeconds
+
+            batch.append(msg)
+            if len(batch) >= cfg.FILTER_BATCH_SIZE:
+                scanned += len(batch)
+                yield batch
+                batch = []
+
+            start = time.perf_counter()
+
+        if len(batch) > 0:
+            scanned += len(batch)
+            yield batch
+
+    except breaker.MONGO_ERRORS:
+        failed = True
+        breaker.failed()
+        raise
+
+    finally:
+        await cursor.close()
+
+        # Also done if the reader stopped early.
+        if not failed:
+            metrics.add('mongo_seconds', mongoSeconds)
+            if len(tests) == 0:
+                metrics.add('documents_scanned', scanned)
+            breaker.succeeded(mongoSeconds if firstSeconds is None \
+                else firstSeconds)
+            slowquery.check(mongoSeconds, findArg1, projection, \
+                util.SORT_ORDER, None if len(tests) > 0 else limit)
+
+class PoolMsgs(object):
+    """Iterate, in a pool thread, over messages read on the event loop.
+
+    Streamed responses are built in the thread pool, a piece at a
+    time, by ``utilities.streamMany()``. This lets them read the
+    messages as Mongo returns them, rather than all at once. Tests
+    are run in the thread reading the messages.
+
+    Args:
+        batches (obj): Asynchronous generator from ``findMsgBatches()``.
+        tests (list): Tests from ``findMsgBatches()``.
+        limit (int): Maximum number of messages.
+        loop (obj): Event loop ``batches`` runs on.
+    """
+    def __init__(self, batches, tests, limit, loop):
+        self.batches = batches
+        self.tests = tests
+        self.remaining = limit
+        self.loop = loop
+        self.pending = collections.deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while len(self.pending) == 0:
+            if self.remaining <= 0:
+                raise StopIteration
+
+            # The caller's context is used, so metrics are counted.
+            try:
+                batch = asyncio.run_coroutine_threadsafe( \
+                    self.batches.__anext__(), self.loop).result()
+            except StopAsyncIteration:
+                raise StopIteration
+
+            if len(self.tests) > 0:
+                batch = util.passingMsgs(batch, self.tests)
+
+            batch = batch[0:self.remaining]
+            self.remaining -= len(batch)
+            self.pending.extend(batch)
+
+        return self.pending.popleft()
+
+    def close(self):
+        """Stop reading, and close the Mongo cursor.
+        """
+        self.remaining = 0
+        asyncio.run_coroutine_threadsafe(self.batches.aclose(), \
+            self.loop).result()
+
+async def findOneMsg(findArg1):
+    """Asynchronous version of ``utilities.findOneMsg()``.
+
+    Args:
+        findArg1 (dict): Query.
+
+    Returns:
+        dict: Message found, or ``None``.
+    """
+    if snapshot.isReady():
+        answered, msg = await runInPool(snapshot.findOne, findArg1)
+        if answered:
+            return msg
+
+    breaker.check()
+
+    start = time.perf_counter()
+    try:
+        msg = await getDb().MSG.find_one(findArg1, \
+            max_time_ms=util.queryTimeoutMs())
+    except breaker.MONGO_ERRORS:
+        breaker.failed()
+        raise
+    seconds = time.perf_counter() - start
+
+    metrics.add('mongo_seconds', seconds)
+    breaker.succeeded(seconds)
+    slowquery.check(seconds, findArg1, None, None, 1)
+
+    if msg is not None:
+        metrics.add('documents_scanned', 1)
+
+    return msg
+
+async def startNotifier():
+    """Start ``notifier`` and have it wake waiters on the event loop.
+    """
+    global _notifierStarted, _arrival
+
+    if _notifierStarted:
+        return
+    _notifierStarted = True
+
+    loop = asyncio.get_running_loop()
+    _arrival = asyncio.Event()
+
+    def wake():
+        global _arrival
+
+        arrival = _arrival
+        _arrival = asyncio.Event()
+        arrival.set()
+
+    await runInPool(notifier.start, util.dbConn)
+    notifier.subscribe(lambda msg: loop.call_soon_threadsafe(wake))
+
+async def waitForMsgs(findArg1, filters, wait):
+    """Asynchronous version of ``utilities.waitForMsgs()``.
+
+    Args:
+        findArg1 (dict): Query.
+        filters (list): Filters for ``findMsgs()``.
+        wait (float): Maximum seconds to wait.
+    """
+    await startNotifier()
+    deadline = asyncio.get_running_loop().time() + wait
+
+    while True:
+        arrival = _arrival
+
+        if len(await findMsgs(findArg1, 1, filters, False, True)) > 0:
+            return
+
+        remaining = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0.0:
+            return
+
+        try:
+            await asyncio.wait_for(arrival.wait(), remaining)
+        except asyncio.TimeoutError:
+            return
+
+async def handleOne(findArg1, environ, send):
+    """Answer a route using ``utilities.returnOne()``.
+
+    Args:
+        findArg1 (dict): Query for the route.
+        environ (dict): WSGI environment.
+        send (function): Coroutine sending an event to the client.
+    """
+    items = util.getStandardQueryItems(Request(environ))
+    hasError, _, afterDt = items[0:3]
+    field, ids = util.splitIds(findArg1)
+
+    if hasError or ((ids is not None) and (len(ids) > cfg.BATCH_MAX_QUERIES)):
+        await sendWsgi(flaskapp.app, environ, send)
+        return
+
+    findArg1['insert_time'] = {'$gt': afterDt}
+
+    if ids is not None:
+        query = dict(findArg1)
+        query[field] = {'$in': ids}
+        msgs = util.oneMsgPerId(await findMsgs(query, util.DEFAULT_LIMIT), field)
+
+        await sendResponse(environ, send, lambda request: \
+            util.respondMultiOne(msgs, findArg1, ids, request, items))
+        return
+
+    msg = await findOneMsg(findArg1)
+
+    await sendResponse(environ, send, \
+        lambda request: util.respondOne(msg, findArg1, request, items))
+
+async def handleMany(findArg1, environ, send):
+    """Answer a route using ``utilities.returnMany()``.
+
+    Args:
+        findArg1 (dict): Query for the route.
+        environ (dict): WSGI environment.
+        send (function): Coroutine sending an event to the client.
+    """
+    request = Request(environ)
+    items = util.getStandardQueryItems(request)
+    hasError, _, afterDt, limit = items[0:4]
+    waitError, _, wait = util.getWaitQueryItem(request)
+    nextError, _, nextKey = util.getNextQueryItem(request)
+
+    if hasError or waitError or nextError:
+        await sendWsgi(flaskapp.app, environ, send)
+        return
+
+    _, streaming, variant = util.responseVariant(request)
+    key = coalesce.requestKey(findArg1, items, request.args.get('next'), \
+        variant)
+
+    findArg1['insert_time'] = {'$gt': afterDt}
+
+    # Building the point test searches the spatial index.
+    filters = await runInPool(util.queryFilters, items)
+
+    if nextKey is not None:
+        util.startAfterKey(findArg1, filters, nextKey)
+
+    try:
+        respond = await manyResponder(findArg1, request, environ, items, \
+            filters, wait, streaming, variant, key)
+    except breaker.MONGO_ERRORS:
+        stale = None if streaming else lastgood.staleResponse(key)
+        if stale is None:
+            raise
+
+        respond = lambda _: stale
+
+    await sendResponse(environ, send, \
+        lambda request: util.varyOnAccept(respond(request)))
+
+async def manyResponder(findArg1, request, environ, items, filters, wait, \
+        streaming, variant, key):
+    """Asynchronous version of ``utilities.manyResponse()``.
+
+    Mongo is queried here, and the response is built in the thread
+    pool, in a request context.
+
+    Args:
+        findArg1 (dict): Query for ``findMsgs()``.
+        request (obj): Werkzeug request.
+        environ (dict): WSGI environment.
+        items (tuple): Result of ``utilities.getStandardQueryItems()``.
+        filters (list): Filters for ``findMsgs()``.
+        wait (float): ``wait=`` value of the request.
+        streaming (bool): ``True`` if the response will be streamed.
+        variant (str): Name of the representation.
+        key (tuple): Key from ``coalesce.requestKey()``.
+
+    Returns:
+        function: Function taking the Flask request and returning
+        the Flask response (for ``sendResponse()``).
+    """
+    limit = items[3]
+
+    if wait > 0.0:
+        await waitForMsgs(findArg1, filters, wait)
+
+    etag = None
+
+    if request.if_none_match:
+        etagBuilder = util.manyEtagBuilder(variant, items, request)
+        for msg in await findMsgs(findArg1, limit, filters, False, True):
+            etagBuilder.add(msg)
+        etag = etagBuilder.etag()
+
+        if httpcache.isNotModified(request, etag):
+            return lambda _: \
+                httpcache.notModified(etag, httpcache.maxAge(findArg1))
+
+    copyMsgs = not fragcache.isEnabled()
+
+    async def findAndRespond():
+        msgs = await findMsgs(findArg1, limit, filters, copyMsgs)
+        return lambda request: lastgood.keep(key, \
+            util.respondMany(msgs, findArg1, request, items, etag))
+
+    # Streamed responses read Mongo as they are sent.
+    if streaming:
+        batches, tests = await findMsgBatches(findArg1, limit, filters, \
+            copyMsgs)
+        msgs = PoolMsgs(batches, tests, limit, asyncio.get_running_loop())
+
+        def respondStreaming(request):
+            response = util.respondMany(msgs, findArg1, request, items, etag)
+            response.call_on_close(msgs.close)
+            return response
+
+        return respondStreaming
+
+    if not coalesce.isEnabled():
+        return await findAndRespond()
+
+    async def build():
+        respond = await findAndRespond()
+        context = contextvars.copy_context()
+
+        def share():
+            with flaskapp.app.request_context(environ):
+                return coalesce.share(respond(flask.request))
+
+        return await runInPool(context.run, share)
+
+    shared = await coalesce.runAsync(key, build)
+    return lambda _: coalesce.rebuild(shared)
+
+async def handleStream(environ, receive, send):
+    """Answer ``/stream``.
+
+    Args:
+        environ (dict): WSGI environment.
+        receive (function): Coroutine returning the next event from
+            the client.
+        send (function): Coroutine sending an event to the client.
+    """
+    hasError, _, limit, backlogQuery, tests, filters = \
+        await runInPool(eventstream.parseStreamRequest, Request(environ))
+
+    if hasError:
+        await sendWsgi(flaskapp.app, environ, send)
+        return
+
+    loop = asyncio.get_running_loop()
+    msgQueue = asyncio.Queue()
+    state = {'dropped': False}
+
+    # Called in the thread that passes new messages on.
+    def receiveMsg(msg):
+        if state['dropped'] or not all(t(msg) for t in tests):
+            return
+
+        loop.call_soon_threadsafe(put, msg)
+
+    def put(msg):
+        if state['dropped']:
+            return
+
+        if msgQueue.qsize() >= cfg.SSE_QUEUE_SIZE:
+            state['dropped'] = True
+            notifier.unsubscribe(receiveMsg)
+            msg = None
+
+        msgQueue.put_nowait(msg)
+
+    async def waitForDisconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    # Transforming and encoding messages is done in the thread pool.
+    def formatEvent(msg):
+        with flaskapp.app.app_context():
+            return eventstream.formatEvent(msg)
+
+    async def sendBody(body):
+        await send({'type': 'http.response.body', 'body': body, \
+            'more_body': True})
+
+    await startNotifier()
+    notifier.subscribe(receiveMsg)
+    disconnected = asyncio.ensure_future(waitForDisconnect())
+
+    try:
+        headers = [(b'content-type', b'text/event-stream; charset=utf-8')]
+        for k, v in eventstream.STREAM_HEADERS.items():
+            headers.append((k.lower().encode('latin-1'), v.encode('latin-1')))
+
+        await send({'type': 'http.response.start', 'status': 200, \
+            'headers': headers})
+        await sendBody(eventstream.retryField())
+
+        # Messages in both the backlog and the queue are only sent once.
+        sent = set()
+        if backlogQuery is not None:
+            for msg in await findMsgs(backlogQuery, limit, filters, False):
+                sent.add((msg['_id'], msg['insert_time']))
+                await sendBody(await runInPool(formatEvent, msg))
+
+        while True:
+            getter = asyncio.ensure_future(msgQueue.get())
+            done, _ = await asyncio.wait([getter, disconnected], \
+                timeout=cfg.SSE_KEEPALIVE, \
+                return_when=asyncio.FIRST_COMPLETED)
+
+            if getter not in done:
+                getter.cancel()
+                if disconnected in done:
+                    return
+
+                await sendBody(eventstream.KEEPALIVE_COMMENT)
+                continue
+
+            msg = getter.result()
+            if msg is None:
+                await sendBody(eventstream.DROPPED_EVENT)
+                break
+
+            if (msg['_id'], msg['insert_time']) in sent:
+                continue
+
+            await sendBody(await runInPool(formatEvent, msg))
+
+        await send({'type': 'http.response.body', 'body': b''})
+
+    finally:
+        notifier.unsubscribe(receiveMsg)
+        disconnected.cancel()
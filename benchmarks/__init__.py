@@ -0,0 +1,13 @@
+"""Benchmarks for FIS-B Rest.
+
+Run these from the ``fisb-rest`` directory, as modules:
+
+* ``python3 -m benchmarks.gendata``: fill ``MSG`` with synthetic
+  messages shaped like the ones 'fisb-decode' writes.
+* ``python3 -m benchmarks.loadtest``: send requests to each route of
+  a running server and write throughput and latencies as JSON.
+* ``python3 -m benchmarks.micro``: time the transform and filter
+  functions in ``utilities`` and compare with the baselines in
+  ``benchmarks/baselines``.
+* ``python3 -m benchmarks.compare``: compare two JSON results.
+"""
@@ -0,0 +1,119 @@
+"""Compare two benchmark results.
+
+Both files are JSON with a ``"cases"`` object, as written by
+``benchmarks.loadtest`` or ``benchmarks.micro``. For each case in
+both, the change in each value is printed as a percentage. Cases only
+in one file are listed.
+
+Usage (from the ``fisb-rest`` directory)::
+
+  python3 -m benchmarks.compare old.json new.json --threshold 10
+
+With ``--threshold``, the exit status is ``1`` if any checked value
+got worse by more than that percentage.
+"""
+
+import argparse
+import json
+import sys
+
+#: Values compared for ``benchmarks.loadtest`` results, and whether
+#: bigger is better.
+VALUES = [('throughput', True), ('p50', False), ('p95', False), \
+    ('p99', False)]
+
+#: Values compared for ``benchmarks.micro`` results.
+MICRO_VALUES = [('seconds', False)]
+
+def loadCases(filename):
+    """Read the cases of a result file.
+
+    Args:
+        filename (str): Result file.
+
+    Returns:
+        dict: The ``"cases"`` object.
+    """
+    with open(filename) as f:
+        return json.load(f)['cases']
+
+def change(old, new, biggerIsBetter):
+    """Return how much worse a value got, as a percentage.
+
+    Args:
+        old (float): Old value.
+        new (float): New value.
+        biggerIsBetter (bool): ``True`` if a bigger value is better.
+
+    Returns:
+        float: Percentage. Negative if the value got better.
+    """
+    if old == 0:
+        return 0.0
+
+    percent = (new - old) * 100.0 / old
+    return -percent if biggerIsBetter else percent
+
+def compare(oldCases, newCases, values=VALUES, threshold=None):
+    """Compare two sets of cases and print the changes.
+
+    Args:
+        oldCases (dict): Cases of the old result.
+        newCases (dict): Cases of the new result.
+        values (list): Values to compare, as in ``VALUES``.
+        threshold (float): Percentage a value may get worse by, or
+            ``None`` for no limit.
+
+    Returns:
+        list: Names of cases with a value worse than ``threshold``.
+    """
+    worse = []
+
+    print('{:40s} '.format('case') + \
+        ' '.join('{:>11s}'.format(v) for v, _ in values) + '  (% worse)')
+
+    for name in sorted(set(oldCases) | set(newCases)):
+        if name not in newCases:
+            print('{:40s} only in old'.format(name))
+            continue
+        if name not in oldCases:
+            print('{:40s} only in new'.format(name))
+            continue
+
+        changes = [change(oldCases[name][v], newCases[name][v], better) \
+            for v, better in values]
+
+        flag = ''
+        if (threshold is not None) and any(c > threshold for c in changes):
+            worse.append(name)
+            flag = '  WORSE'
+
+        print('{:40s} '.format(name) + \
+            ' '.join('{:+11.1f}'.format(c) for c in changes) + flag)
+
+    return worse
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare benchmark results.')
+    parser.add_argument('old', help='Old result file.')
+    parser.add_argument('new', help='New result file.')
+    parser.add_argument('--threshold', type=float, default=None, \
+        help='Exit with status 1 if a value got worse by more than ' + \
+             'this percentage.')
+    args = parser.parse_args()
+
+    oldCases = loadCases(args.old)
+    newCases = loadCases(args.new)
+
+    values = VALUES
+    if any('throughput' not in c for c in oldCases.values()):
+        values = MICRO_VALUES
+
+    worse = compare(oldCases, newCases, values, args.threshold)
+
+    if len(worse) > 0:
+        print('{} case(s) worse than {}%.'.format(len(worse), args.threshold))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
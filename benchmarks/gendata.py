@@ -0,0 +1,485 @@
+"""Fill ``MSG`` with synthetic messages for benchmarking.
+
+The messages are shaped like the ones 'fisb-decode' writes (see the
+examples in the documentation): METAR, TAF, and winds text with a
+point location, NOTAM, TFR, SUA, and G-AIRMET polygons with
+``altitudes``, CRL ``reports``, RSR ``stations``, image objects, and
+cancellations. Polygons are placed at random over the continental
+US, and ``--vertices`` sets how many points each has.
+
+The same ``--seed`` and ``--scale`` always give the same messages, so
+runs on different versions of FIS-B Rest can be compared.
+
+Usage (from the ``fisb-rest`` directory)::
+
+  python3 -m benchmarks.gendata --scale 2 --drop
+
+``MSG`` must be empty, or ``--drop`` given to empty it first. Don't
+run this against a database 'fisb-decode' is writing to.
+"""
+
+import argparse
+import datetime
+import hashlib
+import math
+import random
+import string
+import sys
+
+from pymongo import MongoClient
+
+import fisb_restConfig as cfg
+import utilities as util
+
+#: Time all generated times are relative to.
+BASE_TIME = datetime.datetime(2021, 6, 25, 12, 0, 0, \
+    tzinfo=datetime.timezone.utc)
+
+#: Area polygons and points are placed in: (south, north, west, east).
+CONUS = (25.0, 49.0, -125.0, -67.0)
+
+#: Number of messages of each kind at ``--scale 1``.
+COUNTS = {
+    'METAR': 2000,
+    'TAF': 600,
+    'WINDS': 500,
+    'PIREP': 200,
+    'NOTAM-TFR': 60,
+    'NOTAM-D': 1500,
+    'NOTAM-D-SUA': 300,
+    'NOTAM-FDC': 300,
+    'NOTAM-TMOA': 40,
+    'NOTAM-TRA': 40,
+    'G_AIRMET': 150,
+    'AIRMET': 60,
+    'SIGMET': 20,
+    'CWA': 20,
+    'SUA': 60,
+    'FIS_B_UNAVAILABLE': 20,
+    'CANCEL': 40,
+    'STATIONS': 20,
+    'LOCATIONS': 300,
+}
+
+#: CRL types, with their product id, type, and look-ahead range.
+CRL_TYPES = [
+    ('CRL_8', 8, 'NOTAM/TFR', 100),
+    ('CRL_11', 11, 'AIRMET', 375),
+    ('CRL_12', 12, 'SIGMET', 375),
+    ('CRL_14', 14, 'G-AIRMET', 375),
+    ('CRL_15', 15, 'CWA', 375),
+    ('CRL_16', 16, 'NOTAM/TRA', 100),
+    ('CRL_17', 17, 'NOTAM/TMOA', 100),
+]
+
+#: Image products and the names of their images.
+IMAGES = [('NEXRAD_REGIONAL', ['NEXRAD_REGIONAL']), \
+    ('NEXRAD_CONUS', ['NEXRAD_CONUS']), \
+    ('LIGHTNING', ['LIGHTNING_ALL', 'LIGHTNING_POS']), \
+    ('CLOUD_TOPS', ['CLOUD_TOPS'])] + \
+    [('ICING_{:05d}'.format(a), ['ICING_{:05d}_PRB'.format(a), \
+        'ICING_{:05d}_SEV'.format(a), 'ICING_{:05d}_SLD'.format(a)]) \
+        for a in range(2000, 26000, 2000)] + \
+    [('TURBULENCE_{:05d}'.format(a), ['TURBULENCE_{:05d}'.format(a)]) \
+        for a in range(2000, 26000, 2000)]
+
+#: Messages inserted at a time.
+INSERT_BATCH = 1000
+
+class Generator:
+    """Makes synthetic messages from a seeded random number generator.
+
+    Args:
+        seed (int): Random number seed.
+        vertices (int): Points in each polygon.
+    """
+    def __init__(self, seed, vertices):
+        self.rng = random.Random(seed)
+        self.vertices = vertices
+        self.usedNames = set()
+        self.serial = 0
+
+    def time(self, minutes):
+        """Return a time relative to ``BASE_TIME``.
+
+        Args:
+            minutes (float): Minutes after ``BASE_TIME`` (may be negative).
+
+        Returns:
+            datetime: Time.
+        """
+        return BASE_TIME + datetime.timedelta(minutes=minutes)
+
+    def name(self, letters, prefix=''):
+        """Return a unique random name.
+
+        Args:
+            letters (int): Number of random letters.
+            prefix (str): Added to the front of the name.
+
+        Returns:
+            str: Name not returned before.
+        """
+        while True:
+            name = prefix + ''.join(self.rng.choice(string.ascii_uppercase) \
+                for _ in range(letters))
+            if name not in self.usedNames:
+                self.usedNames.add(name)
+                return name
+
+    def number(self):
+        """Return a unique NOTAM style number, such as ``'21-10892'``.
+
+        Returns:
+            str: Number.
+        """
+        self.serial += 1
+        return '21-{}'.format(1000 + self.serial)
+
+    def point(self):
+        """Return a random point.
+
+        Returns:
+            tuple: Latitude and longitude.
+        """
+        south, north, west, east = CONUS
+        return self.rng.uniform(south, north), self.rng.uniform(west, east)
+
+    def text(self, words):
+        """Return random upper case text.
+
+        Args:
+            words (int): Number of words.
+
+        Returns:
+            str: Text.
+        """
+        return ' '.join(''.join(self.rng.choice(string.ascii_uppercase + \
+            string.digits) for _ in range(self.rng.randint(2, 8))) \
+            for _ in range(words))
+
+    def pointGeojson(self, lat, lon):
+        """Return a ``"geojson"`` field with a single point.
+
+        Args:
+            lat (float): Latitude.
+            lon (float): Longitude.
+
+        Returns:
+            dict: GeoJSON feature collection.
+        """
+        return {'type': 'FeatureCollection', 'features': [ \
+            {'type': 'Feature', 'properties': {}, \
+             'geometry': {'type': 'Point', \
+                          'coordinates': [round(lon, 6), round(lat, 6)]}}]}
+
+    def polygonFeature(self, id, element, high, low, start, stop):
+        """Return a polygon feature with ``altitudes``.
+
+        As 'fisb-decode' writes them, the coordinates are a single
+        list of ``[longitude, latitude]`` points, and the first point
+        is not repeated at the end.
+
+        Args:
+            id (str): ``"id"`` property.
+            element (str): ``"element"`` property.
+            high (int): Top altitude (feet).
+            low (int): Bottom altitude (feet).
+            start (datetime): ``"start_time"`` property.
+            stop (datetime): ``"stop_time"`` property.
+
+        Returns:
+            dict: GeoJSON feature.
+        """
+        lat, lon = self.point()
+        radius = self.rng.uniform(0.1, 3.0)
+        coords = []
+        for i in range(self.vertices):
+            angle = 2.0 * math.pi * i / self.vertices
+            r = radius * self.rng.uniform(0.8, 1.0)
+            coords.append([round(lon + r * math.cos(angle), 6), \
+                round(lat + r * math.sin(angle), 6)])
+
+        return {'type': 'Feature', \
+            'geometry': {'type': 'Polygon', 'coordinates': coords}, \
+            'properties': {'altitudes': [high, 'MSL', low, 'MSL'], \
+                'element': element, 'id': id, \
+                'start_time': start, 'stop_time': stop}}
+
+    def polygonGeojson(self, id, element, count):
+        """Return a ``"geojson"`` field with one or more polygons.
+
+        Args:
+            id (str): ``"id"`` property of each feature.
+            element (str): ``"element"`` property of each feature.
+            count (int): Number of polygons.
+
+        Returns:
+            dict: GeoJSON feature collection.
+        """
+        features = []
+        for _ in range(count):
+            low = self.rng.choice([0, 0, 1000, 5000, 12000, 18000])
+            high = low + self.rng.choice([3000, 5000, 10000, 17000, 30000])
+            start = self.time(self.rng.uniform(-120, 60))
+            features.append(self.polygonFeature(id, element, high, low, \
+                start, start + datetime.timedelta(hours=6)))
+
+        return {'type': 'FeatureCollection', 'features': features}
+
+    def station(self):
+        """Return a ground station name, such as
+        ``'40.0383~-86.255593'``.
+
+        Returns:
+            str: Station.
+        """
+        lat, lon = self.point()
+        return '{:.4f}~{:.6f}'.format(lat, lon)
+
+def generateMsgs(scale=1, seed=1, vertices=32):
+    """Generate synthetic messages.
+
+    Args:
+        scale (int): Multiplies the number of messages in ``COUNTS``.
+        seed (int): Random number seed.
+        vertices (int): Points in each polygon.
+
+    Yields:
+        dict: Messages, without ``_id``, ``insert_time``, or ``digest``
+        (see ``finishMsg()``).
+    """
+    g = Generator(seed, vertices)
+    rng = g.rng
+
+    def count(kind):
+        return COUNTS[kind] * scale
+
+    stations = [g.station() for _ in range(count('STATIONS'))]
+    locations = [g.name(3, 'K') for _ in range(count('LOCATIONS'))]
+
+    for _ in range(count('METAR')):
+        name = g.name(3, 'K')
+        lat, lon = g.point()
+        yield {'type': 'METAR', 'unique_name': name, \
+            'contents': 'METAR {} 251154Z {}='.format(name, g.text(14)), \
+            'observation_time': g.time(-6), 'expiration_time': g.time(114), \
+            'geojson': g.pointGeojson(lat, lon)}
+
+    for _ in range(count('TAF')):
+        name = g.name(3, 'K')
+        lat, lon = g.point()
+        yield {'type': 'TAF', 'unique_name': name, \
+            'issued_time': g.time(-40), 'valid_period_begin_time': g.time(0), \
+            'valid_period_end_time': g.time(1800), \
+            'contents': 'TAF {} 251120Z {}='.format(name, \
+                '\n'.join(g.text(8) for _ in range(5))), \
+            'expiration_time': g.time(1800), \
+            'geojson': g.pointGeojson(lat, lon)}
+
+    for msgType in ['WINDS_06_HR', 'WINDS_12_HR', 'WINDS_24_HR']:
+        for _ in range(count('WINDS')):
+            yield {'type': msgType, 'unique_name': g.name(3), \
+                'model_run_time': g.time(-120), 'issued_time': g.time(-2), \
+                'valid_time': g.time(720), 'for_use_from_time': g.time(540), \
+                'for_use_to_time': g.time(1080), \
+                'contents': ' '.join('{:04d}{:+03d}'.format( \
+                    rng.randint(0, 3699), rng.randint(-60, 30)) \
+                    for _ in range(9)), \
+                'expiration_time': g.time(1080)}
+
+    for _ in range(count('PIREP')):
+        lat, lon = g.point()
+        station = g.name(3)
+        yield {'type': 'PIREP', \
+            'unique_name': g.name(12, 'p'), 'station': station, \
+            'report_type': rng.choice(['UA', 'UUA']), \
+            'contents': 'PIREP {} 251140Z {}'.format(station, g.text(12)), \
+            'fl': str(rng.randint(10, 400)), 'report_time': g.time(-20), \
+            'expiration_time': g.time(100), \
+            'geojson': g.pointGeojson(lat, lon)}
+
+    # NOTAMs. Subtypes with graphics get polygons.
+    for subtype, polygons in [('TFR', (1, 4)), ('D', None), \
+            ('D-SUA', (1, 2)), ('FDC', None), ('TMOA', (1, 3)), \
+            ('TRA', (1, 3))]:
+        for _ in range(count('NOTAM-' + subtype)):
+            number = g.number()
+            msg = {'type': 'NOTAM', 'subtype': subtype, \
+                'unique_name': number, 'number': number.replace('-', '/'), \
+                'location': rng.choice(locations), \
+                'station': rng.choice(stations), \
+                'contents': 'NOTAM-{} {} {}'.format(subtype, number, \
+                    g.text(rng.randint(10, 80))), \
+                'start_of_activity_time': g.time(-60), \
+                'end_of_validity_time': g.time(4320), \
+                'expiration_time': g.time(4320)}
+            if polygons is not None:
+                msg['geojson'] = g.polygonGeojson(number, subtype, \
+                    rng.randint(*polygons))
+            yield msg
+
+    for _ in range(count('G_AIRMET')):
+        number = g.number()
+        subtype = rng.choice([0, 3, 6])
+        yield {'type': 'G_AIRMET', 'unique_name': number, 'subtype': subtype, \
+            'station': rng.choice(stations), \
+            'issued_time': g.time(-15), \
+            'for_use_from_time': g.time(subtype * 60), \
+            'for_use_to_time': g.time(subtype * 60 + 180), \
+            'expiration_time': g.time(subtype * 60 + 180), \
+            'geojson': g.polygonGeojson(number, rng.choice(['TURB-HI', \
+                'TURB-LO', 'ICING', 'IFR', 'MT_OBSC', 'LLWS', 'SFC_WND']), \
+                rng.randint(1, 3))}
+
+    for msgType in ['AIRMET', 'SIGMET', 'CWA']:
+        for _ in range(count(msgType)):
+            number = g.number()
+            msg = {'type': msgType, 'unique_name': number, \
+                'station': rng.choice(stations), \
+                'issued_time': g.time(-30), 'for_use_from_time': g.time(-15), \
+                'for_use_to_time': g.time(165), \
+                'contents': '{} {}'.format(msgType, g.text(60)), \
+                'expiration_time': g.time(165), \
+                'geojson': g.polygonGeojson(number, msgType, \
+                    rng.randint(1, 2))}
+            if msgType == 'SIGMET':
+                msg['subtype'] = rng.choice(['SIGMET', 'WST'])
+            yield msg
+
+    for msgType in ['NOTAM', 'G_AIRMET', 'CWA', 'SIGMET', 'AIRMET']:
+        for _ in range(count('CANCEL') // 5):
+            number = g.number()
+            yield {'type': msgType, 'unique_name': number, 'cancel': number, \
+                'expiration_time': g.time(30)}
+
+    for _ in range(count('SUA')):
+        low = rng.choice([0, 5000, 10000])
+        yield {'type': 'SUA', 'unique_name': g.number(), \
+            'start_time': g.time(180), 'end_time': g.time(540), \
+            'schedule_id': str(rng.randint(1000000, 9999999)), \
+            'airspace_id': str(rng.randint(10000, 99999)), \
+            'status': rng.choice(['P', 'W', 'A']), \
+            'airspace_type': rng.choice(['W', 'R', 'M', 'A', 'B']), \
+            'airspace_name': g.name(5), \
+            'expiration_time': g.time(540), \
+            'high_altitude': low + 13000, 'low_altitude': low, \
+            'separation_rule': 'A'}
+
+    for _ in range(count('FIS_B_UNAVAILABLE')):
+        yield {'type': 'FIS_B_UNAVAILABLE', 'unique_name': g.number(), \
+            'product': 'NEXRAD', 'contents': g.text(6), \
+            'issued_time': g.time(-600), 'expiration_time': g.time(600), \
+            'centers': sorted(rng.sample(['ZAB', 'ZAU', 'ZFW', 'ZHU', 'ZID', \
+                'ZKC', 'ZMP', 'ZOB', 'ZNY', 'ZDC'], 4))}
+
+    # One CRL of each type and a service status per ground station.
+    for station in stations:
+        for msgType, productId, productType, rangeNm in CRL_TYPES:
+            reports = ['{}/{}{}'.format(g.number(), rng.choice(['TO', 'TG']), \
+                '*' if rng.random() < 0.9 else '') \
+                for _ in range(rng.randint(0, 120))]
+            yield {'type': msgType, 'unique_name': station, \
+                'station': station, 'product_id': productId, \
+                'product_type': productType, 'range_nm': rangeNm, \
+                'overflow': 1 if rng.random() < 0.05 else 0, \
+                'reports': reports, 'expiration_time': g.time(20)}
+
+        yield {'type': 'SERVICE_STATUS', 'unique_name': station, \
+            'expiration_time': g.time(1), \
+            'traffic': ['{:06x}/{}'.format(rng.randint(0xa00000, 0xadf7c7), \
+                rng.choice(['X', 'T', 'R', 'S', 'TRS'])) \
+                for _ in range(rng.randint(0, 40))]}
+
+    yield {'type': 'RSR', 'unique_name': 'RSR', \
+        'stations': dict((s, [rng.randint(100, 3000), rng.randint(5, 40), \
+            rng.randint(50, 100)]) for s in stations), \
+        'expiration_time': g.time(1)}
+
+    for name, imageNames in IMAGES:
+        yield {'type': 'IMAGE', 'unique_name': name, \
+            'observation_time': g.time(-4), \
+            'bbox': [[round(CONUS[1], 6), round(CONUS[2], 6)], \
+                     [round(CONUS[0], 6), round(CONUS[3], 6)]], \
+            'expiration_time': g.time(71), \
+            'urls': dict((n, 'http://127.0.0.1:5000/png/{}.png'.format( \
+                g.name(12, 'i'))) for n in imageNames)}
+
+def finishMsg(msg, n):
+    """Add the fields 'fisb-decode' adds when storing a message.
+
+    ``insert_time`` values are spread over the hour before
+    ``BASE_TIME``, in the order the messages were generated.
+
+    Args:
+        msg (dict): Message from ``generateMsgs()``. It is altered.
+        n (int): Number of the message.
+
+    Returns:
+        dict: ``msg``.
+    """
+    msg['_id'] = '{}-{}'.format(msg['type'], msg['unique_name'])
+    msg['insert_time'] = BASE_TIME - datetime.timedelta(seconds=3600) + \
+        datetime.timedelta(milliseconds=n * 50)
+    msg['digest'] = hashlib.sha1(repr(sorted(msg.items(), \
+        key=lambda x: x[0])).encode('utf-8')).hexdigest()
+
+    return msg
+
+def loadMsgs(db, msgs):
+    """Insert messages into ``MSG``.
+
+    Args:
+        db (obj): Handle to the database.
+        msgs (obj): Iterable of messages from ``generateMsgs()``.
+
+    Returns:
+        int: Number of messages inserted.
+    """
+    batch = []
+    n = 0
+
+    for msg in msgs:
+        batch.append(finishMsg(msg, n))
+        n += 1
+
+        if len(batch) >= INSERT_BATCH:
+            db.MSG.insert_many(batch)
+            batch = []
+
+    if len(batch) > 0:
+        db.MSG.insert_many(batch)
+
+    return n
+
+def main():
+    parser = argparse.ArgumentParser( \
+        description='Fill MSG with synthetic messages for benchmarking.')
+    parser.add_argument('--uri', default=cfg.MONGO_URI, \
+        help='Mongo URI (default: MONGO_URI from fisb_restConfig.py).')
+    parser.add_argument('--database', default='fisb', \
+        help='Database name (default: fisb, which the server uses).')
+    parser.add_argument('--scale', type=int, default=1, \
+        help='Multiplies the number of messages (default: 1).')
+    parser.add_argument('--seed', type=int, default=1, \
+        help='Random number seed (default: 1).')
+    parser.add_argument('--vertices', type=int, default=32, \
+        help='Points in each polygon (default: 32).')
+    parser.add_argument('--drop', action='store_true', \
+        help='Delete all messages in MSG (and MSG_GEO) first.')
+    args = parser.parse_args()
+
+    db = MongoClient(args.uri, **util.mongoClientOptions())[args.database]
+
+    if args.drop:
+        db.MSG.delete_many({})
+        db.MSG_GEO.delete_many({})
+    elif db.MSG.estimated_document_count() > 0:
+        print('MSG is not empty. Use --drop to empty it first.')
+        sys.exit(1)
+
+    n = loadMsgs(db, generateMsgs(args.scale, args.seed, args.vertices))
+    print('Inserted {} messages.'.format(n))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""Send requests to each route of a running server and time them.
+
+The routes are taken from ``app.py``. Ids for routes such as
+``/metar/<id>`` are picked from the messages in ``MSG`` (normally put
+there by ``benchmarks.gendata``). Each route is requested several
+ways (called cases):
+
+* as is,
+* with ``lat=``/``lon=`` and with ``high=``/``low=`` (routes
+  returning many messages),
+* with a list of ids (single object routes),
+
+and ``/batch`` is sent a list of single object queries. ``/stream``
+(which never ends) and ``/metrics`` are skipped.
+
+Each case is requested ``--requests`` times by ``--concurrency``
+threads, each with its own keep-alive connection. The result is
+written as JSON::
+
+  {
+    "info": {...settings and time of the run...},
+    "cases": {
+      "/metar?lat,lon": {
+        "requests": 200, "errors": 0, "seconds": 0.81,
+        "throughput": 246.9, "bytes": 1843200,
+        "mean": 0.032, "p50": 0.030, "p95": 0.051, "p99": 0.067
+      },
+      ...
+    }
+  }
+
+Times are in seconds and throughput is in requests per second. Use
+``benchmarks.compare`` to compare two results.
+
+Usage (from the ``fisb-rest`` directory)::
+
+  python3 -m benchmarks.loadtest --url http://127.0.0.1:7214 \\
+    --concurrency 8 --requests 200 --output results.json
+"""
+
+import argparse
+import datetime
+import http.client
+import json
+import platform
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+import fisb_restConfig as cfg
+
+#: Point used for ``lat=``/``lon=`` cases (Dayton, Ohio).
+SAMPLE_POINT = (39.9, -84.2)
+
+#: Altitudes used for ``high=``/``low=`` cases.
+SAMPLE_ALTITUDES = (10000, 3000)
+
+#: Ids used in list of ids cases and ``/batch``.
+IDS_PER_LIST = 10
+
+#: Routes not requested.
+SKIPPED_ROUTES = ['/', '/<path:filename>', '/stream', '/metrics']
+
+def loadApp():
+    """Import ``app.py`` without the work it does at startup that a
+    load test doesn't need.
+
+    Returns:
+        tuple: The ``app`` and ``utilities`` modules.
+    """
+    cfg.SNAPSHOT_ENABLED = False
+
+    import app
+    import utilities
+
+    return app, utilities
+
+def sampleIds(db, findArg1, field, rng):
+    """Pick ids from ``MSG`` for a route such as ``/metar/<id>``.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+        findArg1 (dict): Query the route makes, from
+            ``utilities.describeRoute()``.
+        field (str): Field the id is compared with.
+        rng (obj): ``random.Random`` used to pick.
+
+    Returns:
+        list: Up to ``IDS_PER_LIST`` ids.
+    """
+    query = dict((k, v) for k, v in findArg1.items() if k != field)
+    ids = sorted(str(x) for x in db.MSG.distinct(field, query))
+    rng.shuffle(ids)
+
+    return ids[0:IDS_PER_LIST]
+
+def makeCases(app, util, rng):
+    """Build the list of requests to make.
+
+    Args:
+        app (obj): The ``app`` module.
+        util (obj): The ``utilities`` module.
+        rng (obj): ``random.Random`` used to pick ids.
+
+    Returns:
+        list: List of tuples of case name, method, path (with query
+        string), and body (or ``None``).
+    """
+    lat, lon = SAMPLE_POINT
+    high, low = SAMPLE_ALTITUDES
+    cases = []
+    batchPaths = []
+
+    for rule in sorted(app.app.url_map.iter_rules(), key=lambda r: r.rule):
+        if (rule.rule in SKIPPED_ROUTES) or ('GET' not in rule.methods):
+            continue
+
+        path = rule.rule
+        for arg in rule.arguments:
+            path = path.replace('<{}>'.format(arg), 'X')
+
+        described = util.describeRoute(app.app, path)
+        if described is None:
+            continue
+
+        kind, findArg1 = described
+
+        if len(rule.arguments) == 0:
+            cases.append((rule.rule, 'GET', rule.rule, None))
+            if kind == util.ROUTE_MANY:
+                cases.append((rule.rule + '?lat,lon', 'GET', \
+                    '{}?lat={}&lon={}'.format(rule.rule, lat, lon), None))
+                cases.append((rule.rule + '?high,low', 'GET', \
+                    '{}?high={}&low={}'.format(rule.rule, high, low), None))
+            continue
+
+        fields = [k for k, v in findArg1.items() if v == 'X']
+        ids = []
+        if len(fields) == 1:
+            ids = sampleIds(util.dbConn, findArg1, fields[0], rng)
+
+        if len(ids) == 0:
+            print('No ids found for {}, skipped.'.format(rule.rule), \
+                file=sys.stderr)
+            continue
+
+        prefix = rule.rule.split('<')[0]
+        def idPath(id):
+            return prefix + urllib.parse.quote(id, safe='')
+
+        cases.append((rule.rule, 'GET', idPath(ids[0]), None))
+        if kind == util.ROUTE_ONE:
+            cases.append((rule.rule + ' (list)', 'GET', \
+                prefix + ','.join(idPath(id)[len(prefix):] for id in ids), \
+                None))
+            batchPaths.append(idPath(ids[-1]))
+
+    if len(batchPaths) > 0:
+        cases.append(('/batch', 'POST', '/batch', \
+            json.dumps({'queries': batchPaths}).encode('utf-8')))
+
+    return cases
+
+def runCase(host, port, method, path, body, requests, concurrency, headers):
+    """Make the requests of one case.
+
+    Args:
+        host (str): Server host.
+        port (int): Server port.
+        method (str): ``'GET'`` or ``'POST'``.
+        path (str): Path and query string.
+        body (bytes): Body, or ``None``.
+        requests (int): Number of requests.
+        concurrency (int): Number of threads making requests.
+        headers (dict): Headers sent with each request.
+
+    Returns:
+        dict: Result of the case.
+    """
+    latencies = []
+    counts = {'errors': 0, 'bytes': 0, 'left': requests}
+    lock = threading.Lock()
+
+    def worker():
+        conn = http.client.HTTPConnection(host, port, timeout=60)
+        myLatencies = []
+        errors = 0
+        nBytes = 0
+
+        while True:
+            with lock:
+                if counts['left'] == 0:
+                    break
+                counts['left'] -= 1
+
+            start = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+                if response.status not in [200, 304]:
+                    errors += 1
+                nBytes += len(data)
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection(host, port, timeout=60)
+            myLatencies.append(time.perf_counter() - start)
+
+        conn.close()
+        with lock:
+            latencies.extend(myLatencies)
+            counts['errors'] += errors
+            counts['bytes'] += nBytes
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+
+    return {'requests': requests, 'errors': counts['errors'], \
+        'seconds': seconds, 'throughput': requests / seconds, \
+        'bytes': counts['bytes'], \
+        'mean': sum(latencies) / len(latencies), \
+        'p50': percentile(latencies, 50), \
+        'p95': percentile(latencies, 95), \
+        'p99': percentile(latencies, 99)}
+
+def percentile(values, p):
+    """Return a percentile of sorted values (nearest rank).
+
+    Args:
+        values (list): Sorted values.
+        p (float): Percentile (0-100).
+
+    Returns:
+        float: Value at the percentile.
+    """
+    if len(values) == 0:
+        return 0.0
+
+    rank = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+def main():
+    parser = argparse.ArgumentParser( \
+        description='Time requests to each route of a running server.')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', \
+        help='Server URL (default: http://127.0.0.1:5000).')
+    parser.add_argument('--concurrency', type=int, default=8, \
+        help='Threads making requests (default: 8).')
+    parser.add_argument('--requests', type=int, default=200, \
+        help='Requests for each case (default: 200).')
+    parser.add_argument('--warmup', type=int, default=5, \
+        help='Untimed requests for each case first (default: 5).')
+    parser.add_argument('--routes', default=None, \
+        help='Only run cases whose name matches this regular expression.')
+    parser.add_argument('--seed', type=int, default=1, \
+        help='Random number seed used to pick ids (default: 1).')
+    parser.add_argument('--gzip', action='store_true', \
+        help='Send "Accept-Encoding: gzip".')
+    parser.add_argument('--output', default=None, \
+        help='File to write results to (default: standard output).')
+    args = parser.parse_args()
+
+    url = urllib.parse.urlsplit(args.url)
+    host = url.hostname
+    port = url.port or 80
+
+    headers = {'Content-Type': 'application/json'}
+    if args.gzip:
+        headers['Accept-Encoding'] = 'gzip'
+
+    app, util = loadApp()
+    cases = makeCases(app, util, random.Random(args.seed))
+    if args.routes is not None:
+        cases = [c for c in cases if re.search(args.routes, c[0])]
+
+    results = {}
+    for name, method, path, body in cases:
+        if args.warmup > 0:
+            runCase(host, port, method, path, body, args.warmup, 1, headers)
+
+        results[name] = runCase(host, port, method, path, body, \
+            args.requests, args.concurrency, headers)
+
+        print('{:40s} {:8.1f}/s  p50 {:7.1f}ms  p95 {:7.1f}ms  p99 {:7.1f}ms' \
+            .format(name, results[name]['throughput'], \
+            results[name]['p50'] * 1000, results[name]['p95'] * 1000, \
+            results[name]['p99'] * 1000), file=sys.stderr)
+
+    output = {'info': {'url': args.url, 'concurrency': args.concurrency, \
+            'requests': args.requests, 'gzip': args.gzip, \
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(), \
+            'python': platform.python_version(), \
+            'platform': platform.platform()}, \
+        'cases': results}
+
+    text = json.dumps(output, indent=2, sort_keys=True)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == "__main__":
+    main()
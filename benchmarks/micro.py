@@ -0,0 +1,313 @@
+"""Time the functions in ``utilities`` that transform and filter
+messages.
+
+These run in Python for every message of every request, so a change
+that makes one slower shows up here as a number long before it shows
+up in production. Each function is timed on synthetic messages (from
+``benchmarks.gendata``) over a grid of input sizes:
+
+* ``vertices``: points in each polygon (``VERTICES``),
+* ``features``: polygons in each message (``FEATURES``),
+* ``batch``: messages handled in one timed run (``BATCHES``).
+
+Only the sizes a function depends on are varied, and
+``checkIfInPolygon()`` inputs over ``MAX_POINTS`` points are skipped.
+Each case is run ``--repeat`` times (on a new input each time, if the
+function alters it), and the fastest time
+for the whole batch is kept (as ``"seconds"``), along with the median
+and the fastest time per message. ``checkIfInPolygon()`` is timed
+both ``cold`` (polygons not yet built) and ``warm`` (polygons already
+in ``spatialindex``).
+
+Baselines are kept in ``benchmarks/baselines/micro.json``. To check
+for regressions, from the ``fisb-rest`` directory::
+
+  python3 -m benchmarks.micro --compare benchmarks/baselines/micro.json
+
+This exits with status ``1`` if any case is more than ``--threshold``
+percent slower. To update the baselines after an intended change::
+
+  python3 -m benchmarks.micro --output benchmarks/baselines/micro.json
+
+Times depend on the machine, so compare runs made on the same one.
+"""
+
+import argparse
+import datetime
+import functools
+import itertools
+import json
+import platform
+import re
+import statistics
+import sys
+import time
+
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+import utilities as util
+import spatialindex
+from benchmarks import gendata
+from benchmarks import compare
+
+#: Points in each polygon.
+VERTICES = [8, 64, 512]
+
+#: Polygons in each message.
+FEATURES = [1, 4, 16]
+
+#: Messages in each timed run.
+BATCHES = [10, 100, 1000]
+
+#: Query strings used for ``getStandardQueryItems()``.
+QUERY_STRINGS = {
+    'plain': '',
+    'latlon': 'lat=39.9&lon=-84.2',
+    'all': 'after=2021-06-25T11:00:00Z&limit=500&lat=39.9&lon=-84.2' + \
+        '&high=10000&low=3000',
+}
+
+#: Point used for ``checkIfInPolygon()``.
+SAMPLE_POINT = (39.9, -84.2)
+
+#: Altitudes used for ``checkIfInAltBounds()``.
+SAMPLE_ALTITUDES = (10000, 3000)
+
+#: Largest input for ``checkIfInPolygon()``, in total polygon points
+#: (vertices x features x batch). Bigger grid points are skipped.
+MAX_POINTS = 1000000
+
+#: Default path of the baselines.
+BASELINE_FILE = 'benchmarks/baselines/micro.json'
+
+def polygonMsgs(batch, features, vertices, seed=1):
+    """Make NOTAM-TFR messages with polygons.
+
+    Args:
+        batch (int): Number of messages.
+        features (int): Polygons in each message.
+        vertices (int): Points in each polygon.
+        seed (int): Random number seed.
+
+    Returns:
+        list: Messages, as stored in ``MSG``.
+    """
+    g = gendata.Generator(seed, vertices)
+    msgs = []
+
+    for n in range(batch):
+        number = g.number()
+        msgs.append(gendata.finishMsg({'type': 'NOTAM', 'subtype': 'TFR', \
+            'unique_name': number, 'number': number.replace('-', '/'), \
+            'location': 'KDAY', 'station': g.station(), \
+            'contents': g.text(40), \
+            'start_of_activity_time': g.time(-60), \
+            'end_of_validity_time': g.time(4320), \
+            'expiration_time': g.time(4320), \
+            'geojson': g.polygonGeojson(number, 'TFR', features)}, n))
+
+    return msgs
+
+@functools.lru_cache(maxsize=1)
+def lastPolygonMsgs(batch, features, vertices):
+    """Same as ``polygonMsgs()``, but the last result is kept, so
+    cases with the same input share it (the biggest inputs take
+    a while to make).
+    """
+    return polygonMsgs(batch, features, vertices)
+
+def crlMsgs(batch, seed=1):
+    """Make complete CRL messages (the slowest case, since every
+    report is checked).
+
+    Args:
+        batch (int): Number of messages.
+        seed (int): Random number seed.
+
+    Returns:
+        list: Messages, as stored in ``MSG``.
+    """
+    g = gendata.Generator(seed, 8)
+
+    return [gendata.finishMsg({'type': 'CRL_8', 'unique_name': s, \
+        'station': s, 'product_id': 8, 'product_type': 'NOTAM/TFR', \
+        'range_nm': 100, 'overflow': 0, \
+        'reports': ['{}/TO*'.format(g.number()) for _ in range(100)], \
+        'expiration_time': g.time(20)}, n) \
+        for n, s in enumerate(g.station() for _ in range(batch))]
+
+def rsrMsgs(batch, seed=1):
+    """Make RSR messages.
+
+    Args:
+        batch (int): Number of messages.
+        seed (int): Random number seed.
+
+    Returns:
+        list: Messages, as stored in ``MSG``.
+    """
+    g = gendata.Generator(seed, 8)
+
+    return [gendata.finishMsg({'type': 'RSR', 'unique_name': 'RSR', \
+        'stations': dict((g.station(), [1000, 20, 90]) for _ in range(20)), \
+        'expiration_time': g.time(1)}, n) for n in range(batch)]
+
+def requests(batch, queryString):
+    """Make Flask style request objects.
+
+    Args:
+        batch (int): Number of requests.
+        queryString (str): Query string of each.
+
+    Returns:
+        list: Requests.
+    """
+    return [Request(EnvironBuilder(path='/notam', \
+        query_string=queryString).get_environ()) for _ in range(batch)]
+
+def makeCases():
+    """Build the list of cases.
+
+    Returns:
+        list: List of tuples of case name, function making the input,
+        function to run on each item of the input, function called
+        before each run (or ``None``), and ``True`` if each run needs
+        a new input (because the function alters it).
+    """
+    lat, lon = SAMPLE_POINT
+    high, low = SAMPLE_ALTITUDES
+    cases = []
+
+    for (name, qs), batch in itertools.product(QUERY_STRINGS.items(), BATCHES):
+        cases.append(('getStandardQueryItems[{},batch={}]'.format(name, batch), \
+            lambda qs=qs, batch=batch: requests(batch, qs), \
+            util.getStandardQueryItems, None, True))
+
+    for features, batch in itertools.product(FEATURES, BATCHES):
+        size = 'features={},batch={}'.format(features, batch)
+        msgs = lambda features=features, batch=batch: \
+            polygonMsgs(batch, features, 8)
+
+        cases.append(('convertMsgDtToIsoString[{}]'.format(size), msgs, \
+            util.convertMsgDtToIsoString, None, True))
+        cases.append(('changeStandardFields[{}]'.format(size), msgs, \
+            util.changeStandardFields, None, True))
+        cases.append(('checkIfInAltBounds[{}]'.format(size), msgs, \
+            lambda msg: util.checkIfInAltBounds(msg, high, low), None, False))
+
+    for batch in BATCHES:
+        cases.append(('addCrlCompleteField[batch={}]'.format(batch), \
+            lambda batch=batch: crlMsgs(batch), \
+            util.addCrlCompleteField, None, True))
+        cases.append(('augmentRsr[batch={}]'.format(batch), \
+            lambda batch=batch: rsrMsgs(batch), util.augmentRsr, None, True))
+
+    test = lambda msg: util.checkIfInPolygon(msg, lat, lon)
+
+    for vertices, features, batch in itertools.product(VERTICES, FEATURES, \
+            BATCHES):
+        if vertices * features * batch > MAX_POINTS:
+            continue
+
+        size = 'vertices={},features={},batch={}'.format(vertices, features, \
+            batch)
+        msgs = lambda vertices=vertices, features=features, batch=batch: \
+            lastPolygonMsgs(batch, features, vertices)
+
+        cases.append(('checkIfInPolygon[cold,{}]'.format(size), msgs, test, \
+            spatialindex.clear, False))
+        cases.append(('checkIfInPolygon[warm,{}]'.format(size), msgs, test, \
+            None, False))
+
+    return cases
+
+def runCase(makeInput, func, before, fresh, repeat):
+    """Time one case.
+
+    Args:
+        makeInput (function): Returns the input (a list). If
+            ``fresh`` is ``True``, it must return a new one each call.
+        func (function): Function run on each item of the input.
+        before (function): Called before each run, or ``None``.
+        fresh (bool): If ``True``, each run is given a new input,
+            made before timing starts.
+        repeat (int): Number of runs.
+
+    Returns:
+        dict: Result of the case.
+    """
+    items = makeInput()
+
+    inputs = [items] * repeat
+    if fresh:
+        inputs = [makeInput() for _ in range(repeat)]
+
+    # An untimed run, so 'warm' cases have their polygons built.
+    for item in items:
+        func(item)
+
+    times = []
+    for run in inputs:
+        if before is not None:
+            before()
+
+        start = time.perf_counter()
+        for item in run:
+            func(item)
+        times.append(time.perf_counter() - start)
+
+    return {'seconds': min(times), 'median': statistics.median(times), \
+        'per_item': min(times) / len(items), 'repeat': repeat}
+
+def main():
+    parser = argparse.ArgumentParser( \
+        description='Time utilities transform and filter functions.')
+    parser.add_argument('--repeat', type=int, default=5, \
+        help='Timed runs of each case (default: 5).')
+    parser.add_argument('--cases', default=None, \
+        help='Only run cases whose name matches this regular expression.')
+    parser.add_argument('--output', default=None, \
+        help='File to write results to (such as ' + BASELINE_FILE + ').')
+    parser.add_argument('--compare', default=None, \
+        help='Baseline file to compare with.')
+    parser.add_argument('--threshold', type=float, default=25.0, \
+        help='With --compare, exit with status 1 if a case is more ' + \
+             'than this percent slower (default: 25).')
+    args = parser.parse_args()
+
+    results = {}
+    for name, makeInput, func, before, fresh in makeCases():
+        if (args.cases is not None) and not re.search(args.cases, name):
+            continue
+
+        results[name] = runCase(makeInput, func, before, fresh, args.repeat)
+        print('{:64s} {:10.3f}ms  {:8.2f}us/item'.format(name, \
+            results[name]['seconds'] * 1000, \
+            results[name]['per_item'] * 1000000), file=sys.stderr)
+
+    output = {'info': {'repeat': args.repeat, \
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(), \
+            'python': platform.python_version(), \
+            'platform': platform.platform()}, \
+        'cases': results}
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(json.dumps(output, indent=2, sort_keys=True) + '\n')
+    elif args.compare is None:
+        print(json.dumps(output, indent=2, sort_keys=True))
+
+    if args.compare is not None:
+        baseline = compare.loadCases(args.compare)
+        baseline = dict((k, v) for k, v in baseline.items() if k in results)
+
+        worse = compare.compare(baseline, results, compare.MICRO_VALUES, \
+            args.threshold)
+        if len(worse) > 0:
+            print('{} case(s) more than {}% slower than {}.'.format( \
+                len(worse), args.threshold, args.compare))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
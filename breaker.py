@@ -0,0 +1,158 @@
+"""Circuit breaker for queries made to Mongo by requests.
+
+If Mongo stops answering (a ``mongod`` restart, or a long bulk delete
+by 'fisb-decode'), every request waits for the driver to give up,
+and soon every worker is waiting. Instead, after
+``cfg.MONGO_BREAKER_FAILURES`` failures in a row, the breaker *opens*:
+queries made by requests fail at once with ``OpenError`` (and
+``returnMany()`` routes answer with their last good response, see
+``lastgood``). Queries answered by the in-memory snapshot don't use
+Mongo, so aren't affected.
+
+A failure is a connection error or timeout, or a query whose first
+results took more than ``cfg.MONGO_BREAKER_SLOW`` seconds. While the
+breaker is open, a single thread in each process pings Mongo every
+``cfg.MONGO_BREAKER_RETRY`` seconds, and closes the breaker when it
+answers.
+"""
+
+import threading
+import time
+
+from pymongo import errors
+
+import fisb_restConfig as cfg
+import utilities as util
+import errlog
+
+class OpenError(errors.ConnectionFailure):
+    """Raised instead of querying Mongo while the breaker is open.
+    """
+
+#: Exceptions counted as Mongo failures.
+MONGO_ERRORS = (errors.ConnectionFailure, errors.ExecutionTimeout)
+
+# Failures in a row, and 'True' while the breaker is open.
+_failures = 0
+_open = False
+
+# Thread pinging Mongo while the breaker is open.
+_probe = None
+
+_lock = threading.Lock()
+
+def isEnabled():
+    """Check if the breaker is turned on.
+
+    Returns:
+        bool: ``True`` if ``cfg.MONGO_BREAKER_FAILURES`` is more than 0.
+    """
+    return cfg.MONGO_BREAKER_FAILURES > 0
+
+def isOpen():
+    """Check if queries are being kept from Mongo.
+
+    Returns:
+        bool: ``True`` if the breaker is open.
+    """
+    return _open
+
+def check():
+    """Call before querying Mongo.
+
+    Raises:
+        OpenError: If the breaker is open.
+    """
+    if _open:
+        raise OpenError('Database unavailable.')
+
+def succeeded(seconds):
+    """Record a query that worked.
+
+    Args:
+        seconds (float): Time until Mongo answered. If more than
+            ``cfg.MONGO_BREAKER_SLOW``, this counts as a failure.
+    """
+    global _failures
+
+    if seconds > cfg.MONGO_BREAKER_SLOW:
+        failed()
+        return
+
+    # Only the probe closes an open breaker.
+    with _lock:
+        _failures = 0
+
+def failed():
+    """Record a failed query, opening the breaker if there have been
+    ``cfg.MONGO_BREAKER_FAILURES`` in a row.
+    """
+    global _failures, _open, _probe
+
+    if not isEnabled():
+        return
+
+    with _lock:
+        _failures += 1
+        if _open or (_failures < cfg.MONGO_BREAKER_FAILURES):
+            return
+
+        _open = True
+        errlog.logMessage('circuit breaker', \
+            'Mongo not answering. Breaker open.')
+
+        if (_probe is None) or not _probe.is_alive():
+            _probe = threading.Thread(target=_runProbe, daemon=True, \
+                name='mongo-breaker')
+            _probe.start()
+
+def guarded(msgs):
+    """Iterate over a Mongo cursor, recording the result with
+    ``succeeded()`` or ``failed()``.
+
+    Args:
+        msgs (obj): Mongo cursor (or any iterable reading from Mongo).
+
+    Yields:
+        dict: Messages from ``msgs``.
+    """
+    start = time.monotonic()
+
+    try:
+        for msg in msgs:
+            if start is not None:
+                succeeded(time.monotonic() - start)
+                start = None
+
+            yield msg
+
+    except MONGO_ERRORS:
+        failed()
+        raise
+
+    if start is not None:
+        succeeded(time.monotonic() - start)
+
+def _runProbe():
+    """Ping Mongo until it answers, then close the breaker.
+    """
+    global _failures, _open
+
+    while True:
+        time.sleep(cfg.MONGO_BREAKER_RETRY)
+
+        try:
+            start = time.monotonic()
+            util.dbConn.command('ping')
+            if time.monotonic() - start > cfg.MONGO_BREAKER_SLOW:
+                continue
+        except Exception:
+            continue
+
+        with _lock:
+            _failures = 0
+            _open = False
+
+        errlog.logMessage('circuit breaker', \
+            'Mongo answering again. Breaker closed.')
+        return
@@ -0,0 +1,78 @@
+"""Least recently used cache holding at most a number of bytes.
+
+Used by ``fragcache``, ``compression``, and ``lastgood``, which each
+keep encoded data that is expensive to make and cheap to keep.
+"""
+
+import collections
+import threading
+
+class ByteLRU(object):
+    """Thread safe cache of values with a size in bytes.
+
+    When the total size is over ``maxBytes``, the least recently used
+    entries are dropped.
+
+    Args:
+        maxBytes (int): Most bytes to hold. ``0`` holds nothing.
+    """
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.totalBytes = 0
+
+        # Entries (value, size), oldest first.
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value for a key.
+
+        Args:
+            key (obj): Key.
+
+        Returns:
+            obj: Value, or ``None`` if not cached.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size=None):
+        """Add a value, replacing any with the same key.
+
+        Values bigger than the whole cache are not added.
+
+        Args:
+            key (obj): Key.
+            value (obj): Value.
+            size (int): Size of ``value`` in bytes. If ``None``,
+                ``len(value)`` is used.
+        """
+        if size is None:
+            size = len(value)
+
+        if size > self.maxBytes:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.totalBytes -= old[1]
+
+            self.entries[key] = (value, size)
+            self.totalBytes += size
+
+            while self.totalBytes > self.maxBytes:
+                _, (_, dropped) = self.entries.popitem(last=False)
+                self.totalBytes -= dropped
+
+    def clear(self):
+        """Remove everything.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.totalBytes = 0
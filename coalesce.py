@@ -0,0 +1,182 @@
+"""Coalescing of identical requests in flight.
+
+When a new G-AIRMET or TFR arrives, many clients ask for the same
+thing within a few milliseconds. Without coalescing, each runs its own
+query, transform, and JSON encoding. Here, requests for
+``utilities.returnMany()`` routes with the same normalized query (see
+``requestKey()``) are grouped: the first (the *leader*) builds the
+response, and requests arriving while it does so wait for it and are
+sent the same bytes and headers. Requests arriving after the leader
+finishes start a new group. A waiting request may arrive after the
+leader started its query, so its response may miss a message that
+arrived in between: the guarantee is only that each response was
+current when its leader started.
+
+``run()`` is used by threads (Flask with gunicorn's ``gthread``
+workers). ``runAsync()`` is used by ``asgi.py``. Streamed responses
+are never coalesced. Each response is compressed (if the client
+accepts it) separately, after it is shared.
+"""
+
+import asyncio
+import threading
+
+from flask import Response
+
+import fisb_restConfig as cfg
+import metrics
+
+class _Call(object):
+    """A response being built by a leader.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+# Calls in flight, by key, for 'run()' and 'runAsync()'.
+_calls = {}
+_asyncCalls = {}
+
+_lock = threading.Lock()
+
+def isEnabled():
+    """Check if coalescing is turned on.
+
+    Returns:
+        bool: ``True`` if ``cfg.COALESCE_REQUESTS`` is ``True``.
+    """
+    return cfg.COALESCE_REQUESTS
+
+def requestKey(findArg1, items, nextStr, variant):
+    """Make the key identifying requests with the same response.
+
+    Args:
+        findArg1 (dict): Query of the route, before ``insert_time``
+            is added.
+        items (tuple): Result of ``utilities.getStandardQueryItems()``.
+            The parsed ``after``, ``limit``, ``lat``, ``lon``, ``high``
+            and ``low`` values are used, so (for example)
+            ``lat=39.90`` and ``lat=39.9`` are the same request.
+        nextStr (str): ``next=`` value of the request, or ``None``.
+        variant (str): Name of the representation, from
+            ``utilities.responseVariant()``.
+
+    Returns:
+        tuple: Key.
+    """
+    return (repr(findArg1), nextStr, variant) + tuple(items[2:])
+
+def share(response):
+    """Turn a response into something that can be sent many times.
+
+    Args:
+        response (obj): Flask response, not streamed.
+
+    Returns:
+        tuple: Status, body (bytes), and list of headers.
+    """
+    return response.status_code, response.get_data(), \
+        list(response.headers.items())
+
+def rebuild(shared):
+    """Make a new response from the result of ``share()``.
+
+    Args:
+        shared (tuple): Result of ``share()``.
+
+    Returns:
+        obj: Flask response.
+    """
+    status, body, headers = shared
+    return Response(body, status=status, headers=headers)
+
+def run(key, build):
+    """Build a response, or wait for an identical one in flight.
+
+    Args:
+        key (tuple): Key from ``requestKey()``.
+        build (function): Function returning a Flask response that
+            isn't streamed. Only called by the leader.
+
+    Returns:
+        obj: Flask response. If ``build()`` raised an exception,
+        it is raised in every request of the group.
+    """
+    with _lock:
+        call = _calls.get(key)
+        isLeader = call is None
+        if isLeader:
+            call = _calls[key] = _Call()
+
+    if not isLeader:
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+
+        metrics.add('requests_coalesced', 1)
+        return rebuild(call.result)
+
+    try:
+        response = build()
+        call.result = share(response)
+        return response
+    except BaseException as e:
+        call.error = e
+        raise
+    finally:
+        with _lock:
+            del _calls[key]
+        call.done.set()
+
+async def runAsync(key, build):
+    """Asynchronous version of ``run()``, for ``asgi.py``.
+
+    Must be called from the event loop.
+
+    Args:
+        key (tuple): Key from ``requestKey()``.
+        build (function): Coroutine function returning the result of
+            ``share()``. Only called by the leader.
+
+    Returns:
+        tuple: Result of ``share()``. If ``build()`` raised an
+        exception, it is raised in every request of the group.
+    """
+    while key in _asyncCalls:
+        future = _asyncCalls[key]
+
+        # shield(), so a follower that is cancelled (its client went
+        # away) doesn't cancel the leader's work.
+        try:
+            shared = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+
+            # The leader was cancelled. Try again, probably as leader.
+            continue
+
+        metrics.add('requests_coalesced', 1)
+        return shared
+
+    future = asyncio.get_running_loop().create_future()
+    _asyncCalls[key] = future
+
+    try:
+        shared = await build()
+        future.set_result(shared)
+        return shared
+    except BaseException as e:
+        if isinstance(e, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(e)
+        raise
+    finally:
+        del _asyncCalls[key]
+
+        # Nobody may be waiting, so don't let asyncio report the
+        # exception as never retrieved.
+        if future.done() and not future.cancelled():
+            future.exception()
@@ -0,0 +1,132 @@
+"""Compress responses with gzip or brotli, as the client accepts.
+
+Responses made of JSON (especially GeoJSON) compress very well, which
+matters to clients on slow links. Each response is compressed with
+the best encoding listed in the request's ``Accept-Encoding`` header:
+brotli (``br``) if the ``brotli`` package is installed, else gzip.
+Responses smaller than ``cfg.COMPRESS_MIN_SIZE`` bytes, streamed
+responses (including ``/stream``), and files are sent as is.
+
+Each encoding is a different representation, so it gets its own
+``ETag``: the uncompressed tag with ``-gzip`` or ``-br`` added.
+``httpcache.isNotModified()`` accepts any of them.
+
+Many clients ask for the same data, so compressed bodies of responses
+with an ``ETag`` are kept in a cache of ``cfg.COMPRESS_CACHE_BYTES``
+bytes, keyed by a digest of the uncompressed body and the encoding.
+A body is compressed once, no matter how many clients are sent it.
+The tag isn't used as the key, since the same tag may be sent by
+different routes.
+"""
+
+import gzip
+import hashlib
+
+from flask import request
+
+import fisb_restConfig as cfg
+import bytecache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Mimetypes worth compressing.
+COMPRESSIBLE_MIMETYPES = ['application/json', 'application/x-ndjson', \
+    'text/html', 'text/css', 'text/plain', 'application/javascript']
+
+# Suffix added to the ETag of each encoding.
+ETAG_SUFFIXES = {'gzip': '-gzip', 'br': '-br'}
+
+# Compressed bodies, keyed by (body digest, encoding).
+_cache = bytecache.ByteLRU(cfg.COMPRESS_CACHE_BYTES)
+
+def encodings():
+    """Return the encodings that can be used, best first.
+
+    Returns:
+        list: Encoding names, as used in ``Accept-Encoding``.
+    """
+    if brotli is not None:
+        return ['br', 'gzip']
+
+    return ['gzip']
+
+def compress(data, encoding):
+    """Compress bytes.
+
+    Args:
+        data (bytes): Data to compress.
+        encoding (str): ``'gzip'`` or ``'br'``.
+
+    Returns:
+        bytes: Compressed data.
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=cfg.COMPRESS_LEVEL_BROTLI)
+
+    # 'mtime=0' so the same data always compresses to the same bytes.
+    return gzip.compress(data, compresslevel=cfg.COMPRESS_LEVEL_GZIP, mtime=0)
+
+def compressResponse(response):
+    """Compress a response if the client accepts it.
+
+    Registered with ``app.after_request()``. Must be called in a
+    request context.
+
+    Args:
+        response (obj): Flask response.
+
+    Returns:
+        obj: ``response``, possibly compressed.
+    """
+    if not cfg.COMPRESS_RESPONSES:
+        return response
+
+    if response.direct_passthrough or response.is_streamed or \
+            ('Content-Encoding' in response.headers):
+        return response
+
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    encoding = request.accept_encodings.best_match(encodings())
+    if encoding is None:
+        return response
+
+    etag, _ = response.get_etag()
+
+    # A 304 has no body, but its tag must be the one the client has.
+    if response.status_code == 304:
+        if (etag is not None) and \
+                request.if_none_match.contains(etag + ETAG_SUFFIXES[encoding]):
+            response.set_etag(etag + ETAG_SUFFIXES[encoding])
+        return response
+
+    if response.status_code != 200:
+        return response
+
+    data = response.get_data()
+    if len(data) < cfg.COMPRESS_MIN_SIZE:
+        return response
+
+    key = None
+    compressed = None
+    if etag is not None:
+        key = (hashlib.sha1(data).digest(), encoding)
+        compressed = _cache.get(key)
+
+    if compressed is None:
+        compressed = compress(data, encoding)
+        if key is not None:
+            _cache.put(key, compressed)
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    if etag is not None:
+        response.set_etag(etag + ETAG_SUFFIXES[encoding])
+
+    return response
@@ -0,0 +1,38 @@
+"""Write error information to ``cfg.ERROR_FILENAME``.
+
+Used by background threads, where an exception would otherwise
+disappear without a trace, and for problems found at startup.
+"""
+
+import datetime
+import traceback
+
+import fisb_restConfig as cfg
+
+def logError(where):
+    """Append the current exception to ``cfg.ERROR_FILENAME``.
+
+    Must be called from within an ``except`` block. Any error
+    writing the file is ignored.
+
+    Args:
+        where (str): Short description of where the error happened.
+    """
+    logMessage(where, traceback.format_exc())
+
+def logMessage(where, text):
+    """Append a message to ``cfg.ERROR_FILENAME``.
+
+    Any error writing the file is ignored.
+
+    Args:
+        where (str): Short description of where the problem happened.
+        text (str): Message.
+    """
+    try:
+        with open(cfg.ERROR_FILENAME, 'a') as f:
+            f.write('{} {} error:\n{}\n'.format( \
+                datetime.datetime.now(datetime.timezone.utc).isoformat(), \
+                where, text))
+    except Exception:
+        pass
@@ -0,0 +1,280 @@
+"""Server-Sent Events stream of new messages (``/stream``).
+
+Clients connect once and are sent each new or updated message as it
+arrives, in the same form as the other routes return it. A single
+reader per server process (``notifier``) feeds all connected clients,
+so many clients cost no more database work than one.
+
+Query string parameters select the messages sent:
+
+* ``type=``: Comma separated list of message types, as they appear
+  in the ``"type"`` field of results (``METAR``, ``NOTAM``,
+  ``CRL_NOTAM_TFR``, ...).
+* ``subtype=``: Comma separated list of subtypes (``TFR``, ``D``, ...).
+* ``location=``: Comma separated list of locations.
+* ``lat=``/``lon=`` and ``high=``/``low=``: Same as for other routes.
+* ``after=``: Start by sending all matching messages newer than this
+  value. The ``Last-Event-ID`` header (sent by browsers when they
+  reconnect) is used the same way.
+
+Each event has the message's ``after`` value as its ``id`` and the
+message as its ``data``.
+
+Each client holds a thread (or, with ``asgi.py``, a task) for as
+long as it is connected. gunicorn's sync workers answer one request
+at a time, so on them ``/stream`` is turned away with HTTP status 503.
+
+Each client has a buffer of ``cfg.SSE_QUEUE_SIZE`` messages. A client
+that falls that far behind is sent a ``dropped`` event and
+disconnected, so a slow client can't use up memory.
+"""
+
+import queue
+import threading
+
+from flask import jsonify
+from flask import Response
+from flask import stream_with_context
+
+import fisb_restConfig as cfg
+import utilities as util
+import metrics
+import notifier
+
+# Fields that can be selected with query string parameters.
+SELECT_FIELDS = ['type', 'subtype', 'location']
+
+# Map FIS-B Rest CRL names back to the names used in the database.
+CRL_REVERSE_MAP = dict([(v, k) for k, v in util.CRL_MAP.items()])
+
+# Headers sent with the stream.
+STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+# Comment sent when there is nothing else to send, so proxies
+# don't close the connection.
+KEEPALIVE_COMMENT = b': keepalive\n\n'
+
+# Event sent before disconnecting a client that fell behind.
+DROPPED_EVENT = b'event: dropped\ndata: {}\n\n'
+
+def getSelection(request):
+    """Parse the ``type=``, ``subtype=``, and ``location=`` parameters.
+
+    Args:
+        request (obj): Request object from Flask.
+
+    Returns:
+        dict: For each parameter present, the field name (as stored
+        in the database) and a list of allowed values. Subtypes that
+        are numbers are converted to integers.
+    """
+    selection = {}
+
+    for field in SELECT_FIELDS:
+        valueStr = request.args.get(field)
+        if valueStr == None:
+            continue
+
+        values = []
+        for v in valueStr.split(','):
+            v = v.strip().upper()
+            if v == '':
+                continue
+
+            if field == 'type':
+                v = v.replace('-', '_')
+                v = CRL_REVERSE_MAP.get(v, v)
+            elif (field == 'subtype') and v.isdigit():
+                v = int(v)
+
+            values.append(v)
+
+        selection[field] = values
+
+    return selection
+
+def isSelected(msg, selection):
+    """Check if a message has one of the selected values for each field.
+
+    Args:
+        msg (dict): Message from the database.
+        selection (dict): Result of ``getSelection()``.
+
+    Returns:
+        bool: ``True`` if the message is selected.
+    """
+    for field, values in selection.items():
+        if msg.get(field) not in values:
+            return False
+
+    return True
+
+def returnStream(request):
+    """Return a Server-Sent Events stream of new messages.
+
+    Args:
+        request (obj): Request object from Flask.
+
+    Returns:
+        obj: Streaming response of type ``text/event-stream``, or a
+        JSON error object if the query string was bad. On a sync
+        worker (see ``util.isSyncWorker()``), which the stream would
+        hold for good, a JSON error object with HTTP status 503.
+    """
+    if util.isDescribing():
+        return util.ROUTE_STREAM, {}
+
+    if util.isSyncWorker(request):
+        response = jsonify({'status': -1, \
+            'error': '/stream needs threaded workers or asgi.py.'})
+        response.status_code = 503
+        return response
+
+    hasError, errorString, limit, backlogQuery, tests, filters = \
+        parseStreamRequest(request)
+
+    if hasError:
+        return jsonify({'status': -1, 'error': errorString})
+
+    msgQueue = queue.Queue(maxsize=cfg.SSE_QUEUE_SIZE)
+    dropped = threading.Event()
+
+    def receive(msg):
+        if dropped.is_set() or not all(t(msg) for t in tests):
+            return
+
+        try:
+            msgQueue.put_nowait(msg)
+        except queue.Full:
+            dropped.set()
+            notifier.unsubscribe(receive)
+
+    notifier.start(util.dbConn)
+    notifier.subscribe(receive)
+
+    backlog = []
+    if backlogQuery != None:
+        backlog = util.findMsgs(backlogQuery, limit, filters, False)
+
+    return Response(stream_with_context( \
+        streamEvents(backlog, msgQueue, dropped, receive)), \
+        mimetype='text/event-stream', headers=STREAM_HEADERS)
+
+def parseStreamRequest(request):
+    """Parse the query string and headers of a ``/stream`` request.
+
+    Args:
+        request (obj): Request object from Flask.
+
+    Returns:
+        tuple: Tuple containing:
+
+        1. (bool) ``True`` if there was an error.
+        2. (str) Error string if there was an error.
+        3. (int) Maximum number of backlog messages.
+        4. (dict) Query for the backlog (for ``util.findMsgs()``), or
+           ``None`` if there is no backlog to send.
+        5. (list) Functions taking a new message and returning
+           ``True`` if it should be sent.
+        6. (list) Filters for ``util.findMsgs()`` for the backlog.
+    """
+    hasError, errorString, afterDt, limit, \
+        hasLatLong, lat, lon, \
+        hasHighLow, high, low = util.getStandardQueryItems(request)
+
+    lastEventId = request.headers.get('Last-Event-ID')
+    if lastEventId != None:
+        try:
+            afterDt = util.isoStringToDt(lastEventId)
+        except Exception as _:
+            hasError = True
+            errorString = (errorString + ' Bad Last-Event-ID header.').strip()
+
+    if hasError:
+        return hasError, errorString, limit, None, [], []
+
+    selection = getSelection(request)
+
+    tests = [lambda msg: isSelected(msg, selection)]
+    if hasLatLong:
+        tests.append(lambda msg: util.checkIfInPolygon(msg, lat, lon))
+    if hasHighLow:
+        tests.append(lambda msg: util.checkIfInAltBounds(msg, high, low))
+
+    backlogQuery = None
+    filters = []
+    if (request.args.get('after') != None) or (lastEventId != None):
+        backlogQuery = {'insert_time': {'$gt': afterDt}}
+        for field, values in selection.items():
+            backlogQuery[field] = {'$in': values}
+
+        if hasLatLong:
+            filters.append(util.pointFilter(lat, lon))
+        if hasHighLow:
+            filters.append(util.altFilter(high, low))
+
+    return hasError, errorString, limit, backlogQuery, tests, filters
+
+def formatEvent(msg):
+    """Format a message as a Server-Sent Event.
+
+    Args:
+        msg (dict): Message from the database. It is not altered.
+
+    Returns:
+        bytes: Event.
+    """
+    fragment, afterStr = util.msgFragment(msg, True)
+    metrics.add('documents_returned', 1)
+
+    return b''.join([b'id: ', afterStr.encode('utf-8'), \
+        b'\nevent: message\ndata: ', fragment, b'\n\n'])
+
+def retryField():
+    """Return the field telling the client how long to wait before
+    reconnecting.
+
+    Returns:
+        bytes: ``retry:`` field.
+    """
+    return 'retry: {}\n\n'.format(int(cfg.SSE_RETRY * 1000)).encode('utf-8')
+
+def streamEvents(backlog, msgQueue, dropped, receive):
+    """Generate the event stream for one client.
+
+    Args:
+        backlog (obj): Iterable of messages to send first.
+        msgQueue (obj): Queue of new messages for this client.
+        dropped (obj): ``threading.Event`` set if the client fell
+            too far behind.
+        receive (function): Function registered with
+            ``notifier.subscribe()`` for this client.
+
+    Yields:
+        bytes: Pieces of the stream.
+    """
+    try:
+        yield retryField()
+
+        # Messages in both the backlog and the queue are only sent once.
+        sent = set()
+        for msg in backlog:
+            sent.add((msg['_id'], msg['insert_time']))
+            yield formatEvent(msg)
+
+        while not dropped.is_set():
+            try:
+                msg = msgQueue.get(timeout=cfg.SSE_KEEPALIVE)
+            except queue.Empty:
+                yield KEEPALIVE_COMMENT
+                continue
+
+            if (msg['_id'], msg['insert_time']) in sent:
+                continue
+
+            yield formatEvent(msg)
+
+        yield DROPPED_EVENT
+
+    finally:
+        notifier.unsubscribe(receive)
@@ -6,3 +6,262 @@ ERROR_FILENAME = 'FISB_REST.ERR'
 
 #: MONGO URI
 MONGO_URI = 'mongodb://localhost:27017/'
+
+#: Keep an in-memory snapshot of the ``MSG`` collection and answer
+#: queries from it instead of from Mongo. If Mongo is a replica set,
+#: the snapshot is kept current with a change stream. Otherwise,
+#: Mongo is polled.
+SNAPSHOT_ENABLED = False
+
+#: Seconds between polls of Mongo (or waits on the change stream)
+#: when the snapshot is enabled.
+SNAPSHOT_POLL_INTERVAL = 1.0
+
+#: If the snapshot hasn't been confirmed in sync with Mongo for this
+#: many seconds, queries go to Mongo instead.
+SNAPSHOT_MAX_AGE = 10.0
+
+#: Keep one copy of the in-memory snapshot in shared memory for all
+#: worker processes, instead of one in each (see ``sharedsnapshot.py``).
+#: Only used if ``SNAPSHOT_ENABLED`` is ``True``. With gunicorn, the
+#: process keeping it current is started by ``gunicorn.conf.py``.
+#: Otherwise, run ``python3 sharedsnapshot.py`` next to the server.
+SHARED_SNAPSHOT = False
+
+#: Directory for the shared snapshot. Should be on a memory file
+#: system, so it is never written to disk.
+SHARED_SNAPSHOT_DIR = '/dev/shm/fisb-rest'
+
+#: Seconds between checks for changes by the process keeping the
+#: shared snapshot.
+SHARED_SNAPSHOT_INTERVAL = 0.25
+
+#: Prepared polygons of messages not seen by any query (or by the
+#: snapshot) for this many seconds are dropped from the spatial index.
+SPATIAL_INDEX_MAX_IDLE = 3600
+
+#: Messages tested at a time by the ``lat=``/``lon=`` and
+#: ``high=``/``low=`` tests done in Python. The polygons of a batch
+#: are tested with one vectorized shapely call. Mongo returns 101
+#: messages in its first cursor batch, so this doesn't wait on
+#: extra reads.
+FILTER_BATCH_SIZE = 100
+
+#: Do ``lat=``/``lon=`` tests in Mongo using a 2dsphere index on the
+#: ``MSG_GEO`` collection (created and kept up to date by FIS-B Rest)
+#: instead of in Python.
+MONGO_GEO_FILTER = False
+
+#: Seconds between removals of ``MSG_GEO`` entries for messages that
+#: no longer exist, when Mongo isn't a replica set.
+GEO_PRUNE_INTERVAL = 60
+
+#: Seconds between polls of ``MSG`` for new polygons, when Mongo isn't
+#: a replica set (otherwise, a change stream is used).
+GEO_POLL_INTERVAL = 1.0
+
+#: Messages up to this many seconds older than the newest one copied
+#: to ``MSG_GEO`` are read again by each poll, and always pass the
+#: point test, in case they were saved out of order.
+GEO_SYNC_LAG = 30
+
+#: Stream responses for queries that can return many results, instead
+#: of building the whole response in memory first. Responses for
+#: clients sending ``Accept: application/x-ndjson`` are always streamed.
+STREAM_RESPONSES = False
+
+#: Approximate size (in bytes) of each piece of a streamed
+#: response.
+STREAM_CHUNK_SIZE = 65536
+
+#: If ``True``, identical requests in flight at the same time (same
+#: route and query) share one response, built once. Helps with the
+#: bursts of requests after new messages arrive.
+COALESCE_REQUESTS = True
+
+#: Maximum size in bytes of the cache of messages already converted
+#: to JSON. Set to 0 to turn the cache off.
+FRAGMENT_CACHE_BYTES = 0
+
+#: ``Cache-Control`` ``max-age`` (seconds) for each product type. Types
+#: not listed use ``'DEFAULT'``. ``'STATIC'`` is used for static items.
+#: A value of 0 sends ``no-cache``, which makes caches check back (using
+#: the ``ETag``) every time.
+CACHE_MAX_AGE = {
+    'DEFAULT': 0,
+    'WINDS_06_HR': 60,
+    'WINDS_12_HR': 60,
+    'WINDS_24_HR': 60,
+    'STATIC': 3600,
+    }
+
+#: Longest time (seconds) a request with ``wait=`` will be held. Only
+#: used by threaded workers and ``asgi.py``. With gunicorn's sync
+#: workers, ``wait=`` is always treated as 0.
+LONG_POLL_MAX_WAIT = 25
+
+#: Seconds between checks for new messages when waiting requests (or
+#: ``/stream`` clients) exist, and Mongo isn't a replica set and the
+#: snapshot is off.
+NOTIFY_POLL_INTERVAL = 0.5
+
+#: Number of messages buffered for each ``/stream`` client. A client
+#: that falls further behind than this is disconnected.
+SSE_QUEUE_SIZE = 100
+
+#: Seconds between keepalive comments sent to idle ``/stream`` clients.
+SSE_KEEPALIVE = 15
+
+#: Seconds ``/stream`` clients are told to wait before reconnecting.
+SSE_RETRY = 3
+
+#: Threads used by the ASGI entry point (``asgi.py``) for polygon tests,
+#: building responses, and routes it passes to Flask.
+ASGI_THREADS = 16
+
+#: If ``True``, ``python3 indexes.py`` creates the indexes on ``MSG``
+#: needed by the routes if they are missing, as if ``--create`` were
+#: given. The database belongs to 'fisb-decode', so this is off.
+CREATE_INDEXES = False
+
+#: Maximum number of connections to Mongo per server process.
+MONGO_MAX_POOL_SIZE = 50
+
+#: Seconds to wait to find a Mongo server before failing.
+MONGO_SERVER_SELECTION_TIMEOUT = 5.0
+
+#: Seconds to wait for Mongo to answer on a connection before failing.
+MONGO_SOCKET_TIMEOUT = 30.0
+
+#: Seconds a query made by a request may run (Mongo ``maxTimeMS``)
+#: before it is stopped and an error returned. ``0`` for no limit.
+MONGO_QUERY_TIMEOUT = 10.0
+
+#: Mongo failures in a row (errors, or queries slower than
+#: ``MONGO_BREAKER_SLOW``) after which requests stop querying Mongo
+#: until it answers again (see ``breaker.py``). ``0`` turns this off.
+MONGO_BREAKER_FAILURES = 3
+
+#: Seconds a query may take to return its first results before it
+#: counts as a failure for the circuit breaker.
+MONGO_BREAKER_SLOW = 2.0
+
+#: Seconds between pings of Mongo while the circuit breaker is open.
+MONGO_BREAKER_RETRY = 2.0
+
+#: Bytes of memory used to keep the last good response of each query,
+#: sent (marked as stale) if Mongo can't answer. ``0`` turns this off.
+LAST_GOOD_BYTES = 32000000
+
+#: If ``True``, requests are turned away (HTTP status 503 with a
+#: ``Retry-After`` header) when a process is too busy, rather than
+#: waiting in line. See ``admission.py``. Off by default, so requests
+#: are never refused; set the limits below for your load before
+#: turning it on.
+ADMISSION_CONTROL = False
+
+#: Estimated cost of a request to each route. Routes not listed use
+#: ``'ONE'`` if they return one object (such as ``/metar/<id>``), and
+#: ``'DEFAULT'`` otherwise. A cost of 0 is never turned away.
+#: ``/stream`` clients count for as long as they are connected.
+ADMISSION_COSTS = {
+    'ONE': 1,
+    'DEFAULT': 10,
+    '/all': 100,
+    '/image': 100,
+    '/batch': 20,
+    '/stream': 4,
+    '/metrics': 0,
+    }
+
+#: Highest total cost of the requests running at once in a process.
+ADMISSION_MAX_COST = 200
+
+#: Requests costing at most this much are cheap, and may use all of
+#: ``ADMISSION_MAX_COST``.
+ADMISSION_CHEAP_COST = 1
+
+#: Fraction of ``ADMISSION_MAX_COST`` that requests that aren't cheap
+#: may use, leaving the rest for cheap ones.
+ADMISSION_BULK_SHARE = 0.5
+
+#: Most requests waiting for room in a process. Cheap requests go
+#: first.
+ADMISSION_QUEUE_SIZE = 50
+
+#: Longest time (seconds) a request waits for room before it is
+#: turned away.
+ADMISSION_QUEUE_TIMEOUT = 0.5
+
+#: ``Retry-After`` value (seconds) sent with requests turned away.
+ADMISSION_RETRY_AFTER = 1
+
+#: If ``True``, requests with ``profile=1`` in the query string (or an
+#: ``X-Profile: 1`` header) are profiled, and the profile written to
+#: the ``profiles`` directory next to ``ERROR_FILENAME``. See
+#: ``profiler.py``. Anyone who can reach the server can ask for a
+#: profile, so only turn this on while looking into a problem.
+PROFILE_ENABLED = False
+
+#: If ``PROFILE_ENABLED`` is ``True`` and this is more than 0, one
+#: request in this many is also profiled.
+PROFILE_SAMPLE = 0
+
+#: Number of profiles kept. Older ones are removed.
+PROFILE_KEEP = 100
+
+#: Queries to ``MSG`` made by requests that take longer than this
+#: many seconds are written, with their query plans, to
+#: ``SLOW_QUERY_FILENAME`` (see ``slowquery.py``). ``0`` turns this off.
+SLOW_QUERY_SECONDS = 1.0
+
+#: Where to write slow queries.
+SLOW_QUERY_FILENAME = 'FISB_REST_SLOW.LOG'
+
+#: Each process writes at most one slow query every this many seconds.
+SLOW_QUERY_LOG_INTERVAL = 10.0
+
+#: If ``True``, ``/debug/explain?route=<path>`` returns the query plan of
+#: a route. Only answered for requests from the server itself, but a
+#: proxy on the same machine that doesn't set ``X-Forwarded-For`` (such
+#: as a plain nginx ``proxy_pass``) makes every request look local.
+#: Plans are made with ``explain('executionStats')``, which runs the
+#: query, so only turn this on while looking into a problem.
+DEBUG_EXPLAIN = False
+
+#: Maximum number of ids in a single object request (such as
+#: ``/metar/KDEN,KCOS``), and of queries in a ``/batch`` request.
+BATCH_MAX_QUERIES = 100
+
+#: If ``True``, responses are compressed (gzip, or brotli if the
+#: ``brotli`` package is installed) when the client accepts it.
+COMPRESS_RESPONSES = True
+
+#: Responses smaller than this many bytes are not compressed.
+COMPRESS_MIN_SIZE = 1024
+
+#: gzip compression level (1-9).
+COMPRESS_LEVEL_GZIP = 6
+
+#: brotli compression quality (0-11).
+COMPRESS_LEVEL_BROTLI = 5
+
+#: Bytes of memory used to keep compressed responses, so the same
+#: response is only compressed once. ``0`` turns this off.
+COMPRESS_CACHE_BYTES = 32000000
+
+#: If ``True``, requests are measured and the numbers served at
+#: ``/metrics`` in Prometheus text format. If ``False``, ``/metrics``
+#: returns 404.
+METRICS_ENABLED = False
+
+#: Directory where each server process writes its metrics, so
+#: ``/metrics`` can add up all gunicorn workers. Must be an absolute
+#: path shared by all workers, and only used by one server.
+METRICS_DIR = '/tmp/fisb-rest-metrics'
+
+#: Seconds between writes of each process's metrics to ``METRICS_DIR``.
+METRICS_FLUSH_INTERVAL = 5.0
+
+#: Upper bounds (seconds) of the buckets of the request time histogram.
+METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
@@ -0,0 +1,53 @@
+"""Cache of messages already transformed and encoded as JSON.
+
+Most messages are sent many times before they change. A METAR
+may be requested thousands of times before it is replaced. Rather
+than running ``utilities.changeStandardFields()`` and encoding the
+result each time, the encoded bytes are kept here.
+
+Entries are keyed by the message's ``_id``, ``digest``, and
+``insert_time``. 'fisb-decode' sets a new ``insert_time`` whenever
+it rewrites a message, so a changed message never matches an old
+entry. The cache holds at most ``cfg.FRAGMENT_CACHE_BYTES`` bytes.
+The least recently used entries are dropped first.
+"""
+
+import fisb_restConfig as cfg
+import bytecache
+
+_cache = bytecache.ByteLRU(cfg.FRAGMENT_CACHE_BYTES)
+
+def isEnabled():
+    """Check if the cache is turned on.
+
+    Returns:
+        bool: ``True`` if ``cfg.FRAGMENT_CACHE_BYTES`` is more than 0.
+    """
+    return cfg.FRAGMENT_CACHE_BYTES > 0
+
+def get(key):
+    """Return the cached bytes for a key.
+
+    Args:
+        key (tuple): ``(_id, digest, insert_time)`` of the message, as
+            built by ``utilities.msgFragment()``.
+
+    Returns:
+        bytes: Encoded message, or ``None`` if not cached.
+    """
+    return _cache.get(key)
+
+def put(key, fragment):
+    """Add an encoded message to the cache.
+
+    Args:
+        key (tuple): ``(_id, digest, insert_time)`` of the message, as
+            built by ``utilities.msgFragment()``.
+        fragment (bytes): Encoded message.
+    """
+    _cache.put(key, fragment)
+
+def clear():
+    """Remove everything from the cache.
+    """
+    _cache.clear()
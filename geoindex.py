@@ -0,0 +1,389 @@
+"""Answer ``lat=``/``lon=`` queries in Mongo using a 2dsphere index.
+
+Normally, every message matching a query is sent from Mongo and the
+ones whose polygons don't contain the point are thrown away in Python.
+When ``cfg.MONGO_GEO_FILTER`` is ``True``, the point test is done by
+Mongo instead, so only the messages that will be returned are sent.
+
+The polygons stored by 'fisb-decode' can't be indexed directly: their
+``coordinates`` are a single list of points, not a list of rings, and
+the rings are not closed. So polygons are copied into a separate
+collection, ``MSG_GEO``, as valid GeoJSON with a 2dsphere index. Each
+polygon feature of a message becomes one document::
+
+  {
+    "_id": "<message _id>/<feature number>",
+    "msg_id": <message _id>,
+    "version": <message digest (or insert_time)>,
+    "geometry": {"type": "Polygon", "coordinates": [[...]]}
+  }
+
+Polygons Mongo refuses to index (for instance, self-intersecting ones)
+are stored without ``geometry`` and with ``"unindexed": true``.
+These always match, in keeping with the FIS-B Rest principle of
+erring on the side of returning data.
+
+``MSG_GEO`` is kept up to date by a background thread in each
+process, so requests never wait on it. The thread first copies every
+polygon (skipping ones already stored with the same version, so
+several processes can share ``MSG_GEO``), then follows a change
+stream on ``MSG``, resuming after the last change it handled if it
+has to reconnect. If Mongo isn't a replica set, it polls ``MSG``
+every ``cfg.GEO_POLL_INTERVAL`` seconds instead, reading messages up
+to ``cfg.GEO_SYNC_LAG`` seconds older than the newest one seen, so
+messages saved a little out of order are still copied. Entries for
+messages that no longer exist are then removed every
+``cfg.GEO_PRUNE_INTERVAL`` seconds.
+
+Until the first copy is done, point tests are done in Python. After
+that, messages up to ``cfg.GEO_SYNC_LAG`` seconds older than the
+newest one copied may not be in ``MSG_GEO`` yet, so they always match
+(erring on the side of returning data, as for unindexed polygons).
+
+Note that Mongo treats polygon edges as great circle segments, while
+shapely (used when this is off) treats them as straight lines in
+latitude and longitude. For points very close to long polygon edges,
+the two may disagree.
+"""
+
+import datetime
+import os
+import threading
+import time
+
+from pymongo import errors
+
+import fisb_restConfig as cfg
+import errlog
+import snapshot
+
+# Seconds to wait before trying again after an error.
+RETRY_INTERVAL = 5.0
+
+# Error code of a change stream whose resume token is too old.
+CHANGE_STREAM_HISTORY_LOST = 286
+
+# Version of each message currently in MSG_GEO, keyed by message
+# '_id'. Only used by the sync thread.
+_synced = {}
+
+# Newest 'insert_time' of any message copied to MSG_GEO, or 'None'.
+_highWater = None
+
+# 'True' once every message has been copied to MSG_GEO.
+_ready = False
+
+# Resume token of the last change handled.
+_resumeToken = None
+
+_lastPrune = 0.0
+
+# Process id of the process the sync thread was started in.
+_startPid = None
+_startLock = threading.Lock()
+
+def _version(msg):
+    """Return the value used to tell if a message has changed.
+
+    Args:
+        msg (dict): Message.
+
+    Returns:
+        obj: ``digest`` field if present, else ``insert_time``.
+    """
+    if 'digest' in msg:
+        return msg['digest']
+
+    return msg.get('insert_time')
+
+def createIndexes(db):
+    """Create the indexes ``MSG_GEO`` needs. Safe to call repeatedly.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+    """
+    db.MSG_GEO.create_index([('geometry', '2dsphere')])
+    db.MSG_GEO.create_index('msg_id')
+
+def toGeoJsonPolygon(coords):
+    """Convert 'fisb-decode' polygon coordinates to a GeoJSON polygon.
+
+    Args:
+        coords (list): List of ``[lon, lat]`` points.
+
+    Returns:
+        dict: GeoJSON ``Polygon`` with a single closed ring, or ``None``
+        if there are not enough points to make a polygon.
+    """
+    ring = [[xy[0], xy[1]] for xy in coords]
+
+    if (len(ring) > 0) and (ring[0] != ring[-1]):
+        ring.append(ring[0])
+
+    if len(ring) < 4:
+        return None
+
+    return {'type': 'Polygon', 'coordinates': [ring]}
+
+def _storeMsg(db, msg):
+    """Replace the ``MSG_GEO`` documents for a single message.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+        msg (dict): Message with at least ``_id``, ``insert_time``,
+            ``digest`` (if any) and ``geojson.features.geometry``.
+    """
+    msgId = msg['_id']
+    version = _version(msg)
+
+    db.MSG_GEO.delete_many({'msg_id': msgId})
+
+    features = msg.get('geojson', {}).get('features', [])
+    for n in range(0, len(features)):
+        geometry = features[n]['geometry']
+        if geometry['type'] != 'Polygon':
+            continue
+
+        doc = {'_id': '{}/{}'.format(msgId, n), 'msg_id': msgId, \
+            'version': version}
+        polygon = toGeoJsonPolygon(geometry['coordinates'])
+
+        if polygon is not None:
+            doc['geometry'] = polygon
+        else:
+            doc['unindexed'] = True
+
+        try:
+            db.MSG_GEO.replace_one({'_id': doc['_id']}, doc, upsert=True)
+
+        except errors.DuplicateKeyError:
+            # Another process stored it at the same time.
+            pass
+
+        except errors.WriteError:
+            # Mongo won't index this polygon.
+            doc.pop('geometry', None)
+            doc['unindexed'] = True
+            db.MSG_GEO.replace_one({'_id': doc['_id']}, doc, upsert=True)
+
+    _synced[msgId] = version
+
+def start(db):
+    """Start the thread keeping ``MSG_GEO`` up to date, if not running.
+
+    Safe to call more than once, and after a fork.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+    """
+    global _startPid
+
+    if _startPid == os.getpid():
+        return
+
+    with _startLock:
+        if _startPid == os.getpid():
+            return
+        _startPid = os.getpid()
+
+    threading.Thread(target=_run, args=(db,), name='geoindex', \
+        daemon=True).start()
+
+def _run(db):
+    """Body of the sync thread.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+    """
+    global _ready, _resumeToken
+
+    useChangeStream = True
+
+    while True:
+        try:
+            createIndexes(db)
+
+            if useChangeStream:
+                _followChangeStream(db)
+            else:
+                _followByPolling(db)
+
+        except errors.OperationFailure as e:
+            if e.code == snapshot.CHANGE_STREAM_NOT_SUPPORTED:
+                useChangeStream = False
+                continue
+
+            # Start over with a full copy.
+            if e.code == CHANGE_STREAM_HISTORY_LOST:
+                _resumeToken = None
+                _ready = False
+                continue
+
+            errlog.logError('geoindex')
+            time.sleep(RETRY_INTERVAL)
+
+        except Exception:
+            errlog.logError('geoindex')
+            time.sleep(RETRY_INTERVAL)
+
+def _copy(db, query):
+    """Copy the messages with polygons matching a query to ``MSG_GEO``.
+
+    Messages already stored with the same version are skipped.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+        query (dict): Query selecting the messages to look at.
+    """
+    global _highWater
+
+    query = dict(query)
+    query['geojson.features.geometry.type'] = 'Polygon'
+
+    projection = {'insert_time': 1, 'digest': 1, \
+        'geojson.features.geometry': 1}
+
+    for msg in db.MSG.find(query, projection):
+        if _synced.get(msg['_id']) != _version(msg):
+            _storeMsg(db, msg)
+
+        if (_highWater is None) or (msg['insert_time'] > _highWater):
+            _highWater = msg['insert_time']
+
+def _copyAll(db):
+    """Copy every message with polygons to ``MSG_GEO``, and remove
+    entries for messages that no longer exist.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+    """
+    global _ready
+
+    _synced.clear()
+    for x in db.MSG_GEO.find({}, {'msg_id': 1, 'version': 1}):
+        _synced[x['msg_id']] = x['version']
+
+    _copy(db, {})
+    _prune(db)
+    _ready = True
+
+def _prune(db):
+    """Remove ``MSG_GEO`` entries for messages that no longer exist.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+    """
+    global _lastPrune
+
+    _lastPrune = time.monotonic()
+
+    liveIds = set(x['_id'] for x in db.MSG.find({}, {'_id': 1}))
+    deadIds = [k for k in _synced.keys() if k not in liveIds]
+    if len(deadIds) > 0:
+        db.MSG_GEO.delete_many({'msg_id': {'$in': deadIds}})
+        for k in deadIds:
+            del _synced[k]
+
+def _followChangeStream(db):
+    """Copy messages to ``MSG_GEO`` as a change stream reports them.
+
+    The stream is opened before the first copy, so no change made
+    during the copy is missed.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+    """
+    global _resumeToken, _highWater
+
+    pipeline = [{'$match': {'operationType': \
+        {'$in': ['insert', 'update', 'replace', 'delete']}}}]
+
+    with db.MSG.watch(pipeline, full_document='updateLookup', \
+            resume_after=_resumeToken) as stream:
+        if not _ready:
+            _copyAll(db)
+
+        while stream.alive:
+            change = stream.try_next()
+
+            if change is not None:
+                msgId = change['documentKey']['_id']
+                msg = change.get('fullDocument')
+
+                if msg is None:
+                    db.MSG_GEO.delete_many({'msg_id': msgId})
+                    _synced.pop(msgId, None)
+
+                else:
+                    if _synced.get(msgId) != _version(msg):
+                        _storeMsg(db, msg)
+
+                    insertTime = msg.get('insert_time')
+                    if (insertTime is not None) and \
+                            ((_highWater is None) or (insertTime > _highWater)):
+                        _highWater = insertTime
+
+            _resumeToken = stream.resume_token
+
+def _followByPolling(db):
+    """Poll ``MSG`` for new and changed messages.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+    """
+    if not _ready:
+        _copyAll(db)
+
+    while True:
+        time.sleep(cfg.GEO_POLL_INTERVAL)
+
+        query = {}
+        if _highWater is not None:
+            query['insert_time'] = {'$gte': _highWater - \
+                datetime.timedelta(seconds=cfg.GEO_SYNC_LAG)}
+
+        _copy(db, query)
+
+        if (time.monotonic() - _lastPrune) > cfg.GEO_PRUNE_INTERVAL:
+            _prune(db)
+
+def pointQuery(db, lat, lon):
+    """Build a Mongo query selecting messages that pass a point test.
+
+    The query matches messages without any polygon, and messages
+    with at least one polygon containing the point. This has the
+    same meaning as ``utilities.checkIfInPolygon()``, except that
+    messages that may not be in ``MSG_GEO`` yet always match.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+        lat (float): Latitude.
+        lon (float): Longitude.
+
+    Returns:
+        dict: Query to be combined with the route's query using
+        ``$and``, or ``None`` if ``MSG_GEO`` could not be used (in
+        which case the point test must be done in Python).
+    """
+    start(db)
+
+    # Read once, since the sync thread changes it.
+    highWater = _highWater
+    if (not _ready) or (highWater is None):
+        return None
+
+    try:
+        point = {'type': 'Point', 'coordinates': [lon, lat]}
+        msgIds = db.MSG_GEO.distinct('msg_id', {'$or': [ \
+            {'geometry': {'$geoIntersects': {'$geometry': point}}}, \
+            {'unindexed': True}]})
+
+    except errors.PyMongoError:
+        errlog.logError('geoindex')
+        return None
+
+    return {'$or': [ \
+        {'geojson.features.geometry.type': {'$ne': 'Polygon'}}, \
+        {'_id': {'$in': msgIds}}, \
+        {'insert_time': {'$gt': highWater - \
+            datetime.timedelta(seconds=cfg.GEO_SYNC_LAG)}}]}
@@ -9,5 +9,42 @@ bind = "0.0.0.0:7214"
 # Number of instances to run.
 workers = 2
 
+# Requests held by 'wait=' (long polling) and '/stream' each tie up a
+# thread, so use threaded workers, with the number of threads being
+# how many requests each worker can handle at once. With sync workers
+# ("sync"), 'wait=' is ignored and '/stream' is turned away.
+worker_class = "gthread"
+threads = 50
+
+# Most connections waiting to be accepted. Beyond this, new connections
+# are refused at once instead of waiting behind everyone else (the
+# gunicorn default is 2048). See also ADMISSION_CONTROL in
+# fisb_restConfig.py.
+backlog = 256
+
 # Name of app
 wsgi_app = "app:app"
+
+# Load the app once, before starting workers. Workers start faster,
+# and share the memory used by the loaded code
+# until they change it. The database connection can't be shared, so
+# the hooks below close it before forking and each worker makes its own.
+preload_app = True
+
+# If SHARED_SNAPSHOT is True, start the process that keeps the snapshot
+# shared by the workers.
+def when_ready(server):
+    import sharedsnapshot
+    sharedsnapshot.startLoader()
+
+def pre_fork(server, worker):
+    import utilities
+    utilities.beforeFork()
+
+def post_fork(server, worker):
+    import utilities
+    utilities.afterFork()
+
+def worker_exit(server, worker):
+    import utilities
+    utilities.closeDbConn()
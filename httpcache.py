@@ -0,0 +1,175 @@
+"""HTTP caching support: ``ETag``, ``If-None-Match``, and ``Cache-Control``.
+
+Clients poll the same routes over and over, and most of the time
+nothing has changed. Every data response carries a strong ``ETag``
+computed from the messages it contains: their number, the newest
+``insert_time``, and the ``_id``, ``digest``, and ``insert_time`` of
+each. The shape of the response (one message, a list of ids, or many
+messages, as JSON or NDJSON) and the request parameters that show up
+in the body (the ids asked for, ``after=``, and ``next=``) are mixed
+in too, so a tag identifies exactly one body. This is cheap to compute
+without transforming or encoding anything, so a request with a
+matching ``If-None-Match`` header gets a ``304 Not Modified`` response
+for the cost of a database query.
+
+The tag sent with a body is always computed from the messages in that
+body. Streamed responses send their headers before the messages are
+read, so they have no ``ETag`` (but a request for one is still
+answered with ``304 Not Modified`` if nothing has changed).
+
+``Cache-Control`` ``max-age`` values are set per product type in
+``cfg.CACHE_MAX_AGE``, so a reverse proxy in front of gunicorn can
+answer most polling itself.
+"""
+
+import hashlib
+
+import bson
+from flask import Response
+
+import fisb_restConfig as cfg
+import compression
+
+class EtagBuilder(object):
+    """Compute an ``ETag`` from the messages in a response.
+
+    Call ``add()`` with each message (before it is altered by
+    ``utilities.changeStandardFields()``), then ``etag()``.
+
+    Args:
+        variant (str): Name of the representation (for example
+            ``'one'`` or ``'many-ndjson'``). Different representations
+            of the same messages get different tags.
+        params (tuple): Request parameters that change the body
+            for the same messages, such as the ids asked for or the
+            value of ``after=``. Must have a stable ``repr()``.
+    """
+    def __init__(self, variant, params=()):
+        self.hash = hashlib.sha1(variant.encode('utf-8'))
+        self.hash.update(repr(params).encode('utf-8'))
+        self.count = 0
+        self.newest = None
+
+    def add(self, msg):
+        """Add a message to the tag.
+
+        Args:
+            msg (dict): Message from the database.
+        """
+        insertTime = msg.get('insert_time')
+
+        self.hash.update(repr((msg['_id'], msg.get('digest'), \
+            insertTime)).encode('utf-8'))
+        self.count += 1
+
+        if (insertTime is not None) and \
+                ((self.newest is None) or (insertTime > self.newest)):
+            self.newest = insertTime
+
+    def etag(self):
+        """Return the tag.
+
+        Returns:
+            str: Tag, without quotes.
+        """
+        newest = 0
+        if self.newest is not None:
+            newest = int(self.newest.timestamp() * 1000000)
+
+        return '{}-{}-{}'.format(self.count, newest, \
+            self.hash.hexdigest()[:20])
+
+def staticEtag(msg, variant):
+    """Compute an ``ETag`` for a ``STATIC_ITEMS`` document.
+
+    Static documents have no ``insert_time``, so their BSON encoding
+    is hashed.
+
+    Args:
+        msg (dict): Document, or ``None``.
+        variant (str): Name of the representation.
+
+    Returns:
+        str: Tag, without quotes.
+    """
+    h = hashlib.sha1(variant.encode('utf-8'))
+
+    if msg is not None:
+        h.update(bson.encode(msg))
+
+    return 'S-' + h.hexdigest()[:20]
+
+def maxAge(findArg1):
+    """Return the ``max-age`` to use for a query.
+
+    The product type is taken from the ``type`` field of the query.
+    If a query can match several types, the smallest value is used.
+
+    Args:
+        findArg1 (dict): Query used for the response.
+
+    Returns:
+        int: ``max-age`` in seconds.
+    """
+    msgType = findArg1.get('type')
+
+    if isinstance(msgType, str):
+        types = [msgType]
+    elif isinstance(msgType, dict) and ('$in' in msgType):
+        types = msgType['$in']
+    else:
+        types = ['DEFAULT']
+
+    return min([cfg.CACHE_MAX_AGE.get(t, cfg.CACHE_MAX_AGE['DEFAULT']) \
+        for t in types])
+
+def setHeaders(response, etag, age):
+    """Add ``ETag`` and ``Cache-Control`` headers to a response.
+
+    Args:
+        response (obj): Flask response.
+        etag (str): Tag from ``EtagBuilder.etag()`` or ``staticEtag()``,
+            or ``None`` for no ``ETag``.
+        age (int): ``max-age`` in seconds.
+
+    Returns:
+        obj: ``response``.
+    """
+    if etag is not None:
+        response.set_etag(etag)
+
+    if age > 0:
+        response.headers['Cache-Control'] = 'public, max-age={}'.format(age)
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+
+    return response
+
+def isNotModified(request, etag):
+    """Check if the client already has the current representation.
+
+    Args:
+        request (obj): Request object from Flask.
+        etag (str): Current tag.
+
+    Returns:
+        bool: ``True`` if the ``If-None-Match`` header matches ``etag``,
+        or the tag of a compressed version of it (see ``compression``).
+    """
+    if request.if_none_match.contains_weak(etag):
+        return True
+
+    return any(request.if_none_match.contains_weak(etag + suffix) \
+        for suffix in compression.ETAG_SUFFIXES.values())
+
+def notModified(etag, age):
+    """Return an empty ``304 Not Modified`` response.
+
+    Args:
+        etag (str): Current tag.
+        age (int): ``max-age`` in seconds.
+
+    Returns:
+        obj: Flask response.
+    """
+    return setHeaders(Response(status=304), etag, age)
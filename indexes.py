@@ -0,0 +1,230 @@
+"""Indexes on ``MSG`` needed by the routes, and checks of query plans.
+
+Every route queries ``MSG`` by ``type`` (and sometimes ``unique_name``,
+``station``, ``subtype``, or ``location``) and sorts by ``insert_time``
+and ``_id``. Without a matching index, Mongo reads the whole collection
+and sorts it in memory on every request. Nothing fails; requests
+just get slow. This is easy to miss after a database is
+rebuilt.
+
+This is checked by running this module from the ``fisb-rest``
+directory (it is not done when the server starts, since the
+database belongs to 'fisb-decode', and a server that can't reach
+Mongo shouldn't hang while starting)::
+
+  python3 indexes.py [--create]
+
+* ``createIndexes()`` creates any index in ``MSG_INDEXES`` that
+  is missing, if ``--create`` is given or ``cfg.CREATE_INDEXES`` is
+  ``True``.
+* ``verifyQueryPlans()`` runs ``explain()`` on a query for each
+  route in ``app.py``. Routes whose plan has a ``COLLSCAN`` (whole
+  collection scan) or a ``SORT`` (in-memory sort) stage are listed,
+  and the exit status is 1.
+"""
+
+import argparse
+import sys
+
+from pymongo import errors
+
+import fisb_restConfig as cfg
+import utilities as util
+
+#: Indexes on ``MSG``. Each is a tuple of the index keys and a
+#: dictionary of options for ``create_index()``.
+MSG_INDEXES = [
+    # /all
+    ([('insert_time', 1), ('_id', 1)], {}),
+
+    # Most routes.
+    ([('type', 1), ('insert_time', 1), ('_id', 1)], {}),
+
+    # Routes for a single object, such as /metar/<id>.
+    ([('type', 1), ('unique_name', 1), ('insert_time', 1)], {}),
+
+    # /crl-8/<id> and the other CRL routes.
+    ([('type', 1), ('station', 1), ('insert_time', 1)], {}),
+
+    # NOTAM routes.
+    ([('type', 1), ('subtype', 1), ('insert_time', 1), ('_id', 1)], {}),
+    ([('type', 1), ('location', 1), ('insert_time', 1), ('_id', 1)], {}),
+    ([('type', 1), ('subtype', 1), ('location', 1), ('insert_time', 1), \
+        ('_id', 1)], {}),
+
+    # /cancel and the other cancellation routes. Only messages with
+    # a 'cancel' field are indexed.
+    ([('insert_time', 1), ('_id', 1), ('type', 1)], \
+        {'partialFilterExpression': {'cancel': {'$exists': True}}}),
+]
+
+# Plan stages that show a query isn't fully using an index.
+BAD_STAGES = ['COLLSCAN', 'SORT']
+
+# Value used for each variable part of a route ('<id>') when
+# building a query for it.
+SAMPLE_ARGUMENT = 'X'
+
+def _indexKey(keys, options):
+    """Return a value identifying an index by what it indexes.
+
+    Args:
+        keys (list): Index keys.
+        options (dict): Index options.
+
+    Returns:
+        tuple: Keys and partial filter expression (as strings).
+        Numeric key values are made integers (Mongo may return
+        ``1.0`` for ``1``). Others, such as ``'2dsphere'``, are kept.
+    """
+    return (str([(k, int(v) if isinstance(v, (int, float)) else v) \
+        for k, v in keys]), str(options.get('partialFilterExpression')))
+
+def createIndexes(db):
+    """Create any index in ``MSG_INDEXES`` that ``MSG`` doesn't have.
+
+    Indexes are compared by keys and partial filter expression, not
+    by name, so an existing index created by hand is not duplicated.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+
+    Returns:
+        list: Names of the indexes created.
+    """
+    existing = set()
+    for info in db.MSG.index_information().values():
+        existing.add(_indexKey(info['key'], info))
+
+    created = []
+    for keys, options in MSG_INDEXES:
+        if _indexKey(keys, options) in existing:
+            continue
+
+        name = '_'.join(['{}_{}'.format(k, v) for k, v in keys])
+        if 'partialFilterExpression' in options:
+            name += '_partial'
+
+        created.append(db.MSG.create_index(keys, name=name, **options))
+
+    return created
+
+def routeQueries(app):
+    """Return a sample query for each route that queries ``MSG``.
+
+    Args:
+        app (obj): Flask application.
+
+    Returns:
+        list: List of tuples of the route (such as
+        ``'/metar/<id>'``), kind of route (``util.ROUTE_ONE`` or
+        ``util.ROUTE_MANY``), and query, as the route would make it
+        with no query string.
+    """
+    afterDt = util.isoStringToDt(util.DEFAULT_AFTER)
+    queries = []
+
+    for rule in app.url_map.iter_rules():
+        path = rule.rule
+        for arg in rule.arguments:
+            path = path.replace('<{}>'.format(arg), SAMPLE_ARGUMENT)
+
+        described = util.describeRoute(app, path)
+        if described is None:
+            continue
+
+        kind, findArg1 = described
+        if kind not in [util.ROUTE_ONE, util.ROUTE_MANY]:
+            continue
+
+        findArg1['insert_time'] = {'$gt': afterDt}
+        queries.append((rule.rule, kind, findArg1))
+
+    return queries
+
+def planStages(db, kind, findArg1):
+    """Return the stages of the plan Mongo would use for a query.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+        kind (str): ``util.ROUTE_ONE`` or ``util.ROUTE_MANY``.
+        findArg1 (dict): Query.
+
+    Returns:
+        list: Names of the stages of the winning plan.
+    """
+    if kind == util.ROUTE_ONE:
+        cursor = db.MSG.find(findArg1).limit(1)
+    else:
+        cursor = db.MSG.find(findArg1).sort(util.SORT_ORDER) \
+            .limit(util.DEFAULT_LIMIT)
+
+    stages = []
+
+    def walk(x):
+        if isinstance(x, dict):
+            if 'stage' in x:
+                stages.append(x['stage'])
+            for v in x.values():
+                walk(v)
+        elif isinstance(x, list):
+            for v in x:
+                walk(v)
+
+    walk(cursor.explain()['queryPlanner']['winningPlan'])
+
+    return stages
+
+def verifyQueryPlans(db, app):
+    """Check the query plan of each route.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+        app (obj): Flask application.
+
+    Returns:
+        list: One string for each route with a bad plan (or whose
+        plan couldn't be found), describing the problem.
+    """
+    problems = []
+
+    for route, kind, findArg1 in routeQueries(app):
+        try:
+            stages = planStages(db, kind, findArg1)
+        except errors.PyMongoError as e:
+            problems.append('{}: explain() failed: {}'.format(route, e))
+            continue
+
+        bad = [s for s in stages if s in BAD_STAGES]
+        if len(bad) > 0:
+            problems.append('{}: plan has {} for query {}'.format(route, \
+                ', '.join(bad), findArg1))
+
+    return problems
+
+def main():
+    """Create missing indexes (if asked to) and check query plans.
+    """
+    parser = argparse.ArgumentParser( \
+        description='Check the indexes on MSG needed by the routes.')
+    parser.add_argument('--create', action='store_true', \
+        help='Create missing indexes (also done if CREATE_INDEXES is True).')
+    args = parser.parse_args()
+
+    # Only the routes are needed, not the snapshot.
+    cfg.SNAPSHOT_ENABLED = False
+    import app
+
+    if args.create or cfg.CREATE_INDEXES:
+        for name in createIndexes(util.dbConn):
+            print('Created index {}.'.format(name))
+
+    problems = verifyQueryPlans(util.dbConn, app.app)
+    for problem in problems:
+        print(problem)
+
+    if len(problems) > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Last good responses, sent when Mongo can't answer.
+
+Each response of a ``utilities.returnMany()`` route that isn't
+streamed is kept here, keyed (like ``coalesce``) by the route and its
+normalized query. If Mongo fails, or the circuit breaker (see
+``breaker``) is open, the last good response for the same request is
+sent at once instead of an error. It is marked as stale:
+
+* ``"stale": true`` is added to the JSON object.
+* The ``Age`` header is the number of seconds since it was made.
+* There is no ``ETag``, and ``Cache-Control`` is ``no-cache``, so
+  caches ask again.
+
+At most ``cfg.LAST_GOOD_BYTES`` bytes of responses are kept. The least
+recently used are dropped first.
+"""
+
+import time
+
+import fisb_restConfig as cfg
+import bytecache
+import coalesce
+
+# Entries (result of 'coalesce.share()', time made).
+_cache = bytecache.ByteLRU(cfg.LAST_GOOD_BYTES)
+
+def isEnabled():
+    """Check if last good responses are kept.
+
+    Returns:
+        bool: ``True`` if ``cfg.LAST_GOOD_BYTES`` is more than 0.
+    """
+    return cfg.LAST_GOOD_BYTES > 0
+
+def keep(key, response):
+    """Keep a response, if it is complete and good.
+
+    Args:
+        key (tuple): Key from ``coalesce.requestKey()``.
+        response (obj): Flask response.
+
+    Returns:
+        obj: ``response``.
+    """
+    if (not isEnabled()) or response.is_streamed or \
+            (response.status_code != 200):
+        return response
+
+    shared = coalesce.share(response)
+    _cache.put(key, (shared, time.monotonic()), len(shared[1]))
+
+    return response
+
+def staleResponse(key):
+    """Make a stale response from the last good response for a key.
+
+    Args:
+        key (tuple): Key from ``coalesce.requestKey()``.
+
+    Returns:
+        obj: Flask response, or ``None`` if there isn't one.
+    """
+    entry = _cache.get(key)
+    if entry is None:
+        return None
+
+    (status, body, headers), made = entry
+
+    body = body.rstrip()[:-1] + b',"stale":true}\n'
+    headers = [(k, v) for k, v in headers \
+        if k.lower() not in ['etag', 'cache-control', 'content-length']]
+    headers.append(('Cache-Control', 'no-cache'))
+    headers.append(('Age', str(int(time.monotonic() - made))))
+
+    return coalesce.rebuild((status, body, headers))
+
+def clear():
+    """Remove everything from the cache.
+    """
+    _cache.clear()
@@ -0,0 +1,542 @@
+"""Request metrics, served at ``/metrics`` in Prometheus text format.
+
+For each route (such as ``/metar/<id>``) the following are kept:
+
+* ``fisb_rest_requests_total``: Requests, by HTTP status.
+* ``fisb_rest_request_seconds``: Histogram of request time.
+* ``fisb_rest_mongo_seconds_total``: Time waiting on Mongo.
+* ``fisb_rest_filter_seconds_total``: Time in the ``lat=``/``lon=``
+  and ``high=``/``low=`` tests done in Python.
+* ``fisb_rest_transform_seconds_total``: Time in
+  ``utilities.changeStandardFields()``.
+* ``fisb_rest_serialize_seconds_total``: Time encoding JSON.
+* ``fisb_rest_response_bytes_total``: Bytes of response bodies sent.
+* ``fisb_rest_documents_scanned_total``: Messages read from Mongo or
+  the in-memory snapshot before the Python tests.
+* ``fisb_rest_documents_returned_total``: Messages returned.
+* ``fisb_rest_requests_coalesced_total``: Requests sent the response
+  built for an identical request in flight (see ``coalesce``).
+
+When ``documents_scanned`` is much bigger than ``documents_returned``,
+the Python tests are throwing away most of the work.
+
+While a request is handled, its numbers are added up in a dictionary
+held in a ``contextvars.ContextVar`` (so this works with threads and
+with ``asgi.py``). When it finishes, they are added to the totals of
+the process. Each process writes its totals to
+``cfg.METRICS_DIR/metrics-<pid>-<start>.json`` every
+``cfg.METRICS_FLUSH_INTERVAL`` seconds, and ``/metrics`` adds up the
+files of all running processes, so all gunicorn workers are counted.
+``<start>`` is the time the process started, so a new worker that
+gets the process id of an old one doesn't overwrite its file. When a
+worker exits (or is recycled by ``max_requests``), its totals are
+folded into ``cfg.METRICS_DIR/metrics-dead.json`` before its file is
+removed, so the totals reported never go down (which Prometheus would
+take to be a counter reset).
+
+This is off by default (``cfg.METRICS_ENABLED``).
+"""
+
+import contextvars
+import fcntl
+import json
+import os
+import threading
+import time
+
+from flask import Response
+from flask import request
+
+import fisb_restConfig as cfg
+import utilities as util
+import errlog
+
+# Prefix of all metric names.
+PREFIX = 'fisb_rest_'
+
+# Per route totals kept for each request, with their help text.
+# Each is reported with '_total' added to its name.
+ROUTE_COUNTERS = [
+    ('mongo_seconds', 'Seconds waiting on Mongo.'),
+    ('filter_seconds', 'Seconds in lat/lon and high/low tests done in Python.'),
+    ('transform_seconds', 'Seconds in changeStandardFields().'),
+    ('serialize_seconds', 'Seconds encoding JSON.'),
+    ('response_bytes', 'Bytes of response bodies.'),
+    ('documents_scanned', 'Messages read before Python tests.'),
+    ('documents_returned', 'Messages returned.'),
+    ('requests_coalesced', 'Requests sent the response of an identical request.'),
+]
+
+# Set in the WSGI environment by 'asgi.py' for requests it counts
+# itself, so Flask doesn't count them again.
+ENVIRON_KEY = 'fisb_rest.metrics'
+
+# Numbers for the request being handled: a dictionary, or 'None'.
+_current = contextvars.ContextVar('metrics', default=None)
+
+# Totals for this process:
+#   counters: {name: {labels (as JSON): value}}
+#   histograms: {route: [bucket counts..., sum, count]}
+_counters = {}
+_histograms = {}
+_lock = threading.Lock()
+
+# Process id of the process the flush thread was started in.
+_flushPid = None
+
+# (process id, name of its file in cfg.METRICS_DIR), set by _filename().
+_fileKey = (None, None)
+
+# Files in cfg.METRICS_DIR holding the totals of processes that have
+# exited, and locked while folding a file into them.
+DEAD_FILENAME = 'metrics-dead.json'
+LOCK_FILENAME = 'metrics.lock'
+
+def isEnabled():
+    """Check if metrics are turned on.
+
+    Returns:
+        bool: ``True`` if ``cfg.METRICS_ENABLED`` is ``True``.
+    """
+    return cfg.METRICS_ENABLED
+
+def isActive():
+    """Check if the current request is being measured.
+
+    Returns:
+        bool: ``True`` if ``add()`` will record anything.
+    """
+    return _current.get() is not None
+
+def requestStats():
+    """Return the numbers for the current request.
+
+    Returns:
+        dict: Numbers kept by ``add()``, or ``None`` if no request is
+        being measured.
+    """
+    return _current.get()
+
+def add(name, value):
+    """Add to a number for the current request.
+
+    Does nothing if no request is being measured.
+
+    Args:
+        name (str): One of the names in ``ROUTE_COUNTERS``.
+        value (float): Amount to add.
+    """
+    stats = _current.get()
+    if stats is not None:
+        stats[name] = stats.get(name, 0) + value
+
+def startRequest():
+    """Start measuring a request.
+
+    Returns:
+        dict: Numbers for the request.
+    """
+    stats = {'start': time.perf_counter()}
+    _current.set(stats)
+
+    return stats
+
+def finishRequest(stats, route, status):
+    """Add the numbers for a finished request to the process totals.
+
+    Args:
+        stats (dict): Result of ``startRequest()``.
+        route (str): Route, such as ``'/metar/<id>'``.
+        status (int): HTTP status.
+    """
+    seconds = time.perf_counter() - stats['start']
+
+    with _lock:
+        _addCounter('requests_total', {'route': route, 'status': str(status)}, 1)
+
+        for name, _ in ROUTE_COUNTERS:
+            if name in stats:
+                _addCounter(name, {'route': route}, stats[name])
+
+        histogram = _histograms.get(route)
+        if histogram is None:
+            histogram = [0] * (len(cfg.METRICS_BUCKETS) + 2)
+            _histograms[route] = histogram
+
+        for i in range(len(cfg.METRICS_BUCKETS)):
+            if seconds <= cfg.METRICS_BUCKETS[i]:
+                histogram[i] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+    _startFlushThread()
+
+def _addCounter(name, labels, value):
+    """Add to a process total. Must be called holding ``_lock``.
+
+    Args:
+        name (str): Metric name, without ``PREFIX``.
+        labels (dict): Labels.
+        value (float): Amount to add.
+    """
+    key = json.dumps(labels, sort_keys=True)
+    values = _counters.setdefault(name, {})
+    values[key] = values.get(key, 0) + value
+
+def timedCursor(cursor, countScanned):
+    """Iterate over a Mongo cursor, adding the time spent to
+    ``mongo_seconds``.
+
+    Args:
+        cursor (obj): Mongo cursor (or any iterable).
+        countScanned (bool): If ``True``, also count each message in
+            ``documents_scanned``.
+
+    Yields:
+        dict: Messages from ``cursor``.
+    """
+    iterator = iter(cursor)
+
+    while True:
+        start = time.perf_counter()
+        try:
+            msg = next(iterator)
+        except StopIteration:
+            add('mongo_seconds', time.perf_counter() - start)
+            return
+        add('mongo_seconds', time.perf_counter() - start)
+
+        if countScanned:
+            add('documents_scanned', 1)
+
+        yield msg
+
+def counted(msgs, name):
+    """Iterate over messages, counting each.
+
+    Args:
+        msgs (obj): Iterable of messages.
+        name (str): Name to add 1 to for each message.
+
+    Yields:
+        dict: Messages from ``msgs``.
+    """
+    for msg in msgs:
+        add(name, 1)
+        yield msg
+
+def beforeRequest():
+    """Start measuring a Flask request.
+
+    Registered with ``app.before_request()``.
+    """
+    if isEnabled() and not request.environ.get(ENVIRON_KEY):
+        request.environ[ENVIRON_KEY + '.stats'] = startRequest()
+
+def afterRequest(response):
+    """Finish measuring a Flask request.
+
+    Registered with ``app.after_request()``. Streamed responses are
+    finished when the last byte is sent.
+
+    Args:
+        response (obj): Flask response.
+
+    Returns:
+        obj: ``response``.
+    """
+    stats = request.environ.get(ENVIRON_KEY + '.stats')
+    if stats is None:
+        return response
+
+    route = request.url_rule.rule if request.url_rule is not None else 'none'
+    status = response.status_code
+
+    if not response.is_streamed:
+        add('response_bytes', response.calculate_content_length() or 0)
+        finishRequest(stats, route, status)
+        return response
+
+    def countBytes(body):
+        for chunk in body:
+            add('response_bytes', len(chunk))
+            yield chunk
+
+    response.response = countBytes(response.response)
+    response.call_on_close(lambda: finishRequest(stats, route, status))
+
+    return response
+
+def _startFlushThread():
+    """Start the thread writing this process's totals, if not running.
+    """
+    global _flushPid
+
+    if _flushPid == os.getpid():
+        return
+
+    with _lock:
+        if _flushPid == os.getpid():
+            return
+        _flushPid = os.getpid()
+
+    threading.Thread(target=_runFlush, name='metrics', daemon=True).start()
+
+def _runFlush():
+    """Body of the flush thread.
+    """
+    while True:
+        time.sleep(cfg.METRICS_FLUSH_INTERVAL)
+
+        try:
+            flush()
+        except Exception:
+            errlog.logError('metrics')
+
+def _processStart(pid):
+    """Return the time a process started, from ``/proc``.
+
+    Args:
+        pid (int): Process id.
+
+    Returns:
+        int: Start time in clock ticks since boot, or ``None`` if it
+        can't be read (no such process, or no ``/proc``).
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            stat = f.read()
+    except OSError:
+        return None
+
+    # The command name (field 2) is in parentheses and may hold
+    # spaces, so fields are counted after the last ')'. The start
+    # time is field 22.
+    try:
+        return int(stat[stat.rindex(')') + 1:].split()[19])
+    except (ValueError, IndexError):
+        return None
+
+def _filename():
+    """Return the name of this process's file in ``cfg.METRICS_DIR``.
+
+    Returns:
+        str: ``metrics-<pid>-<start>.json``. ``<start>`` is from
+        ``_processStart()`` or, without ``/proc``, the time this was
+        first called in the process.
+    """
+    global _fileKey
+
+    pid = os.getpid()
+    if _fileKey[0] != pid:
+        start = _processStart(pid)
+        if start is None:
+            start = time.time_ns()
+        _fileKey = (pid, 'metrics-{}-{}.json'.format(pid, start))
+
+    return _fileKey[1]
+
+def flush():
+    """Write this process's totals to ``cfg.METRICS_DIR``.
+    """
+    with _lock:
+        data = json.dumps({'counters': _counters, 'histograms': _histograms})
+
+    os.makedirs(cfg.METRICS_DIR, exist_ok=True)
+
+    filename = os.path.join(cfg.METRICS_DIR, _filename())
+    with open(filename + '.tmp', 'w') as f:
+        f.write(data)
+    os.replace(filename + '.tmp', filename)
+
+def _isRunning(name):
+    """Check if the process that wrote a file is still running.
+
+    Args:
+        name (str): Name of a file written by ``flush()``.
+
+    Returns:
+        bool: ``True`` if the process exists and (where ``/proc`` can
+        tell) is the same process, not a new one with the same id.
+        Names not in the form ``metrics-<pid>-<start>.json`` give
+        ``False``.
+    """
+    try:
+        pid, start = [int(x) for x in name[8:-5].split('-')]
+    except ValueError:
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    current = _processStart(pid)
+    if (current is not None) and (current != start):
+        return False
+
+    return True
+
+def _readTotals(filename):
+    """Read totals written by ``flush()`` or ``_foldDead()``.
+
+    Args:
+        filename (str): Path of the file.
+
+    Returns:
+        dict: Totals, with ``'counters'`` and ``'histograms'`` keys,
+        or ``None`` if the file can't be read.
+    """
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _addTotals(counters, histograms, data):
+    """Add totals read by ``_readTotals()`` to others.
+
+    Args:
+        counters (dict): Counters to add to, as in ``_counters``.
+        histograms (dict): Histograms to add to, as in ``_histograms``.
+        data (dict): Totals to add.
+    """
+    for metric, values in data['counters'].items():
+        totals = counters.setdefault(metric, {})
+        for key, value in values.items():
+            totals[key] = totals.get(key, 0) + value
+
+    for route, histogram in data['histograms'].items():
+        total = histograms.get(route)
+        if (total is None) or (len(total) != len(histogram)):
+            histograms[route] = list(histogram)
+        else:
+            histograms[route] = [a + b for a, b in zip(total, histogram)]
+
+def _foldDead(filename):
+    """Fold the totals of a process that has exited into
+    ``DEAD_FILENAME``, and remove its file.
+
+    Must be called with ``LOCK_FILENAME`` locked.
+
+    Args:
+        filename (str): Path of the process's file.
+    """
+    deadFilename = os.path.join(cfg.METRICS_DIR, DEAD_FILENAME)
+
+    data = _readTotals(filename)
+    if data is not None:
+        counters = {}
+        histograms = {}
+
+        dead = _readTotals(deadFilename)
+        if dead is not None:
+            _addTotals(counters, histograms, dead)
+        _addTotals(counters, histograms, data)
+
+        with open(deadFilename + '.tmp', 'w') as f:
+            f.write(json.dumps({'counters': counters, 'histograms': histograms}))
+        os.replace(deadFilename + '.tmp', deadFilename)
+
+    os.remove(filename)
+
+def collect():
+    """Add up the totals of all processes, running or not.
+
+    Files of processes that are no longer running are folded into
+    ``DEAD_FILENAME`` (see ``_foldDead()``). This is done with a lock
+    held, so a file is never folded (or counted) twice, even if several
+    processes are collecting at the same time.
+
+    Returns:
+        tuple: Counters and histograms, in the same form as
+        ``_counters`` and ``_histograms``.
+    """
+    flush()
+
+    counters = {}
+    histograms = {}
+
+    with open(os.path.join(cfg.METRICS_DIR, LOCK_FILENAME), 'a') as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+
+        names = [name for name in os.listdir(cfg.METRICS_DIR) \
+            if name.startswith('metrics-') and name.endswith('.json')]
+
+        for name in names:
+            if (name != DEAD_FILENAME) and not _isRunning(name):
+                _foldDead(os.path.join(cfg.METRICS_DIR, name))
+
+        for name in os.listdir(cfg.METRICS_DIR):
+            if not (name.startswith('metrics-') and name.endswith('.json')):
+                continue
+
+            data = _readTotals(os.path.join(cfg.METRICS_DIR, name))
+            if data is not None:
+                _addTotals(counters, histograms, data)
+
+    return counters, histograms
+
+def _formatLabels(labels):
+    """Format labels for the Prometheus text format.
+
+    Args:
+        labels (dict): Labels.
+
+    Returns:
+        str: Labels in braces, such as ``{route="/metar"}``.
+    """
+    return '{' + ','.join(['{}="{}"'.format(k, str(v).replace('\\', '\\\\') \
+        .replace('"', '\\"')) for k, v in sorted(labels.items())]) + '}'
+
+def returnMetrics():
+    """Return all metrics in Prometheus text format.
+
+    Returns:
+        obj: Flask response.
+    """
+    if util.isDescribing():
+        return None
+
+    if not isEnabled():
+        return Response('Not found.\n', status=404, mimetype='text/plain')
+
+    counters, histograms = collect()
+    lines = []
+
+    helpText = [('requests_total', 'Requests handled.')] + \
+        [(name, text) for name, text in ROUTE_COUNTERS]
+
+    for name, text in helpText:
+        metric = PREFIX + name
+        if not metric.endswith('_total'):
+            metric += '_total'
+
+        lines.append('# HELP {} {}'.format(metric, text))
+        lines.append('# TYPE {} counter'.format(metric))
+
+        for key, value in sorted(counters.get(name, {}).items()):
+            lines.append('{}{} {}'.format(metric, \
+                _formatLabels(json.loads(key)), repr(float(value))))
+
+    metric = PREFIX + 'request_seconds'
+    lines.append('# HELP {} Seconds taken by requests.'.format(metric))
+    lines.append('# TYPE {} histogram'.format(metric))
+
+    for route, histogram in sorted(histograms.items()):
+        for i in range(len(cfg.METRICS_BUCKETS)):
+            lines.append('{}_bucket{} {}'.format(metric, _formatLabels( \
+                {'route': route, 'le': repr(float(cfg.METRICS_BUCKETS[i]))}), \
+                histogram[i]))
+
+        lines.append('{}_bucket{} {}'.format(metric, \
+            _formatLabels({'route': route, 'le': '+Inf'}), histogram[-1]))
+        lines.append('{}_sum{} {}'.format(metric, \
+            _formatLabels({'route': route}), repr(float(histogram[-2]))))
+        lines.append('{}_count{} {}'.format(metric, \
+            _formatLabels({'route': route}), histogram[-1]))
+
+    return Response('\n'.join(lines) + '\n', \
+        mimetype='text/plain; version=0.0.4')
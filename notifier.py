@@ -0,0 +1,224 @@
+"""Tell waiting requests when new messages arrive.
+
+Used by long-poll requests (``wait=``) and by ``/stream``. Each server
+process has a single reader of new messages, no matter how many
+requests are waiting:
+
+* If the in-memory snapshot is enabled (and not shared between
+  processes), it is used as the source.
+* Otherwise, a thread follows a change stream on ``MSG`` or, if Mongo
+  is not a replica set, polls ``MSG`` every
+  ``cfg.NOTIFY_POLL_INTERVAL`` seconds for messages with a newer
+  ``insert_time``.
+
+Only messages with an ``insert_time`` newer than any seen before are
+passed on, so reloads of the snapshot don't repeat old messages.
+
+Waiters use ``generation()`` and ``waitFor()``. Functions registered
+with ``subscribe()`` are called with each new message.
+"""
+
+import threading
+import time
+
+from pymongo import errors
+
+import fisb_restConfig as cfg
+import errlog
+import snapshot
+
+# Seconds to wait before trying again after an error.
+RETRY_INTERVAL = 5.0
+
+# Incremented each time new messages arrive.
+_generation = 0
+_cond = threading.Condition()
+
+# Newest 'insert_time' passed on.
+_highWater = None
+
+# Functions called with each new message.
+_subscribers = []
+_subscribersLock = threading.Lock()
+
+_startLock = threading.Lock()
+_started = False
+
+def start(db):
+    """Start watching for new messages. Safe to call more than once.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+    """
+    global _started, _highWater
+
+    with _startLock:
+        if _started:
+            return
+        _started = True
+
+        newest = db.MSG.find_one({}, {'insert_time': 1}, \
+            sort=[('insert_time', -1)])
+        if newest is not None:
+            _highWater = newest['insert_time']
+
+        if cfg.SNAPSHOT_ENABLED and not cfg.SHARED_SNAPSHOT:
+            snapshot.addListener(_snapshotListener)
+            return
+
+        threading.Thread(target=_run, args=(db,), name='notifier', \
+            daemon=True).start()
+
+def generation():
+    """Return the current generation.
+
+    Returns:
+        int: Number that changes whenever new messages arrive.
+    """
+    return _generation
+
+def waitFor(gen, timeout):
+    """Wait until new messages arrive or a timeout expires.
+
+    Args:
+        gen (int): Value of ``generation()`` taken before checking
+            for messages. If it has already changed, returns at once.
+        timeout (float): Maximum seconds to wait.
+
+    Returns:
+        bool: ``True`` if new messages arrived.
+    """
+    with _cond:
+        return _cond.wait_for(lambda: _generation != gen, timeout)
+
+def subscribe(func):
+    """Call a function with each new message.
+
+    The function is called from the reader thread and must not block.
+
+    Args:
+        func (function): Function taking a message. The message must
+            not be altered.
+    """
+    with _subscribersLock:
+        _subscribers.append(func)
+
+def unsubscribe(func):
+    """Stop calling a function registered with ``subscribe()``.
+
+    Args:
+        func (function): Function to remove.
+    """
+    with _subscribersLock:
+        if func in _subscribers:
+            _subscribers.remove(func)
+
+def publish(msgs):
+    """Pass new messages to waiters and subscribers.
+
+    Messages not newer than any already passed on are skipped.
+
+    Args:
+        msgs (list): Messages from the database.
+    """
+    global _generation, _highWater
+
+    newMsgs = []
+
+    with _cond:
+        for msg in msgs:
+            insertTime = msg.get('insert_time')
+            if insertTime is None:
+                continue
+            if (_highWater is not None) and (insertTime <= _highWater):
+                continue
+
+            newMsgs.append(msg)
+
+        if len(newMsgs) == 0:
+            return
+
+        for msg in newMsgs:
+            if (_highWater is None) or (msg['insert_time'] > _highWater):
+                _highWater = msg['insert_time']
+
+        _generation += 1
+        _cond.notify_all()
+
+    with _subscribersLock:
+        subscribers = list(_subscribers)
+
+    for msg in newMsgs:
+        for func in subscribers:
+            try:
+                func(msg)
+            except Exception:
+                errlog.logError('notifier subscriber')
+
+def _snapshotListener(operation, msg):
+    """Pass new messages from the snapshot on.
+
+    Args:
+        operation (str): ``'upsert'``, ``'delete'``, or ``'reset'``.
+        msg (dict): Message, or ``None``.
+    """
+    if operation == 'upsert':
+        publish([msg])
+
+def _run(db):
+    """Body of the reader thread.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+    """
+    useChangeStream = True
+
+    while True:
+        try:
+            if useChangeStream:
+                _followChangeStream(db)
+            else:
+                _followByPolling(db)
+
+        except errors.OperationFailure as e:
+            if e.code == snapshot.CHANGE_STREAM_NOT_SUPPORTED:
+                useChangeStream = False
+                continue
+
+            errlog.logError('notifier')
+            time.sleep(RETRY_INTERVAL)
+
+        except Exception:
+            errlog.logError('notifier')
+            time.sleep(RETRY_INTERVAL)
+
+def _followChangeStream(db):
+    """Pass on messages from a change stream on ``MSG``.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+    """
+    pipeline = [{'$match': {'operationType': \
+        {'$in': ['insert', 'update', 'replace']}}}]
+
+    with db.MSG.watch(pipeline, full_document='updateLookup') as stream:
+        for change in stream:
+            if change.get('fullDocument') is not None:
+                publish([change['fullDocument']])
+
+def _followByPolling(db):
+    """Poll ``MSG`` for messages with a newer ``insert_time``.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+    """
+    while True:
+        time.sleep(cfg.NOTIFY_POLL_INTERVAL)
+
+        query = {}
+        if _highWater is not None:
+            query['insert_time'] = {'$gt': _highWater}
+
+        msgs = list(db.MSG.find(query).sort('insert_time', 1))
+        if len(msgs) > 0:
+            publish(msgs)
@@ -0,0 +1,165 @@
+"""Profile single requests on a running server.
+
+If ``cfg.PROFILE_ENABLED`` is ``True``, a request with ``profile=1``
+in its query string, or an ``X-Profile: 1`` header, is run under
+``cProfile``. If ``cfg.PROFILE_SAMPLE`` is more than 0, one request in
+that many is profiled as well.
+
+Each profile is written to ``PROFILE_DIR`` (next to
+``cfg.ERROR_FILENAME``) as two files with the same name:
+
+* ``.prof``: ``cProfile`` output, for ``pstats``, ``snakeviz``, and
+  the like.
+* ``.json``: the route, path, query string, status, time taken, and
+  (if ``cfg.METRICS_ENABLED``) the request's numbers from ``metrics``,
+  such as ``documents_scanned``. ``"top"`` lists the functions with
+  the most cumulative time.
+
+Only the newest ``cfg.PROFILE_KEEP`` profiles are kept. The profile
+covers building the response and compressing it, but not sending a
+streamed body. Requests answered by ``asgi.py`` itself aren't
+profiled. To look at one::
+
+  python3 -m pstats profiles/<name>.prof
+"""
+
+import cProfile
+import datetime
+import io
+import itertools
+import json
+import os
+import pstats
+import re
+import time
+
+from flask import request
+
+import fisb_restConfig as cfg
+import metrics
+import errlog
+
+# Name of the directory, next to cfg.ERROR_FILENAME.
+PROFILE_DIR = 'profiles'
+
+# Functions listed in the '"top"' field of the '.json' file.
+TOP_FUNCTIONS = 30
+
+# Set in the WSGI environment to the profiler of a profiled request.
+ENVIRON_KEY = 'fisb_rest.profiler'
+
+# Counts requests, for 'cfg.PROFILE_SAMPLE'.
+_requests = itertools.count()
+
+def profileDir():
+    """Return the directory profiles are written to.
+
+    Returns:
+        str: ``PROFILE_DIR`` in the directory of ``cfg.ERROR_FILENAME``.
+    """
+    return os.path.join(os.path.dirname(cfg.ERROR_FILENAME), PROFILE_DIR)
+
+def wanted():
+    """Check if the current Flask request should be profiled.
+
+    Returns:
+        bool: ``True`` if it asked to be, or was picked by sampling.
+    """
+    if request.args.get('profile') == '1' or \
+            request.headers.get('X-Profile') == '1':
+        return True
+
+    return (cfg.PROFILE_SAMPLE > 0) and \
+        (next(_requests) % cfg.PROFILE_SAMPLE == 0)
+
+def beforeRequest():
+    """Start profiling a Flask request, if wanted.
+
+    Registered with ``app.before_request()``.
+    """
+    if (not cfg.PROFILE_ENABLED) or not wanted():
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is running.
+        return
+
+    request.environ[ENVIRON_KEY] = (profiler, time.perf_counter())
+
+def afterRequest(response):
+    """Finish profiling a Flask request and write the profile.
+
+    Registered with ``app.after_request()``.
+
+    Args:
+        response (obj): Flask response.
+
+    Returns:
+        obj: ``response``.
+    """
+    profiling = request.environ.pop(ENVIRON_KEY, None)
+    if profiling is None:
+        return response
+
+    profiler, start = profiling
+    profiler.disable()
+    seconds = time.perf_counter() - start
+
+    route = request.url_rule.rule if request.url_rule is not None else 'none'
+    info = {'route': route, 'path': request.path, \
+        'query': request.query_string.decode('utf-8', 'replace'), \
+        'status': response.status_code, 'seconds': seconds, \
+        'pid': os.getpid(), \
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat()}
+
+    stats = metrics.requestStats()
+    if stats is not None:
+        info['counts'] = dict((k, v) for k, v in stats.items() \
+            if k != 'start')
+
+    try:
+        write(profiler, info)
+    except Exception:
+        errlog.logError('profiler')
+
+    return response
+
+def write(profiler, info):
+    """Write a profile, and remove the oldest ones beyond
+    ``cfg.PROFILE_KEEP``.
+
+    Args:
+        profiler (obj): ``cProfile.Profile``, stopped.
+        info (dict): Information about the request.
+    """
+    directory = profileDir()
+    os.makedirs(directory, exist_ok=True)
+
+    name = '{}-{}-{}'.format( \
+        datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S.%f'), \
+        info['pid'], re.sub('[^A-Za-z0-9]+', '_', info['route']).strip('_'))
+    path = os.path.join(directory, name)
+
+    profiler.dump_stats(path + '.prof')
+
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats('cumulative') \
+        .print_stats(TOP_FUNCTIONS)
+    info['top'] = text.getvalue().strip().split('\n')
+
+    with open(path + '.json', 'w') as f:
+        f.write(json.dumps(info, indent=2) + '\n')
+
+    # Names start with the time, so sort oldest first.
+    profiles = sorted(n[:-5] for n in os.listdir(directory) \
+        if n.endswith('.prof'))
+
+    for old in profiles[:-cfg.PROFILE_KEEP]:
+        for extension in ['.prof', '.json']:
+            try:
+                os.remove(os.path.join(directory, old + extension))
+            except OSError:
+                pass
@@ -0,0 +1,638 @@
+"""Copy of the in-memory snapshot shared by all worker processes.
+
+With ``cfg.SNAPSHOT_ENABLED``, each server process normally keeps its
+own copy of ``MSG`` (see ``snapshot``), so memory use, and the work of
+keeping the copies current, grow with the number of gunicorn workers.
+If ``cfg.SHARED_SNAPSHOT`` is also ``True``, a single *loader* process
+keeps the snapshot instead, and writes it to a file in
+``cfg.SHARED_SNAPSHOT_DIR`` (a memory file system such as
+``/dev/shm``) each time it changes. Workers map the file into memory
+and read it in place, so there is one copy no matter how many
+workers there are.
+
+Each file (a *segment*) holds, for every message, in the order of
+``utilities.SORT_ORDER``:
+
+* the message as BSON,
+* its *head*: the names of its fields and the values of the few
+  fields in ``HEAD_FIELDS``, which queries are matched against,
+* the message as sent to clients (from
+  ``utilities.encodeFragment()``),
+* the bounding box and WKB of each of its polygons.
+
+Segments are numbered by a generation counter. A small header file
+holds the current generation and the time the loader's snapshot was
+last known to match the database. A segment is completely written
+before the header points to it, and workers look at the header on
+every query, so all workers move to a new generation at the same
+moment.
+
+Workers only keep the heads decoded (and reuse those of messages
+that didn't change from one generation to the next). Messages given
+to callers that don't alter them (``copyMsgs`` of ``False``) are
+``SharedMsg`` objects: read-only mappings whose other fields are
+decoded from the segment when asked for, and whose encoded form is a
+``memoryview`` of the segment. ``lat=``/``lon=`` tests
+compare the point with the polygon bounding boxes in the segment, and
+only the few polygons whose box holds the point are tested exactly.
+
+The loader is started by the ``when_ready`` hook in
+``gunicorn.conf.py``, or can be run by itself (for instance, next to
+an ASGI server)::
+
+  python3 sharedsnapshot.py
+
+Only one loader works at a time (a lock file decides). Any other
+waits, and takes over if the first one stops.
+"""
+
+import array
+import collections.abc
+import copy
+import fcntl
+import hashlib
+import mmap
+import multiprocessing
+import os
+import struct
+import threading
+import time
+
+import bson
+import numpy
+import shapely
+from bson.codec_options import CodecOptions
+from flask import Flask
+from pymongo import MongoClient
+
+import fisb_restConfig as cfg
+import utilities as util
+import snapshot
+import spatialindex
+import errlog
+
+# Fields kept in the head of each message: the ones routes query on
+# (see 'app.py'), and the ones used for tags and 'next=' tokens.
+# Queries on other fields decode whole messages, which is slower but
+# gives the same answer.
+HEAD_FIELDS = ['_id', 'type', 'subtype', 'unique_name', 'location', \
+    'station', 'cancel', 'insert_time', 'digest']
+
+# Header file: current generation (0 if none yet), and time.time()
+# of the last sync of the loader's snapshot.
+HEADER_FILE = 'header'
+HEADER = struct.Struct('<Qd')
+
+# Lock held by the working loader, and seconds between tries to get it.
+LOCK_FILE = 'loader.lock'
+LOCK_RETRY_INTERVAL = 1.0
+
+# Start of each segment: magic, generation, number of messages,
+# number of polygons. Followed by the message table, the polygon
+# table, and the BSON, JSON, and WKB the tables point to.
+SEGMENT_MAGIC = b'FISBSEG1'
+SEGMENT_HEADER = struct.Struct('<8sQQQ')
+
+# Row of the message table. 'key' is the SHA-1 of the message's BSON.
+MSG_DTYPE = numpy.dtype([('head', '<u8'), ('headLen', '<u8'), \
+    ('doc', '<u8'), ('docLen', '<u8'), \
+    ('fragment', '<u8'), ('fragmentLen', '<u8'), \
+    ('polys', '<u4'), ('key', 'S20')], align=True)
+
+# Row of the polygon table. 'msg' is the row of the message.
+POLY_DTYPE = numpy.dtype([('msg', '<u4'), \
+    ('minx', '<f8'), ('miny', '<f8'), ('maxx', '<f8'), ('maxy', '<f8'), \
+    ('wkb', '<u8'), ('wkbLen', '<u8')], align=True)
+
+# Decode datetimes the way the Mongo client does.
+CODEC_OPTIONS = CodecOptions(tz_aware=True)
+
+# Seconds to wait before trying again to open the header.
+OPEN_RETRY_INTERVAL = 1.0
+
+# Worker side: read only map of the header, and the segment in use.
+_header = None
+_nextOpen = 0.0
+_segment = None
+_lock = threading.Lock()
+
+class SharedMsg(collections.abc.Mapping):
+    """Read-only view of a message in a segment.
+
+    Fields in ``HEAD_FIELDS`` are kept decoded (and shared between
+    requests). The others are decoded from the segment each time they
+    are asked for. Must not be altered. ``copy.deepcopy()`` returns
+    the whole message as a ``dict``.
+    """
+    __slots__ = ('_segment', '_index', '_head', '_fields')
+
+    def __init__(self, segment, index, head, fields):
+        self._segment = segment
+        self._index = index
+        self._head = head
+        self._fields = fields
+
+    def __getitem__(self, key):
+        if key in self._head:
+            return self._head[key]
+        if key not in self._fields:
+            raise KeyError(key)
+
+        return self._segment.decode(self._index)[key]
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __deepcopy__(self, memo):
+        return self._segment.decode(self._index)
+
+    def fragment(self):
+        """Return the message as ``utilities.msgFragment()`` would.
+
+        Returns:
+            memoryview: Encoded message, in the segment.
+        """
+        return self._segment.fragment(self._index)
+
+class _Segment(object):
+    """A segment mapped into memory.
+
+    Args:
+        path (str): Segment file.
+        previous (obj): Segment used before, or ``None``. Heads of
+            messages that haven't changed are taken from it rather
+            than decoded again.
+
+    Messages whose fields have the same names share one tuple of
+    names.
+
+    Raises:
+        OSError: If the file can't be read (the loader may already
+            have removed it).
+        ValueError: If the file isn't a segment.
+    """
+    def __init__(self, path, previous):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.generation, numMsgs, numPolys = \
+            SEGMENT_HEADER.unpack_from(self._mm)
+        if magic != SEGMENT_MAGIC:
+            raise ValueError(path)
+
+        offset = SEGMENT_HEADER.size
+        self.table = numpy.frombuffer(self._mm, MSG_DTYPE, numMsgs, offset)
+        offset += self.table.nbytes
+        self.polys = numpy.frombuffer(self._mm, POLY_DTYPE, numPolys, offset)
+
+        self._view = memoryview(self._mm)
+
+        # Offsets used for every message returned, kept as plain
+        # integers (reading them from the table is much slower).
+        self._docs = array.array('Q', self.table['doc'].tolist())
+        self._docLens = array.array('Q', self.table['docLen'].tolist())
+        self._fragments = array.array('Q', self.table['fragment'].tolist())
+        self._fragmentLens = array.array('Q', \
+            self.table['fragmentLen'].tolist())
+
+        oldHeads = {} if previous is None else previous.heads
+        fieldTuples = {} if previous is None else previous.fieldTuples
+        self.heads = {}
+        self.fieldTuples = {}
+        self.msgs = []
+
+        for n, (head, headLen, key) in enumerate(zip( \
+                self.table['head'].tolist(), self.table['headLen'].tolist(), \
+                self.table['key'].tolist())):
+            msgHead = oldHeads.get(key)
+            if msgHead is None:
+                decoded = bson.decode(self._view[head:head + headLen], \
+                    codec_options=CODEC_OPTIONS)
+                fields = tuple(decoded['fields'])
+                fields = fieldTuples.setdefault(fields, fields)
+                msgHead = (decoded['head'], fields)
+
+            self.heads[key] = msgHead
+            self.fieldTuples.setdefault(msgHead[1], msgHead[1])
+            self.msgs.append(SharedMsg(self, n, msgHead[0], msgHead[1]))
+
+    def decode(self, index):
+        """Decode a whole message.
+
+        Args:
+            index (int): Row of the message.
+
+        Returns:
+            dict: New copy of the message.
+        """
+        start = self._docs[index]
+
+        return bson.decode(self._view[start:start + self._docLens[index]], \
+            codec_options=CODEC_OPTIONS)
+
+    def fragment(self, index):
+        """Return the encoded form of a message.
+
+        Args:
+            index (int): Row of the message.
+
+        Returns:
+            memoryview: Encoded message, in the segment.
+        """
+        start = self._fragments[index]
+
+        return self._view[start:start + self._fragmentLens[index]]
+
+    def pointMask(self, lat, lon):
+        """Test all messages against a point.
+
+        Args:
+            lat (float): Latitude.
+            lon (float): Longitude.
+
+        Returns:
+            obj: NumPy array of ``True``/``False``, one for each
+            message, with the meaning of ``utilities.checkIfInPolygon()``.
+        """
+        passed = self.table['polys'] == 0
+
+        polys = self.polys
+        inBox = numpy.nonzero((polys['minx'] <= lon) & (lon <= polys['maxx']) \
+            & (polys['miny'] <= lat) & (lat <= polys['maxy']))[0]
+
+        if len(inBox) > 0:
+            geoms = shapely.from_wkb([bytes(self._view[o:o + n]) for o, n in \
+                zip(polys['wkb'][inBox].tolist(), \
+                    polys['wkbLen'][inBox].tolist())])
+            inside = shapely.contains_xy(geoms, lon, lat)
+            passed[polys['msg'][inBox][inside]] = True
+
+        return passed
+
+def isReady():
+    """Check if the shared snapshot can be used to answer queries.
+
+    Returns:
+        bool: ``True`` if the loader has written a segment, and its
+        snapshot has been in sync with the database within the last
+        ``cfg.SNAPSHOT_MAX_AGE`` seconds.
+    """
+    header = _openHeader()
+    if header is None:
+        return False
+
+    generation, syncTime = HEADER.unpack_from(header)
+
+    return (generation != 0) and \
+        ((time.time() - syncTime) < cfg.SNAPSHOT_MAX_AGE)
+
+def find(findArg1, limit, tests=[], copyMsgs=True):
+    """Same as ``snapshot.find()``, using the shared snapshot.
+
+    Args:
+        findArg1 (dict): Dictionary in the form of the
+            first argument to the ``find()`` call to Mongo.
+        limit (int): Maximum number of messages to return.
+        tests (list): Functions taking a message and returning
+            ``True`` if it should be returned. Tests from
+            ``spatialindex.pointTest()`` are done using the polygons
+            in the segment.
+        copyMsgs (bool): If ``False``, ``SharedMsg`` objects are
+            returned instead of copies. The caller must not alter them.
+
+    Returns:
+        obj: Iterator of matching messages, or ``None`` if the query
+        can't be answered from the shared snapshot.
+    """
+    if not snapshot.isSupported(findArg1):
+        return None
+
+    segment = _current()
+    if segment is None:
+        return None
+
+    return _find(segment, findArg1, limit, tests, copyMsgs)
+
+def _find(segment, findArg1, limit, tests, copyMsgs):
+    """Generator used by ``find()``.
+
+    Args:
+        segment (obj): Segment to search.
+        findArg1 (dict): Mongo style query.
+        limit (int): Maximum number of messages to return.
+        tests (list): Extra test functions.
+        copyMsgs (bool): ``True`` to return copies of messages.
+
+    Yields:
+        dict: Matching messages.
+    """
+    masks = [segment.pointMask(*t.point) for t in tests if hasattr(t, 'point')]
+    tests = [t for t in tests if not hasattr(t, 'point')]
+
+    # Queries on fields not in the heads need the whole message.
+    useHeads = all(f in HEAD_FIELDS for f in findArg1)
+
+    msgs = (msg for msg in segment.msgs \
+        if snapshot.matches(msg._head if useHeads else msg, findArg1) \
+            and all(m[msg._index] for m in masks))
+
+    if len(tests) > 0:
+        msgs = util.iterPassingMsgs(msgs, tests)
+
+    numResults = 0
+
+    for msg in msgs:
+        yield copy.deepcopy(msg) if copyMsgs else msg
+
+        numResults += 1
+        if numResults >= limit:
+            break
+
+def _openHeader():
+    """Map the header file into memory, if not done already.
+
+    Returns:
+        obj: Read only ``mmap`` of the header, or ``None`` if there is
+        no header yet.
+    """
+    global _header, _nextOpen
+
+    if _header is not None:
+        return _header
+
+    now = time.monotonic()
+    if now < _nextOpen:
+        return None
+    _nextOpen = now + OPEN_RETRY_INTERVAL
+
+    try:
+        with open(os.path.join(cfg.SHARED_SNAPSHOT_DIR, HEADER_FILE), 'rb') as f:
+            _header = mmap.mmap(f.fileno(), HEADER.size, \
+                access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    return _header
+
+def _current():
+    """Return the segment of the current generation, mapping it into
+    memory if it changed.
+
+    Returns:
+        obj: ``_Segment``, or ``None`` if there isn't one.
+    """
+    global _segment
+
+    header = _openHeader()
+    if header is None:
+        return None
+
+    generation = HEADER.unpack_from(header)[0]
+
+    segment = _segment
+    if (segment is not None) and (segment.generation == generation):
+        return segment
+
+    with _lock:
+        if (_segment is None) or (_segment.generation != generation):
+            try:
+                _segment = _Segment(_segmentPath(generation), _segment)
+            except (OSError, ValueError):
+                # The loader may have written newer ones and removed it.
+                return None
+
+        return _segment
+
+def _segmentPath(generation):
+    """Return the file name of a segment.
+
+    Args:
+        generation (int): Generation of the segment.
+
+    Returns:
+        str: Path of the segment.
+    """
+    return os.path.join(cfg.SHARED_SNAPSHOT_DIR, 'segment-{}'.format(generation))
+
+def startLoader():
+    """Start the loader process, if the shared snapshot is turned on.
+
+    Called from the ``when_ready`` hook in ``gunicorn.conf.py``. The
+    loader is a new Python process (not a fork, so it doesn't inherit
+    the caller's database connection or threads). It stops when the
+    calling process does.
+
+    Returns:
+        obj: ``multiprocessing.Process``, or ``None`` if not started.
+    """
+    if not (cfg.SNAPSHOT_ENABLED and cfg.SHARED_SNAPSHOT):
+        return None
+
+    process = multiprocessing.get_context('spawn').Process( \
+        target=runLoader, args=(os.getpid(),), name='fisb-rest-loader', \
+        daemon=True)
+    process.start()
+
+    return process
+
+def runLoader(parentPid=None):
+    """Body of the loader process.
+
+    Waits for the loader lock, then keeps a snapshot (using
+    ``snapshot``) and writes a new segment each time it changes.
+    Segments are only written while the snapshot is in sync with the
+    database, so workers stop using them (and ask Mongo) if it isn't.
+
+    Args:
+        parentPid (int): If not ``None``, return when the process
+            with this id is no longer the parent.
+    """
+    directory = cfg.SHARED_SNAPSHOT_DIR
+    os.makedirs(directory, exist_ok=True)
+
+    def parentIsAlive():
+        return (parentPid is None) or (os.getppid() == parentPid)
+
+    with open(os.path.join(directory, LOCK_FILE), 'a') as lockFile:
+        while True:
+            try:
+                fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                if not parentIsAlive():
+                    return
+                time.sleep(LOCK_RETRY_INTERVAL)
+
+        client = MongoClient(cfg.MONGO_URI, **util.mongoClientOptions())
+        snapshot.start(client.fisb)
+
+        header = _openHeaderForWrite(directory)
+        generation = HEADER.unpack_from(header)[0]
+        published = None
+        cache = {}
+
+        # Messages are encoded by utilities.encodeJson(), which needs
+        # an application. 'app.py' uses Flask's default JSON settings.
+        jsonApp = Flask(__name__)
+
+        while parentIsAlive():
+            time.sleep(cfg.SHARED_SNAPSHOT_INTERVAL)
+
+            age = snapshot.syncAge()
+            if (age is None) or (age >= cfg.SNAPSHOT_MAX_AGE):
+                continue
+
+            try:
+                snapshotGeneration, msgs = snapshot.sortedMsgs()
+                changed = snapshotGeneration != published
+
+                if changed:
+                    generation += 1
+                    with jsonApp.app_context():
+                        cache = _writeSegment(directory, generation, msgs, \
+                            cache)
+                    published = snapshotGeneration
+
+                HEADER.pack_into(header, 0, generation, time.time() - age)
+
+                if changed:
+                    _removeOld(directory, generation)
+
+            except Exception:
+                errlog.logError('shared snapshot')
+
+        snapshot.stop()
+        client.close()
+
+def _openHeaderForWrite(directory):
+    """Map the header file into memory for writing, creating it if
+    needed.
+
+    The file is never replaced, so workers can keep it mapped while
+    loaders come and go.
+
+    Args:
+        directory (str): ``cfg.SHARED_SNAPSHOT_DIR``.
+
+    Returns:
+        obj: Writable ``mmap`` of the header.
+    """
+    fd = os.open(os.path.join(directory, HEADER_FILE), os.O_RDWR | os.O_CREAT)
+
+    try:
+        if os.fstat(fd).st_size < HEADER.size:
+            os.ftruncate(fd, HEADER.size)
+
+        return mmap.mmap(fd, HEADER.size)
+
+    finally:
+        os.close(fd)
+
+def _encodeMsg(msg):
+    """Encode what a segment holds for one message.
+
+    Args:
+        msg (dict): Message from the snapshot. It is not altered.
+
+    Returns:
+        tuple: Head BSON, message BSON, encoded message, key, and
+        a list of ``(minx, miny, maxx, maxy, wkb)`` for each polygon.
+    """
+    doc = bson.encode(msg)
+    head = bson.encode({'fields': list(msg.keys()), \
+        'head': dict((k, msg[k]) for k in HEAD_FIELDS if k in msg)})
+
+    polys = []
+    if 'geojson' in msg:
+        try:
+            polys = [p.bounds + (shapely.to_wkb(p),) \
+                for p in spatialindex.polygons(msg)]
+        except Exception:
+            errlog.logError('shared snapshot polygons')
+
+    return head, doc, util.encodeFragment(copy.deepcopy(msg)), \
+        hashlib.sha1(doc).digest(), polys
+
+def _writeSegment(directory, generation, msgs, cache):
+    """Write a segment.
+
+    Args:
+        directory (str): ``cfg.SHARED_SNAPSHOT_DIR``.
+        generation (int): Generation of the segment.
+        msgs (list): Messages sorted by ``utilities.SORT_ORDER``.
+        cache (dict): Results of ``_encodeMsg()`` from the last
+            segment, keyed by ``_id``, ``digest``, and ``insert_time``.
+
+    Returns:
+        dict: Cache for the next segment.
+    """
+    newCache = {}
+    encoded = []
+
+    for msg in msgs:
+        key = (msg['_id'], msg.get('digest'), msg['insert_time'])
+        entry = cache.get(key)
+        if entry is None:
+            entry = _encodeMsg(msg)
+
+        newCache[key] = entry
+        encoded.append(entry)
+
+    table = numpy.zeros(len(encoded), MSG_DTYPE)
+    polys = numpy.zeros(sum(len(e[4]) for e in encoded), POLY_DTYPE)
+    blobs = []
+
+    offset = SEGMENT_HEADER.size + table.nbytes + polys.nbytes
+    numPolys = 0
+
+    for n, (head, doc, fragment, key, msgPolys) in enumerate(encoded):
+        table[n] = (offset, len(head), offset + len(head), len(doc), \
+            offset + len(head) + len(doc), len(fragment), len(msgPolys), key)
+        blobs.extend([head, doc, fragment])
+        offset += len(head) + len(doc) + len(fragment)
+
+        for minx, miny, maxx, maxy, wkb in msgPolys:
+            polys[numPolys] = (n, minx, miny, maxx, maxy, offset, len(wkb))
+            blobs.append(wkb)
+            offset += len(wkb)
+            numPolys += 1
+
+    path = _segmentPath(generation)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, generation, len(table), \
+            len(polys)))
+        f.write(table.tobytes())
+        f.write(polys.tobytes())
+        f.writelines(blobs)
+
+    os.rename(path + '.tmp', path)
+
+    return newCache
+
+def _removeOld(directory, generation):
+    """Remove segments older than the one before ``generation``.
+
+    Workers that still have one mapped can go on using it.
+
+    Args:
+        directory (str): ``cfg.SHARED_SNAPSHOT_DIR``.
+        generation (int): Current generation.
+    """
+    keep = ['segment-{}'.format(generation), \
+        'segment-{}'.format(generation - 1)]
+
+    for name in os.listdir(directory):
+        if name.startswith('segment-') and (name not in keep):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+if __name__ == "__main__":
+    runLoader()
@@ -0,0 +1,336 @@
+"""Log of slow Mongo queries, with their query plans.
+
+Each query ``utilities.findMsgs()`` and ``utilities.findOneMsg()`` (and
+their versions in ``asgi.py``) send to Mongo is timed. The time is
+the time spent waiting on Mongo, over all of the query's results. A
+query taking more than ``cfg.SLOW_QUERY_SECONDS`` is written to
+``cfg.SLOW_QUERY_FILENAME``, one JSON object per line, with:
+
+* ``route``: Route of the request, such as ``/notam-d/<id>``.
+* ``filter``, ``sort``, ``limit``, and ``projection`` of the query.
+* ``docs_examined``, ``keys_examined``, ``returned``, and
+  ``winning_plan``, from ``explain()``.
+* ``suppressed``: Slow queries not logged since the last one.
+
+So the log can't add to the load when Mongo is struggling, at most
+one query every ``cfg.SLOW_QUERY_LOG_INTERVAL`` seconds is logged by
+each process, and ``explain()`` is run (again) and the log written
+by a background thread, not by the request.
+
+``/debug/explain?route=/notam-d/KDEN`` returns the plan of any route
+(with its query string, URL encoded, if wanted) on demand. It is only
+answered for requests from the server itself (and not through a
+proxy that sets ``X-Forwarded-For``), and only if ``cfg.DEBUG_EXPLAIN``
+is ``True``. It is off by default, since making a plan runs the query.
+"""
+
+import contextvars
+import datetime
+import queue
+import threading
+import time
+
+import bson.json_util
+from flask import jsonify
+from flask import has_request_context
+from flask import request
+from pymongo import errors
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+import fisb_restConfig as cfg
+import utilities as util
+import breaker
+import errlog
+
+# Most slow queries waiting for the background thread.
+QUEUE_SIZE = 10
+
+# Addresses requests to '/debug/explain' may come from.
+LOCAL_ADDRESSES = ['127.0.0.1', '::1']
+
+# Headers added by proxies. A request with any of these didn't
+# really come from the server itself.
+PROXY_HEADERS = ['X-Forwarded-For', 'X-Real-IP', 'Forwarded']
+
+# Route of the request being answered by 'asgi.py'.
+_route = contextvars.ContextVar('slowquery_route', default=None)
+
+# When the last slow query was logged, and how many weren't since.
+_lastLogged = None
+_suppressed = 0
+_lock = threading.Lock()
+
+# Slow queries for the background thread, and the thread.
+_queue = queue.Queue(QUEUE_SIZE)
+_thread = None
+
+def isEnabled():
+    """Check if slow queries are logged.
+
+    Returns:
+        bool: ``True`` if ``cfg.SLOW_QUERY_SECONDS`` is more than 0.
+    """
+    return cfg.SLOW_QUERY_SECONDS > 0
+
+def setRoute(route):
+    """Set the route of the request being answered, for requests not
+    answered by Flask (``asgi.py``).
+
+    Args:
+        route (str): Route, such as ``'/metar/<id>'``.
+    """
+    _route.set(route)
+
+def currentRoute():
+    """Return the route of the request being answered.
+
+    Returns:
+        str: Route, or ``None`` if not known.
+    """
+    route = _route.get()
+    if (route is None) and has_request_context() and \
+            (request.url_rule is not None):
+        route = request.url_rule.rule
+
+    return route
+
+def timed(cursor, query, projection, sort, limit):
+    """Iterate over a Mongo cursor, and log the query if it was slow.
+
+    Args:
+        cursor (obj): Mongo cursor.
+        query (dict): Query of the cursor.
+        projection (dict): Projection of the cursor, or ``None``.
+        sort (list): Sort order of the cursor, or ``None``.
+        limit (int): Limit of the cursor, or ``None``.
+
+    Yields:
+        dict: Messages from ``cursor``.
+    """
+    iterator = iter(cursor)
+    seconds = 0.0
+
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                msg = next(iterator)
+            finally:
+                seconds += time.perf_counter() - start
+
+            yield msg
+
+    except StopIteration:
+        return
+
+    finally:
+        check(seconds, query, projection, sort, limit)
+
+def check(seconds, query, projection, sort, limit):
+    """Log a query if it was slow.
+
+    Args:
+        seconds (float): Time spent waiting on Mongo.
+        query (dict): Query.
+        projection (dict): Projection, or ``None``.
+        sort (list): Sort order, or ``None``.
+        limit (int): Limit, or ``None``.
+    """
+    global _lastLogged, _suppressed
+
+    if (not isEnabled()) or (seconds < cfg.SLOW_QUERY_SECONDS):
+        return
+
+    with _lock:
+        now = time.monotonic()
+        if (_lastLogged is not None) and \
+                (now - _lastLogged < cfg.SLOW_QUERY_LOG_INTERVAL):
+            _suppressed += 1
+            return
+
+        _lastLogged = now
+        suppressed = _suppressed
+        _suppressed = 0
+
+    entry = {'time': datetime.datetime.now(datetime.timezone.utc), \
+        'route': currentRoute(), 'seconds': seconds, 'filter': query, \
+        'sort': sort, 'limit': limit, 'projection': projection, \
+        'suppressed': suppressed}
+
+    _startThread()
+    try:
+        _queue.put_nowait(entry)
+    except queue.Full:
+        pass
+
+def explain(db, query, projection, sort, limit):
+    """Run ``explain()`` on a query.
+
+    The query is run, to get the numbers of documents and keys
+    examined.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+        query (dict): Query.
+        projection (dict): Projection, or ``None``.
+        sort (list): Sort order, or ``None``.
+        limit (int): Limit, or ``None``.
+
+    Returns:
+        dict: ``docs_examined``, ``keys_examined``, ``returned``,
+        ``milliseconds``, and ``winning_plan``.
+    """
+    find = {'find': 'MSG', 'filter': query}
+    if projection is not None:
+        find['projection'] = projection
+    if sort is not None:
+        find['sort'] = dict(sort)
+    if limit is not None:
+        find['limit'] = limit
+
+    options = {'verbosity': 'executionStats'}
+    if util.queryTimeoutMs() is not None:
+        options['maxTimeMS'] = util.queryTimeoutMs()
+
+    result = db.command('explain', find, **options)
+    stats = result.get('executionStats', {})
+
+    return {'docs_examined': stats.get('totalDocsExamined'), \
+        'keys_examined': stats.get('totalKeysExamined'), \
+        'returned': stats.get('nReturned'), \
+        'milliseconds': stats.get('executionTimeMillis'), \
+        'winning_plan': result.get('queryPlanner', {}).get('winningPlan')}
+
+def _startThread():
+    """Start the background thread if it isn't running (in this
+    process).
+    """
+    global _thread
+
+    with _lock:
+        if (_thread is None) or not _thread.is_alive():
+            _thread = threading.Thread(target=_runLog, daemon=True, \
+                name='slowquery')
+            _thread.start()
+
+def _runLog():
+    """Explain and log slow queries from ``_queue``.
+    """
+    while True:
+        entry = _queue.get()
+
+        try:
+            # Mongo isn't answering, so don't add to its load.
+            breaker.check()
+
+            entry.update(explain(util.dbConn, entry['filter'], \
+                entry['projection'], entry['sort'], entry['limit']))
+        except Exception as e:
+            entry['explain_error'] = str(e)
+
+        try:
+            with open(cfg.SLOW_QUERY_FILENAME, 'a') as f:
+                f.write(bson.json_util.dumps(entry) + '\n')
+        except Exception:
+            errlog.logError('slow query log')
+
+def _isLocal(request):
+    """Check if a request came from the server itself.
+
+    Args:
+        request (obj): Request object from Flask.
+
+    Returns:
+        bool: ``True`` if it came from a local address, and not
+        through a proxy.
+    """
+    return (request.remote_addr in LOCAL_ADDRESSES) and \
+        not any(h in request.headers for h in PROXY_HEADERS)
+
+def _error(errorString, status):
+    """Return a JSON error response.
+
+    Args:
+        errorString (str): Error message.
+        status (int): HTTP status.
+
+    Returns:
+        tuple: Response and status, for Flask.
+    """
+    return jsonify({'status': -1, 'error': errorString}), status
+
+def returnExplain(app, request):
+    """Return the query and plan of a route, for ``/debug/explain``.
+
+    The ``route=`` parameter is the path (and query string, if any)
+    of a request, such as ``/notam-d/KDEN`` or
+    ``/g-airmet?after=2021-06-25T11:00:00Z``. The query is built
+    as the route would build it. ``"python_tests"`` is the number of
+    ``lat=``/``lon=`` and ``high=``/``low=`` tests that would be done in
+    Python, after the query.
+
+    Args:
+        app (obj): Flask application.
+        request (obj): Request object from Flask.
+
+    Returns:
+        obj: JSON response.
+    """
+    if util.isDescribing():
+        return None
+
+    if (not cfg.DEBUG_EXPLAIN) or not _isLocal(request):
+        return _error('Not found.', 404)
+
+    route = request.args.get('route')
+    if route is None:
+        return _error('Need a route parameter.', 400)
+
+    path, _, queryString = route.partition('?')
+
+    described = util.describeRoute(app, path)
+    if (described is None) or \
+            (described[0] not in [util.ROUTE_ONE, util.ROUTE_MANY]):
+        return _error('Not a route that queries MSG.', 400)
+
+    kind, findArg1 = described
+
+    routeRequest = Request(EnvironBuilder(path=path, \
+        query_string=queryString).get_environ())
+    items = util.getStandardQueryItems(routeRequest)
+    if items[0]:
+        return _error(items[1], 400)
+
+    findArg1['insert_time'] = {'$gt': items[2]}
+    projection = None
+    tests = []
+    sort = util.SORT_ORDER
+    limit = items[3]
+
+    if kind == util.ROUTE_ONE:
+        field, ids = util.splitIds(findArg1)
+        if ids is None:
+            sort = None
+            limit = 1
+        else:
+            findArg1[field] = {'$in': ids}
+            limit = util.DEFAULT_LIMIT
+    else:
+        findArg1, projection, tests = util.buildMongoQuery(findArg1, \
+            util.queryFilters(items))
+        if len(tests) > 0:
+            limit = None
+
+    try:
+        plan = explain(util.dbConn, findArg1, projection, sort, limit)
+    except errors.PyMongoError as e:
+        return _error('explain() failed: {}'.format(e), 500)
+
+    result = {'status': 0, 'route': route, 'kind': kind, \
+        'filter': findArg1, 'sort': sort, 'limit': limit, \
+        'projection': projection, 'python_tests': len(tests)}
+    result.update(plan)
+
+    return app.response_class(bson.json_util.dumps(result, indent=2) + '\n', \
+        mimetype='application/json')
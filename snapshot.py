@@ -0,0 +1,575 @@
+"""In-memory snapshot of the ``MSG`` collection.
+
+The FIS-B data set is small (a few thousand live messages) and only
+changes a few times per second, so it can be kept in memory and
+queries answered without a round trip to Mongo.
+
+A background thread loads the whole ``MSG`` collection and then keeps
+it current. If Mongo is running as a replica set, a change stream is
+used. Otherwise, the collection is polled for messages with a newer
+``insert_time``, along with the list of ``_id`` values still present
+(to catch deleted messages).
+
+The snapshot is only used if it is *ready*: it has been loaded and
+has been confirmed to be in sync with the database within the last
+``cfg.SNAPSHOT_MAX_AGE`` seconds. If not, callers fall back to Mongo.
+"""
+
+import copy
+import datetime
+import threading
+import time
+
+from pymongo import errors
+
+import fisb_restConfig as cfg
+import utilities as util
+import sharedsnapshot
+import errlog
+
+# Mongo error code for 'The $changeStream stage is only supported
+# on replica sets'.
+CHANGE_STREAM_NOT_SUPPORTED = 40573
+
+# Query operators 'matches()' can evaluate.
+SUPPORTED_OPERATORS = ['$gt', '$gte', '$lt', '$lte', '$ne', '$in', '$exists']
+
+# Seconds to wait before trying to reload after an error.
+RETRY_INTERVAL = 5.0
+
+# Messages in the snapshot, keyed by '_id'.
+_msgs = {}
+
+# List of messages sorted by 'insert_time'. Rebuilt when needed.
+_sortedMsgs = []
+_sortedIsCurrent = False
+
+# Incremented each time the snapshot changes.
+_generation = 0
+
+_lock = threading.Lock()
+_thread = None
+_stopEvent = threading.Event()
+
+_loaded = False
+_lastSync = 0.0
+
+# True if queries are answered by 'sharedsnapshot'.
+_shared = False
+
+# Functions called with (operation, msg) whenever the snapshot changes.
+# 'operation' is one of 'upsert', 'delete', or 'reset'.
+_listeners = []
+
+class UnsupportedQuery(Exception):
+    """Raised when a query uses an operator the snapshot can't evaluate.
+    """
+    pass
+
+def start(db):
+    """Start the thread that loads and maintains the snapshot.
+
+    Does nothing if the thread is already running.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+    """
+    global _thread
+
+    if (_thread is not None) and _thread.is_alive():
+        return
+
+    _stopEvent.clear()
+    _thread = threading.Thread(target=_run, args=(db,), \
+        name='snapshot', daemon=True)
+    _thread.start()
+
+def stop(timeout=None):
+    """Stop the snapshot thread and mark the snapshot as not ready.
+
+    Args:
+        timeout (float): If not ``None``, wait up to this many seconds
+            for the thread to finish.
+    """
+    global _loaded
+
+    _stopEvent.set()
+    _loaded = False
+
+    if (timeout is not None) and (_thread is not None):
+        _thread.join(timeout)
+
+def useShared():
+    """Answer queries from the copy kept by the loader process of
+    ``sharedsnapshot``, instead of a copy kept by this process.
+
+    Called instead of ``start()`` when ``cfg.SHARED_SNAPSHOT`` is
+    ``True``. Listeners aren't called in this case.
+    """
+    global _shared
+
+    _shared = True
+
+def isReady():
+    """Check if the snapshot can be used to answer queries.
+
+    Returns:
+        bool: ``True`` if the snapshot is loaded and has been
+        in sync with the database within the last
+        ``cfg.SNAPSHOT_MAX_AGE`` seconds.
+    """
+    if _shared:
+        return sharedsnapshot.isReady()
+
+    return _loaded and \
+        ((time.monotonic() - _lastSync) < cfg.SNAPSHOT_MAX_AGE)
+
+def generation():
+    """Return the current generation of the snapshot.
+
+    The generation is incremented every time a message is added,
+    changed, or removed.
+
+    Returns:
+        int: Current generation.
+    """
+    return _generation
+
+def syncAge():
+    """Return how long ago the snapshot was known to match the database.
+
+    Returns:
+        float: Seconds, or ``None`` if the snapshot isn't loaded.
+    """
+    if not _loaded:
+        return None
+
+    return time.monotonic() - _lastSync
+
+def sortedMsgs():
+    """Return all messages in the snapshot.
+
+    Returns:
+        tuple: Tuple containing:
+
+        1. (int) Generation of the snapshot. Taken first, so the
+           messages are never older than it.
+        2. (list) Messages sorted by ``insert_time`` and ``_id``.
+           They must not be altered.
+    """
+    generation = _generation
+
+    return generation, _getSorted()
+
+def addListener(func):
+    """Register a function to be called when the snapshot changes.
+
+    The function is called as ``func(operation, msg)`` from the
+    snapshot thread. ``operation`` is ``'upsert'``, ``'delete'``, or
+    ``'reset'``. For ``'reset'`` (snapshot was reloaded from scratch)
+    ``msg`` is ``None`` and listeners should drop everything they hold.
+
+    Args:
+        func (function): Function to call.
+    """
+    if func not in _listeners:
+        _listeners.append(func)
+
+def find(findArg1, limit, tests=[], copyMsgs=True):
+    """Return messages matching ``findArg1``, sorted by ``insert_time``.
+
+    Messages are copied as they are returned and may be altered
+    by the caller. Since they are produced one at a time, the whole
+    result is never held in memory at once.
+
+    Args:
+        findArg1 (dict): Dictionary in the form of the
+            first argument to the ``find()`` call to Mongo.
+        limit (int): Maximum number of messages to return.
+        tests (list): Functions taking a message and returning
+            ``True`` if it should be returned. These are applied
+            before ``limit``, to batches of matching messages (see
+            ``utilities.iterPassingMsgs()``).
+        copyMsgs (bool): If ``False``, the messages in the snapshot
+            are returned instead of copies. The caller must not
+            alter them.
+
+    Returns:
+        obj: Iterator of matching messages, or ``None`` if the query
+        can't be answered from the snapshot.
+    """
+    if _shared:
+        return sharedsnapshot.find(findArg1, limit, tests, copyMsgs)
+
+    if not isSupported(findArg1):
+        return None
+
+    return _find(_getSorted(), findArg1, limit, tests, copyMsgs)
+
+def _find(msgs, findArg1, limit, tests, copyMsgs):
+    """Generator used by ``find()``.
+
+    Args:
+        msgs (list): Messages sorted by ``insert_time``.
+        findArg1 (dict): Mongo style query.
+        limit (int): Maximum number of messages to return.
+        tests (list): Extra test functions.
+        copyMsgs (bool): ``True`` to return copies of messages.
+
+    Yields:
+        dict: Matching messages.
+    """
+    numResults = 0
+
+    msgs = (msg for msg in msgs if matches(msg, findArg1))
+    if len(tests) > 0:
+        msgs = util.iterPassingMsgs(msgs, tests)
+
+    for msg in msgs:
+        yield copy.deepcopy(msg) if copyMsgs else msg
+
+        numResults += 1
+        if numResults >= limit:
+            break
+
+def findOne(findArg1):
+    """Return a single message matching ``findArg1``.
+
+    Args:
+        findArg1 (dict): Dictionary in the form of the
+            first argument to the ``find_one()`` call to Mongo.
+
+    Returns:
+        tuple: Tuple containing:
+
+        1. (bool) ``True`` if the query could be answered from the
+           snapshot. If ``False``, the caller must ask Mongo.
+        2. (dict) Copy of the matching message, or ``None`` if
+           there was no match.
+    """
+    msgs = find(findArg1, 1)
+
+    if msgs is None:
+        return False, None
+
+    return True, next(msgs, None)
+
+def isSupported(findArg1):
+    """Check if a query can be evaluated by ``matches()``.
+
+    Args:
+        findArg1 (dict): Mongo style query.
+
+    Returns:
+        bool: ``True`` if only supported operators are used.
+    """
+    for field, cond in findArg1.items():
+        if field.startswith('$') or ('.' in field):
+            return False
+
+        if isinstance(cond, dict):
+            for op in cond.keys():
+                if op not in SUPPORTED_OPERATORS:
+                    return False
+
+    return True
+
+def matches(msg, findArg1):
+    """Evaluate a Mongo style query against a single message.
+
+    Only the subset of the Mongo query language used by the
+    routes is supported: equality, ``$gt``, ``$gte``, ``$lt``,
+    ``$lte``, ``$ne``, ``$in``, and ``$exists``, all on top
+    level fields.
+
+    Args:
+        msg (dict): Message to check.
+        findArg1 (dict): Mongo style query.
+
+    Returns:
+        bool: ``True`` if the message matches the query.
+
+    Raises:
+        UnsupportedQuery: If the query uses anything else.
+    """
+    for field, cond in findArg1.items():
+        if field.startswith('$') or ('.' in field):
+            raise UnsupportedQuery(field)
+
+        if isinstance(cond, dict):
+            for op, arg in cond.items():
+                if not _matchOp(msg, field, op, arg):
+                    return False
+
+        elif (field not in msg) or (_normalize(msg[field]) != _normalize(cond)):
+            return False
+
+    return True
+
+def _matchOp(msg, field, op, arg):
+    """Evaluate a single query operator for ``matches()``.
+
+    Args:
+        msg (dict): Message to check.
+        field (str): Field name.
+        op (str): Operator, such as ``'$gt'``.
+        arg (obj): Argument of the operator.
+
+    Returns:
+        bool: ``True`` if the field satisfies the operator.
+
+    Raises:
+        UnsupportedQuery: If the operator isn't supported.
+    """
+    if op == '$exists':
+        return (field in msg) == bool(arg)
+
+    if op == '$ne':
+        return (field not in msg) or (_normalize(msg[field]) != _normalize(arg))
+
+    if op == '$in':
+        return (field in msg) and \
+            (_normalize(msg[field]) in [_normalize(x) for x in arg])
+
+    if op not in ['$gt', '$gte', '$lt', '$lte']:
+        raise UnsupportedQuery(op)
+
+    if field not in msg:
+        return False
+
+    value = _normalize(msg[field])
+    arg = _normalize(arg)
+
+    try:
+        if op == '$gt':
+            return value > arg
+        if op == '$gte':
+            return value >= arg
+        if op == '$lt':
+            return value < arg
+        return value <= arg
+
+    except TypeError:
+        # Mongo never matches values of different types.
+        return False
+
+def _normalize(value):
+    """Make datetimes comparable the way Mongo compares them.
+
+    Mongo treats datetimes without a timezone as UTC.
+
+    Args:
+        value (obj): Value to normalize.
+
+    Returns:
+        obj: ``value``, with naive datetimes made UTC aware.
+    """
+    if isinstance(value, datetime.datetime) and (value.tzinfo is None):
+        return value.replace(tzinfo=datetime.timezone.utc)
+
+    return value
+
+def _getSorted():
+    """Return the snapshot as a list sorted by ``insert_time``, then ``_id``
+    (the same order as ``utilities.SORT_ORDER``).
+
+    Returns:
+        list: Messages sorted by ``insert_time`` and ``_id``.
+    """
+    global _sortedMsgs, _sortedIsCurrent
+
+    with _lock:
+        if not _sortedIsCurrent:
+            _sortedMsgs = sorted(_msgs.values(), \
+                key=lambda m: (_normalize(m['insert_time']), str(m['_id'])))
+            _sortedIsCurrent = True
+
+        return _sortedMsgs
+
+def _upsert(msg):
+    """Add or replace a message in the snapshot.
+
+    Args:
+        msg (dict): Message from the database.
+    """
+    global _sortedIsCurrent, _generation
+
+    with _lock:
+        _msgs[msg['_id']] = msg
+        _sortedIsCurrent = False
+        _generation += 1
+
+    _notify('upsert', msg)
+
+def _delete(msgId):
+    """Remove a message from the snapshot.
+
+    Args:
+        msgId (obj): ``_id`` of the message to remove.
+    """
+    global _sortedIsCurrent, _generation
+
+    with _lock:
+        msg = _msgs.pop(msgId, None)
+        if msg is None:
+            return
+        _sortedIsCurrent = False
+        _generation += 1
+
+    _notify('delete', msg)
+
+def _notify(operation, msg):
+    """Call all listeners. Errors in listeners are logged and ignored.
+
+    Args:
+        operation (str): ``'upsert'``, ``'delete'``, or ``'reset'``.
+        msg (dict): Message that changed or ``None`` for ``'reset'``.
+    """
+    for func in _listeners:
+        try:
+            func(operation, msg)
+        except Exception:
+            errlog.logError('snapshot listener')
+
+def _loadAll(db):
+    """Replace the snapshot with the current contents of ``MSG``.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+    """
+    global _msgs, _sortedIsCurrent, _generation
+
+    msgs = {}
+    for msg in db.MSG.find({}):
+        msgs[msg['_id']] = msg
+
+    with _lock:
+        _msgs = msgs
+        _sortedIsCurrent = False
+        _generation += 1
+
+    _notify('reset', None)
+    for msg in msgs.values():
+        _notify('upsert', msg)
+
+def _markSynced():
+    """Record that the snapshot is known to match the database.
+    """
+    global _loaded, _lastSync
+
+    _lastSync = time.monotonic()
+    _loaded = True
+
+def _run(db):
+    """Body of the snapshot thread.
+
+    Tries to use a change stream. If the server doesn't support them,
+    polling is used instead. On any error the snapshot is marked as
+    not ready and reloaded after a short delay.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+    """
+    global _loaded
+
+    useChangeStream = True
+
+    while not _stopEvent.is_set():
+        try:
+            if useChangeStream:
+                _followChangeStream(db)
+            else:
+                _followByPolling(db)
+
+        except errors.OperationFailure as e:
+            _loaded = False
+            if e.code == CHANGE_STREAM_NOT_SUPPORTED:
+                useChangeStream = False
+                continue
+
+            errlog.logError('snapshot')
+            _stopEvent.wait(RETRY_INTERVAL)
+
+        except Exception:
+            _loaded = False
+            errlog.logError('snapshot')
+            _stopEvent.wait(RETRY_INTERVAL)
+
+def _followChangeStream(db):
+    """Load the snapshot and keep it current using a change stream.
+
+    The change stream is opened before the load, so no change
+    made during the load is lost.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+    """
+    global _loaded
+
+    with db.MSG.watch(full_document='updateLookup', \
+            max_await_time_ms=int(cfg.SNAPSHOT_POLL_INTERVAL * 1000)) as stream:
+        _loadAll(db)
+        _markSynced()
+
+        while stream.alive and not _stopEvent.is_set():
+            change = stream.try_next()
+
+            if change is not None:
+                op = change['operationType']
+
+                if op == 'delete':
+                    _delete(change['documentKey']['_id'])
+
+                elif op in ['insert', 'update', 'replace']:
+                    if change.get('fullDocument') is not None:
+                        _upsert(change['fullDocument'])
+                    else:
+                        # Document was removed before lookup
+                        _delete(change['documentKey']['_id'])
+
+                else:
+                    # 'drop', 'rename', 'invalidate', etc.
+                    _loaded = False
+                    return
+
+            _markSynced()
+
+def _followByPolling(db):
+    """Load the snapshot and keep it current by polling.
+
+    Every ``cfg.SNAPSHOT_POLL_INTERVAL`` seconds, messages with
+    an ``insert_time`` newer than any in the snapshot are fetched,
+    and messages no longer in the database are removed.
+
+    Args:
+        db (obj): Handle to the ``fisb`` database.
+    """
+    _loadAll(db)
+    _markSynced()
+
+    while not _stopEvent.wait(cfg.SNAPSHOT_POLL_INTERVAL):
+        with _lock:
+            times = [_normalize(m['insert_time']) for m in _msgs.values()]
+        newest = max(times) if len(times) > 0 else None
+
+        if newest is None:
+            cursor = db.MSG.find({})
+        else:
+            cursor = db.MSG.find({'insert_time': {'$gte': newest}})
+
+        for msg in cursor:
+            with _lock:
+                old = _msgs.get(msg['_id'])
+            if (old is not None) and (old['insert_time'] == msg['insert_time']) \
+                    and (old.get('digest') == msg.get('digest')):
+                continue
+            _upsert(msg)
+
+        liveIds = set(x['_id'] for x in db.MSG.find({}, {'_id': 1}))
+
+        with _lock:
+            deadIds = [k for k in _msgs.keys() if k not in liveIds]
+        for msgId in deadIds:
+            _delete(msgId)
+
+        _markSynced()
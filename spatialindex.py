@@ -0,0 +1,315 @@
+"""Spatial index of message polygons used for ``lat=``/``lon=`` queries.
+
+Building shapely polygons from the coordinate lists in each message
+is expensive, and used to be done for every message on every request.
+This module keeps the polygons of each message already built and
+prepared, keyed by the message's ``_id``. An entry is rebuilt only if
+the message's ``digest`` (or ``insert_time`` if there is no digest)
+changes.
+
+All polygons are also kept in an ``STRtree``, so a point query is a
+tree lookup followed by a few prepared ``contains()`` tests. The tree
+is rebuilt lazily the first time it is needed after the set of
+polygons changes. Messages read from a Mongo cursor are tested a batch
+at a time: the polygons of all messages in the batch not already
+answered by the tree are tested with one ``shapely.contains_xy()``
+call.
+
+Entries are added as messages are seen by queries, and if the
+in-memory snapshot is enabled, they are also added and removed as
+messages come and go in the database. Entries not seen for
+``cfg.SPATIAL_INDEX_MAX_IDLE`` seconds are dropped.
+"""
+
+import threading
+import time
+
+import numpy
+import shapely
+from shapely.geometry import Point
+from shapely.geometry import Polygon
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+import fisb_restConfig as cfg
+
+# Index entries, keyed by message '_id'. Each entry is a list of
+# [version, list of prepared polygons, time last seen].
+_entries = {}
+
+# STRtree of all polygons and, for each polygon in the tree,
+# [_id, version, prepared polygon] of the message it came from.
+_tree = None
+_treeKeys = []
+_treeIsCurrent = False
+
+_lock = threading.RLock()
+
+def _version(msg):
+    """Return the value used to tell if a message has changed.
+
+    Args:
+        msg (dict): Message.
+
+    Returns:
+        obj: ``digest`` field if present, else ``insert_time``.
+    """
+    if 'digest' in msg:
+        return msg['digest']
+
+    return msg.get('insert_time')
+
+def polygons(msg):
+    """Build shapely polygons for all polygon features of a message.
+
+    Args:
+        msg (dict): Message with a ``geojson`` field.
+
+    Returns:
+        list: List of shapely polygons. Empty if the message has
+        no polygons.
+    """
+    polys = []
+
+    for x in msg['geojson']['features']:
+        if x['geometry']['type'] != 'Polygon':
+            continue
+
+        coords = x['geometry']['coordinates']
+        shapelyCoords = [(xy[0], xy[1]) for xy in coords]
+
+        polys.append(Polygon(shapelyCoords))
+
+    return polys
+
+def _buildPolygons(msg):
+    """Build prepared polygons for all polygon features of a message.
+
+    Args:
+        msg (dict): Message with a ``geojson`` field.
+
+    Returns:
+        list: List of prepared shapely polygons. Empty if the
+        message has no polygons.
+    """
+    return [prep(p) for p in polygons(msg)]
+
+def update(msg):
+    """Make sure the index entry for a message is current.
+
+    Args:
+        msg (dict): Message. Must have a ``geojson`` field.
+
+    Returns:
+        list: Entry for the message: ``[version, prepared polygons,
+        time last seen]``.
+    """
+    global _treeIsCurrent
+
+    msgId = msg['_id']
+    version = _version(msg)
+
+    with _lock:
+        entry = _entries.get(msgId)
+
+        if (entry is None) or (entry[0] != version):
+            entry = [version, _buildPolygons(msg), 0.0]
+            _entries[msgId] = entry
+            _treeIsCurrent = False
+
+        entry[2] = time.monotonic()
+
+        return entry
+
+def remove(msgId):
+    """Remove a message from the index.
+
+    Args:
+        msgId (obj): ``_id`` of message to remove.
+    """
+    global _treeIsCurrent
+
+    with _lock:
+        if _entries.pop(msgId, None) is not None:
+            _treeIsCurrent = False
+
+def clear():
+    """Remove all entries from the index.
+    """
+    global _treeIsCurrent
+
+    with _lock:
+        _entries.clear()
+        _treeIsCurrent = False
+
+def snapshotListener(operation, msg):
+    """Keep the index in step with the in-memory snapshot.
+
+    Registered with ``snapshot.addListener()``.
+
+    Args:
+        operation (str): ``'upsert'``, ``'delete'``, or ``'reset'``.
+        msg (dict): Message that changed, or ``None`` for ``'reset'``.
+    """
+    if operation == 'reset':
+        clear()
+    elif operation == 'delete':
+        remove(msg['_id'])
+    elif 'geojson' in msg:
+        update(msg)
+    else:
+        remove(msg['_id'])
+
+def _getTree():
+    """Return the STRtree and its keys, rebuilding them if needed.
+
+    Stale entries are dropped before a rebuild.
+
+    Returns:
+        tuple: Tuple containing:
+
+        1. (obj) ``STRtree`` of all polygons, or ``None`` if there
+           are no polygons.
+        2. (list) ``[_id, version, prepared polygon]`` for each
+           polygon in the tree.
+    """
+    global _tree, _treeKeys, _treeIsCurrent
+
+    with _lock:
+        if _treeIsCurrent:
+            return _tree, _treeKeys
+
+        oldest = time.monotonic() - cfg.SPATIAL_INDEX_MAX_IDLE
+        for msgId in [k for k, v in _entries.items() if v[2] < oldest]:
+            del _entries[msgId]
+
+        geoms = []
+        keys = []
+        for msgId, entry in _entries.items():
+            for poly in entry[1]:
+                geoms.append(poly.context)
+                keys.append([msgId, entry[0], poly])
+
+        _tree = STRtree(geoms) if len(geoms) > 0 else None
+        _treeKeys = keys
+        _treeIsCurrent = True
+
+        return _tree, _treeKeys
+
+def pointTest(lat, lon):
+    """Return a function that tests if a message contains a point.
+
+    The STRtree is searched once when this is called. The returned
+    function then only needs a set lookup for messages that were in
+    the tree. Messages not yet in the index are added and tested
+    directly.
+
+    The returned function follows the rules of
+    ``utilities.checkIfInPolygon()``: messages without geometry,
+    or without polygons, always pass. It has a ``batch`` attribute:
+    a function taking a list of messages and returning a NumPy
+    array of ``True``/``False``, one per message, with the same
+    meaning (see ``utilities.passingMsgs()``), and a ``point``
+    attribute of ``(lat, lon)`` (used by ``sharedsnapshot``).
+
+    Args:
+        lat (float): Latitude.
+        lon (float): Longitude.
+
+    Returns:
+        function: Function taking a message and returning ``True``
+        if the message passes.
+    """
+    point = Point(lon, lat)
+
+    with _lock:
+        tree, keys = _getTree()
+        inTree = set((k[0], k[1]) for k in keys)
+        hits = set()
+
+        if tree is not None:
+            for i in tree.query(point):
+                msgId, version, poly = keys[i]
+                if poly.contains(point):
+                    hits.add((msgId, version))
+
+    def test(msg):
+        if 'geojson' not in msg:
+            return True
+
+        entry = update(msg)
+        polys = entry[1]
+        if len(polys) == 0:
+            return True
+
+        key = (msg['_id'], entry[0])
+        if key in hits:
+            return True
+        if key in inTree:
+            return False
+
+        return any(p.contains(point) for p in polys)
+
+    def testBatch(msgs):
+        passed = numpy.ones(len(msgs), dtype=bool)
+
+        # Polygons still to be tested, and the index in msgs of
+        # the message each came from.
+        geoms = []
+        owners = []
+
+        for n, msg in enumerate(msgs):
+            if 'geojson' not in msg:
+                continue
+
+            entry = update(msg)
+            polys = entry[1]
+            if len(polys) == 0:
+                continue
+
+            key = (msg['_id'], entry[0])
+            if key in hits:
+                continue
+
+            passed[n] = False
+            if key in inTree:
+                continue
+
+            geoms.extend(p.context for p in polys)
+            owners.extend([n] * len(polys))
+
+        if len(geoms) > 0:
+            # Polygons were prepared by prep(), so this uses them.
+            inside = shapely.contains_xy(numpy.array(geoms, dtype=object), \
+                lon, lat)
+            passed[numpy.array(owners)[inside]] = True
+
+        return passed
+
+    test.batch = testBatch
+    test.point = (lat, lon)
+
+    return test
+
+def contains(msg, lat, lon):
+    """Test a single message against a point.
+
+    Uses the prepared polygons for the message, but not the tree.
+
+    Args:
+        msg (dict): Message to be checked.
+        lat (float): Latitude.
+        lon (float): Longitude.
+
+    Returns:
+        bool: Same as ``utilities.checkIfInPolygon()``.
+    """
+    if 'geojson' not in msg:
+        return True
+
+    polys = update(msg)[1]
+    if len(polys) == 0:
+        return True
+
+    point = Point(lon, lat)
+    return any(p.contains(point) for p in polys)
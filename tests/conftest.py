@@ -0,0 +1,10 @@
+"""Let tests import the server's modules from the ``fisb-rest`` directory.
+
+Nothing here needs Mongo: importing ``utilities`` makes a client, but
+the driver doesn't connect until a query is made.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,86 @@
+"""Tests of ``ETag`` and ``If-None-Match`` handling in ``httpcache``.
+"""
+
+import datetime
+
+import pytest
+from flask import Response
+from flask import request
+
+from app import app
+import httpcache
+
+T0 = datetime.datetime(2026, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+
+MSGS = [{'_id': 'METAR-KDEN', 'digest': 'a1', 'insert_time': T0}, \
+    {'_id': 'METAR-KIND', 'digest': 'b2', \
+    'insert_time': T0 + datetime.timedelta(seconds=30)}]
+
+def etagOf(msgs, variant='many-json', params=()):
+    """Return the tag of a list of messages.
+
+    Args:
+        msgs (list): Messages.
+        variant (str): Name of the representation.
+        params (tuple): Request parameters.
+
+    Returns:
+        str: Tag.
+    """
+    builder = httpcache.EtagBuilder(variant, params)
+    for msg in msgs:
+        builder.add(msg)
+
+    return builder.etag()
+
+def test_etagIsStable():
+    assert etagOf(MSGS) == etagOf([dict(m) for m in MSGS])
+
+def test_etagCountAndNewest():
+    count, newest, _ = etagOf(MSGS).split('-')
+
+    assert count == '2'
+    assert int(newest) == int(MSGS[1]['insert_time'].timestamp() * 1000000)
+
+@pytest.mark.parametrize('other', [
+    etagOf(MSGS, variant='many-ndjson'),
+    etagOf(MSGS, params=('after',)),
+    etagOf(MSGS[:1]),
+    etagOf([MSGS[0], dict(MSGS[1], digest='c3')]),
+    etagOf([MSGS[1], MSGS[0]]),
+    ])
+def test_etagDiffers(other):
+    assert etagOf(MSGS) != other
+
+def test_setHeaders():
+    response = httpcache.setHeaders(Response('x'), 'abc', 60)
+    assert response.headers['ETag'] == '"abc"'
+    assert response.headers['Cache-Control'] == 'public, max-age=60'
+
+    # Streamed responses are sent without a tag.
+    response = httpcache.setHeaders(Response('x'), None, 0)
+    assert 'ETag' not in response.headers
+    assert response.headers['Cache-Control'] == 'no-cache'
+
+@pytest.mark.parametrize('header, expected', [
+    (None, False),
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"abc-gzip"', True),
+    ('"other", "abc-br"', True),
+    ('"abcd"', False),
+    ('"abc-zip"', False),
+    ])
+def test_isNotModified(header, expected):
+    headers = {} if header is None else {'If-None-Match': header}
+
+    with app.test_request_context('/metar', headers=headers):
+        assert httpcache.isNotModified(request, 'abc') == expected
+
+def test_notModified():
+    response = httpcache.notModified('abc', 30)
+
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    assert response.headers['ETag'] == '"abc"'
+    assert response.headers['Cache-Control'] == 'public, max-age=30'
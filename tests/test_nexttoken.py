@@ -0,0 +1,91 @@
+"""Tests of ``next=`` tokens: ``makeNextToken()``, ``parseNextToken()``,
+``getNextQueryItem()``, and ``startAfterKey()``.
+"""
+
+import base64
+import datetime
+
+import bson
+import pytest
+from flask import request
+
+from app import app
+import utilities as util
+
+T0 = datetime.datetime(2026, 1, 2, 3, 4, 5, 678000, \
+    tzinfo=datetime.timezone.utc)
+
+def makeToken(doc):
+    """Encode any document the way ``makeNextToken()`` does.
+
+    Args:
+        doc (dict): Document.
+
+    Returns:
+        str: Token.
+    """
+    return base64.urlsafe_b64encode(bson.encode(doc)).decode('ascii') \
+        .rstrip('=')
+
+def test_roundTrip():
+    token = util.makeNextToken({'_id': 'METAR-KDEN', 'insert_time': T0})
+
+    assert '=' not in token
+    assert util.parseNextToken(token) == (T0, 'METAR-KDEN')
+
+@pytest.mark.parametrize('doc', [
+    {'t': '2026-01-02T03:04:05Z', 'i': 'METAR-KDEN'},
+    {'t': T0, 'i': 12},
+    {'t': T0, 'i': {'$gt': ''}},
+    {'t': 5, 'i': 'METAR-KDEN'},
+    ])
+def test_badFieldTypes(doc):
+    with pytest.raises(ValueError):
+        util.parseNextToken(makeToken(doc))
+
+@pytest.mark.parametrize('token', ['', 'not a token', makeToken({'t': T0})])
+def test_badTokens(token):
+    with pytest.raises(Exception):
+        util.parseNextToken(token)
+
+def test_getNextQueryItem():
+    bad = makeToken({'t': T0, 'i': 12})
+    with app.test_request_context('/metar?next=' + bad):
+        assert util.getNextQueryItem(request) == \
+            (True, 'Bad next parameter.', None)
+
+    good = util.makeNextToken({'_id': 'A', 'insert_time': T0})
+    with app.test_request_context('/metar?next=' + good):
+        assert util.getNextQueryItem(request) == (False, '', (T0, 'A'))
+
+def test_startAfterKeyAlone():
+    findArg1 = {'type': 'METAR'}
+    filters = []
+    util.startAfterKey(findArg1, filters, (T0, 'METAR-KDEN'))
+
+    assert findArg1['insert_time'] == {'$gte': T0}
+    assert len(filters) == 1
+
+    test, query = filters[0]
+    assert query() == {'$or': [{'insert_time': {'$gt': T0}}, \
+        {'_id': {'$gt': 'METAR-KDEN'}}]}
+
+    later = T0 + datetime.timedelta(seconds=1)
+    assert test({'_id': 'METAR-KAAA', 'insert_time': later})
+    assert test({'_id': 'METAR-KXYZ', 'insert_time': T0})
+    assert not test({'_id': 'METAR-KDEN', 'insert_time': T0})
+    assert not test({'_id': 'METAR-KAAA', 'insert_time': T0})
+
+def test_startAfterKeyEarlierAfter():
+    earlier = T0 - datetime.timedelta(minutes=5)
+    findArg1 = {'insert_time': {'$gt': earlier}}
+    util.startAfterKey(findArg1, [], (T0, 'METAR-KDEN'))
+
+    assert findArg1['insert_time'] == {'$gte': T0}
+
+def test_startAfterKeyLaterAfter():
+    later = T0 + datetime.timedelta(minutes=5)
+    findArg1 = {'insert_time': {'$gt': later}}
+    util.startAfterKey(findArg1, [], (T0, 'METAR-KDEN'))
+
+    assert findArg1['insert_time'] == {'$gt': later}
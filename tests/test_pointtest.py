@@ -0,0 +1,149 @@
+"""Tests of ``lat=``/``lon=`` point tests: ``spatialindex`` (one message
+at a time and a batch at a time) and the query from ``geoindex``.
+"""
+
+import datetime
+import os
+
+import pytest
+
+import fisb_restConfig as cfg
+import geoindex
+import spatialindex
+import utilities as util
+
+T0 = datetime.datetime(2026, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+
+def square(msgId, lon, lat, size=1.0, digest='d1'):
+    """Make a message with one square polygon.
+
+    Args:
+        msgId (str): ``_id``.
+        lon (float): Longitude of the south west corner.
+        lat (float): Latitude of the south west corner.
+        size (float): Length of a side in degrees.
+        digest (str): ``digest``.
+
+    Returns:
+        dict: Message.
+    """
+    coords = [[lon, lat], [lon + size, lat], [lon + size, lat + size], \
+        [lon, lat + size], [lon, lat]]
+
+    return {'_id': msgId, 'digest': digest, 'insert_time': T0, \
+        'geojson': {'features': [{'geometry': {'type': 'Polygon', \
+        'coordinates': coords}}]}}
+
+@pytest.fixture(autouse=True)
+def clearIndex():
+    spatialindex.clear()
+    yield
+    spatialindex.clear()
+
+def sampleMsgs():
+    """Return messages covering each case of ``checkIfInPolygon()``.
+
+    Returns:
+        list: Messages.
+    """
+    point = {'_id': 'POINT', 'insert_time': T0, 'geojson': {'features': \
+        [{'geometry': {'type': 'Point', 'coordinates': [-100.5, 40.5]}}]}}
+
+    return [square('IN', -101, 40), square('OUT', -90, 30), \
+        {'_id': 'NOGEO', 'insert_time': T0}, point, \
+        square('BIG', -110, 35, 20)]
+
+EXPECTED = {'IN': True, 'OUT': False, 'NOGEO': True, 'POINT': True, \
+    'BIG': True}
+
+def test_contains():
+    for msg in sampleMsgs():
+        assert util.checkIfInPolygon(msg, 40.5, -100.5) == \
+            EXPECTED[msg['_id']], msg['_id']
+
+@pytest.mark.parametrize('warm', [False, True])
+def test_singleAndBatchAgree(warm):
+    msgs = sampleMsgs()
+
+    if warm:
+        # Put the polygons in the tree before the test is made.
+        for msg in msgs:
+            if 'geojson' in msg:
+                spatialindex.update(msg)
+
+    test = spatialindex.pointTest(40.5, -100.5)
+
+    assert [test(msg) for msg in msgs] == \
+        [EXPECTED[msg['_id']] for msg in msgs]
+    assert list(test.batch(msgs)) == [EXPECTED[msg['_id']] for msg in msgs]
+
+def test_changedMessage():
+    spatialindex.update(square('MOVED', -101, 40))
+    test = spatialindex.pointTest(40.5, -100.5)
+
+    moved = square('MOVED', -90, 30, digest='d2')
+    assert not test(moved)
+    assert not test.batch([moved])[0]
+
+def test_passingMsgs():
+    msgs = sampleMsgs()
+    tests = [spatialindex.pointTest(40.5, -100.5)]
+
+    assert [m['_id'] for m in util.passingMsgs(msgs, tests)] == \
+        ['IN', 'NOGEO', 'POINT', 'BIG']
+
+def test_toGeoJsonPolygon():
+    ring = [[0, 0], [1, 0], [1, 1]]
+
+    assert geoindex.toGeoJsonPolygon(ring) == {'type': 'Polygon', \
+        'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 0]]]}
+    assert geoindex.toGeoJsonPolygon(ring + [[0, 0]]) == \
+        geoindex.toGeoJsonPolygon(ring)
+    assert geoindex.toGeoJsonPolygon([[0, 0], [1, 1]]) is None
+
+class FakeCollection(object):
+    """Stands in for ``MSG_GEO``, answering ``distinct()``.
+    """
+    def __init__(self, msgIds):
+        self.msgIds = msgIds
+        self.queries = []
+
+    def distinct(self, key, query):
+        self.queries.append((key, query))
+        return self.msgIds
+
+class FakeDb(object):
+    """Stands in for the ``fisb`` database.
+    """
+    def __init__(self, msgIds):
+        self.MSG_GEO = FakeCollection(msgIds)
+
+@pytest.fixture
+def geoState(monkeypatch):
+    # Act as if the sync thread was already started in this process.
+    monkeypatch.setattr(geoindex, '_startPid', os.getpid())
+    monkeypatch.setattr(geoindex, '_ready', False)
+    monkeypatch.setattr(geoindex, '_highWater', None)
+
+def test_pointQueryNotReady(geoState):
+    assert geoindex.pointQuery(FakeDb([]), 40.5, -100.5) is None
+
+def test_pointQuery(geoState, monkeypatch):
+    monkeypatch.setattr(geoindex, '_ready', True)
+    monkeypatch.setattr(geoindex, '_highWater', T0)
+    db = FakeDb(['IN', 'BIG'])
+
+    query = geoindex.pointQuery(db, 40.5, -100.5)
+
+    key, geoQuery = db.MSG_GEO.queries[0]
+    assert key == 'msg_id'
+    assert geoQuery['$or'][0]['geometry']['$geoIntersects']['$geometry'] \
+        == {'type': 'Point', 'coordinates': [-100.5, 40.5]}
+
+    # Messages written within GEO_SYNC_LAG of the newest synced one
+    # may not be in MSG_GEO yet, so they always match.
+    lag = T0 - datetime.timedelta(seconds=cfg.GEO_SYNC_LAG)
+    assert query == {'$or': [ \
+        {'geojson.features.geometry.type': {'$ne': 'Polygon'}}, \
+        {'_id': {'$in': ['IN', 'BIG']}}, \
+        {'insert_time': {'$gt': lag}}]}
@@ -2,16 +2,44 @@ from pymongo import MongoClient
 from pymongo import errors
 from flask import request
 from flask import jsonify
-from shapely.geometry import Polygon
-from shapely.geometry import Point
+from flask import current_app
+from flask import Request
+from flask import Response
+from flask import stream_with_context
 
 import fisb_restConfig as cfg
 import utilities as util
+import snapshot
+import sharedsnapshot
+import spatialindex
+import geoindex
+import fragcache
+import httpcache
+import coalesce
+import lastgood
+import breaker
+import slowquery
+import notifier
+import metrics
+import time
+import threading
+import datetime
 import dateutil.parser
+import copy
+import base64
+import itertools
+import bson
+from bson.codec_options import CodecOptions
 
 DEFAULT_LIMIT = 10000
 DEFAULT_AFTER = "2004-01-01T00:00:00Z"
 
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# Order of messages returned by findMsgs(). '_id' makes the order of
+# messages with the same 'insert_time' stable, for 'next' tokens.
+SORT_ORDER = [('insert_time', 1), ('_id', 1)]
+
 # Map fisb-decode CRL names to FIS-B Rest names
 CRL_MAP = { 'CRL_8':  'CRL_NOTAM_TFR', \
             'CRL_11': 'CRL_AIRMET', \
@@ -21,8 +49,29 @@ CRL_MAP = { 'CRL_8':  'CRL_NOTAM_TFR', \
             'CRL_16': 'CRL_NOTAM_TRA', \
             'CRL_17': 'CRL_NOTAM_TMOA'}
 
+# Fields holding the id of single object routes, which may be a
+# comma separated list of ids.
+ID_FIELDS = ['unique_name', 'station']
+
+# Kinds of route, as returned by describeRoute().
+ROUTE_ONE = 'ONE'
+ROUTE_MANY = 'MANY'
+ROUTE_STATIC_ONE = 'STATIC_ONE'
+ROUTE_STATIC_MANY = 'STATIC_MANY'
+ROUTE_STREAM = 'STREAM'
+
 # Handle to fisb database. Access elsewhere as util.dbConn
 dbConn = None
+_client = None
+
+# Set if the connection was closed by beforeFork().
+_reconnectAfterFork = False
+
+# Seconds to wait for background threads to stop before forking.
+FORK_STOP_TIMEOUT = 5.0
+
+# Set while describeRoute() is running.
+_describing = threading.local()
 
 # Create database connection to mongo
 def createDbConn():
@@ -30,12 +79,396 @@ def createDbConn():
 
     Fails if unable to connect to database.
     """
-    global dbConn
+    global dbConn, _client
     
-    client = MongoClient(cfg.MONGO_URI, tz_aware=True)
+    _client = MongoClient(cfg.MONGO_URI, **mongoClientOptions())
 
     # Use the 'fisb' database and possibly location database
-    dbConn = client.fisb
+    dbConn = _client.fisb
+
+    if cfg.SNAPSHOT_ENABLED and cfg.SHARED_SNAPSHOT:
+        snapshot.useShared()
+    elif cfg.SNAPSHOT_ENABLED:
+        snapshot.addListener(spatialindex.snapshotListener)
+        snapshot.start(dbConn)
+
+def mongoClientOptions():
+    """Return the options used to create Mongo clients.
+
+    Returns:
+        dict: Keyword arguments for ``MongoClient()`` (or
+        ``AsyncMongoClient()``) from the ``MONGO_`` settings in
+        ``fisb_restConfig.py``.
+    """
+    return {'tz_aware': True, \
+        'maxPoolSize': cfg.MONGO_MAX_POOL_SIZE, \
+        'serverSelectionTimeoutMS': int(cfg.MONGO_SERVER_SELECTION_TIMEOUT * 1000), \
+        'socketTimeoutMS': int(cfg.MONGO_SOCKET_TIMEOUT * 1000)}
+
+def queryTimeoutMs():
+    """Return the ``maxTimeMS`` to use for queries made by requests.
+
+    Returns:
+        int: Milliseconds, or ``None`` if there is no limit.
+    """
+    if not cfg.MONGO_QUERY_TIMEOUT:
+        return None
+
+    return int(cfg.MONGO_QUERY_TIMEOUT * 1000)
+
+def closeDbConn():
+    """Stop the in-memory snapshot (if running) and close the
+    database connection.
+    """
+    global dbConn, _client
+
+    if _client is None:
+        return
+
+    snapshot.stop(FORK_STOP_TIMEOUT)
+    _client.close()
+
+    _client = None
+    dbConn = None
+
+def beforeFork():
+    """Close the database connection before gunicorn forks a worker.
+
+    Called from the ``pre_fork`` hook in ``gunicorn.conf.py``. Mongo
+    clients (and the threads that go with them) can't be shared with
+    a forked process, so when the application is preloaded, the
+    connection made at import time is closed here and made again
+    in each worker by ``afterFork()``.
+    """
+    global _reconnectAfterFork
+
+    if _client is not None:
+        closeDbConn()
+        _reconnectAfterFork = True
+
+def afterFork():
+    """Connect to the database in a newly forked gunicorn worker.
+
+    Called from the ``post_fork`` hook in ``gunicorn.conf.py``. Does
+    nothing unless ``beforeFork()`` closed a connection (if the
+    application isn't preloaded, each worker connects when it imports
+    ``app.py``).
+    """
+    if _reconnectAfterFork:
+        createDbConn()
+
+def describeRoute(app, path):
+    """Find out what query a route makes, without making it.
+
+    The route's view function is called, but ``returnOne()``,
+    ``returnMany()``, and the other ``return`` functions give back
+    a description of the query instead of answering it.
+
+    Args:
+        app (obj): Flask application.
+        path (str): Path part of a URL, such as ``'/metar/KIND'``.
+
+    Returns:
+        tuple: Tuple containing the kind of route (``ROUTE_ONE``,
+        ``ROUTE_MANY``, etc.) and the route's ``findArg1``. ``None`` if
+        the path doesn't match a route, or the route doesn't make a
+        query (such as ``/``).
+    """
+    try:
+        endpoint, args = app.url_map.bind('localhost').match(path)
+    except Exception:
+        return None
+
+    _describing.active = True
+    try:
+        described = app.view_functions[endpoint](**args)
+    except Exception:
+        described = None
+    finally:
+        _describing.active = False
+
+    if isinstance(described, tuple) and (len(described) == 2) and \
+            (described[0] in [ROUTE_ONE, ROUTE_MANY, ROUTE_STATIC_ONE, \
+            ROUTE_STATIC_MANY, ROUTE_STREAM]):
+        return described
+
+    return None
+
+def isDescribing():
+    """Check if ``describeRoute()`` is running.
+
+    Returns:
+        bool: ``True`` if route functions should describe their query
+        rather than answer it.
+    """
+    return getattr(_describing, 'active', False)
+
+def findMsgs(findArg1, limit, filters=[], copyMsgs=True, keysOnly=False):
+    """Find messages in the ``MSG`` collection sorted by ``SORT_ORDER``.
+
+    If the in-memory snapshot is enabled and ready, it is used.
+    Otherwise, Mongo is queried (unless the circuit breaker is open,
+    see ``breaker``).
+
+    ``filters`` are extra conditions from the query string, such as
+    the ``lat=``/``lon=`` test. Each is a tuple of a function that tests
+    a message in Python, and either ``None`` or a function that returns
+    an equivalent Mongo query (or ``None`` if it can't). Filters are
+    done in Mongo where possible and in Python otherwise. Either way,
+    ``limit`` is applied after all filters.
+
+    Args:
+        findArg1 (dict): Dictionary to be used as the
+            first argument to the ``find()`` call to Mongo.
+        limit (int): Maximum number of messages to return.
+        filters (list): List of filters (see above).
+        copyMsgs (bool): If ``False``, messages from the snapshot are
+            not copied, and must not be altered by the caller.
+        keysOnly (bool): If ``True``, messages from Mongo may only
+            contain ``_id``, ``insert_time``, and ``digest``.
+
+    Returns:
+        obj: Iterable of messages (a generator or Mongo cursor).
+
+    Raises:
+        breaker.OpenError: If Mongo would be queried and the circuit
+        breaker is open.
+    """
+    if snapshot.isReady():
+        tests = [f[0] for f in filters]
+
+        msgs = snapshot.find(findArg1, limit, tests, copyMsgs)
+        if msgs is not None:
+            if metrics.isActive() and (len(tests) == 0):
+                msgs = metrics.counted(msgs, 'documents_scanned')
+            return msgs
+
+    findArg1, projection, tests = buildMongoQuery(findArg1, filters, \
+        keysOnly)
+
+    breaker.check()
+
+    cursor = dbConn.MSG.find(findArg1, projection).sort(SORT_ORDER) \
+        .max_time_ms(queryTimeoutMs())
+
+    if len(tests) == 0:
+        cursor = cursor.limit(limit)
+        if metrics.isActive():
+            cursor = metrics.timedCursor(cursor, True)
+        if slowquery.isEnabled():
+            cursor = slowquery.timed(cursor, findArg1, projection, \
+                SORT_ORDER, limit)
+        if breaker.isEnabled():
+            cursor = breaker.guarded(cursor)
+        return cursor
+
+    if slowquery.isEnabled():
+        cursor = slowquery.timed(cursor, findArg1, projection, SORT_ORDER, \
+            None)
+    if breaker.isEnabled():
+        cursor = breaker.guarded(cursor)
+
+    return filterMsgs(cursor, tests, limit)
+
+def buildMongoQuery(findArg1, filters, keysOnly=False):
+    """Build the Mongo query ``findMsgs()`` makes.
+
+    Args:
+        findArg1 (dict): Query for the route.
+        filters (list): Filters (see ``findMsgs()``).
+        keysOnly (bool): If ``True``, only ask for the fields needed
+            for keys.
+
+    Returns:
+        tuple: Tuple containing:
+
+        1. (dict) Query, with the filters that can be done in Mongo.
+        2. (dict) Projection, or ``None`` for all fields.
+        3. (list) Tests for the filters that must be done in Python.
+    """
+    queries = [findArg1]
+    tests = []
+
+    for test, mongoQuery in filters:
+        query = mongoQuery() if mongoQuery is not None else None
+
+        if query is None:
+            tests.append(test)
+        else:
+            queries.append(query)
+
+    if len(queries) > 1:
+        findArg1 = {'$and': queries}
+
+    projection = None
+    if keysOnly:
+        projection = {'insert_time': 1, 'digest': 1}
+        if len(tests) > 0:
+            projection['geojson'] = 1
+
+    return findArg1, projection, tests
+
+def filterMsgs(cursor, tests, limit):
+    """Return messages from a cursor that pass all tests.
+
+    The tests are run on batches of messages by ``iterPassingMsgs()``.
+
+    Args:
+        cursor (obj): Mongo cursor.
+        tests (list): Functions taking a message and returning
+            ``True`` if it should be returned.
+        limit (int): Maximum number of messages to return.
+
+    Yields:
+        dict: Messages passing all tests.
+    """
+    numResults = 0
+
+    msgs = cursor
+    if metrics.isActive():
+        msgs = metrics.timedCursor(cursor, False)
+
+    try:
+        for msg in iterPassingMsgs(msgs, tests):
+            yield msg
+
+            numResults += 1
+            if numResults >= limit:
+                break
+
+    finally:
+        cursor.close()
+
+def iterPassingMsgs(msgs, tests):
+    """Return the messages from an iterator that pass all tests.
+
+    Messages are read ``cfg.FILTER_BATCH_SIZE`` at a time and
+    each batch is tested with ``passingMsgs()``.
+
+    Args:
+        msgs (obj): Iterator of messages.
+        tests (list): Functions taking a message and returning
+            ``True`` if it should be returned.
+
+    Yields:
+        dict: Messages passing all tests.
+    """
+    msgs = iter(msgs)
+
+    while True:
+        batch = list(itertools.islice(msgs, cfg.FILTER_BATCH_SIZE))
+        if len(batch) == 0:
+            break
+
+        yield from passingMsgs(batch, tests)
+
+def passingMsgs(msgs, tests):
+    """Return the messages of a batch that pass all tests.
+
+    A test with a ``batch`` attribute (such as the one from
+    ``pointFilter()``) is run once on the whole batch. Other tests
+    are run on each message. Each test only sees the messages that
+    passed the tests before it.
+
+    Args:
+        msgs (list): Messages.
+        tests (list): Functions taking a message and returning
+            ``True`` if it should be returned.
+
+    Returns:
+        list: Messages passing all tests, in the same order.
+    """
+    start = time.perf_counter()
+    metrics.add('documents_scanned', len(msgs))
+
+    for test in tests:
+        if len(msgs) == 0:
+            break
+
+        testBatch = getattr(test, 'batch', None)
+        if testBatch is not None:
+            passed = testBatch(msgs)
+        else:
+            passed = [test(msg) for msg in msgs]
+
+        msgs = [msg for msg, ok in zip(msgs, passed) if ok]
+
+    metrics.add('filter_seconds', time.perf_counter() - start)
+
+    return msgs
+
+def pointFilter(lat, lon):
+    """Return a filter for ``findMsgs()`` for the ``lat=``/``lon=`` test.
+
+    Args:
+        lat (float): Latitude.
+        lon (float): Longitude.
+
+    Returns:
+        tuple: Filter with the same meaning as ``checkIfInPolygon()``.
+        If ``cfg.MONGO_GEO_FILTER`` is ``True``, the test is done
+        in Mongo.
+    """
+    if cfg.MONGO_GEO_FILTER:
+        return spatialindex.pointTest(lat, lon), \
+            lambda: geoindex.pointQuery(dbConn, lat, lon)
+
+    return spatialindex.pointTest(lat, lon), None
+
+def altFilter(high, low):
+    """Return a filter for ``findMsgs()`` for the ``high=``/``low=`` test.
+
+    Args:
+        high (int): High altitude value (feet).
+        low (int): Low altitude value (feet).
+
+    Returns:
+        tuple: Filter with the same meaning as ``checkIfInAltBounds()``.
+        The test is done in Mongo using ``altBoundsQuery()``.
+    """
+    return lambda msg: checkIfInAltBounds(msg, high, low), \
+        lambda: altBoundsQuery(high, low)
+
+def findOneMsg(findArg1):
+    """Find a single message in the ``MSG`` collection.
+
+    If the in-memory snapshot is enabled and ready, it is used.
+    Otherwise, Mongo is queried.
+
+    Args:
+        findArg1 (dict): Dictionary to be used as the
+            first argument to the ``find_one()`` call to Mongo.
+
+    Returns:
+        dict: Message found, or ``None``.
+
+    Raises:
+        breaker.OpenError: If Mongo would be queried and the circuit
+        breaker is open.
+    """
+    if snapshot.isReady():
+        answered, msg = snapshot.findOne(findArg1)
+        if answered:
+            return msg
+
+    breaker.check()
+
+    start = time.perf_counter()
+    try:
+        msg = dbConn.MSG.find_one(findArg1, max_time_ms=queryTimeoutMs())
+    except breaker.MONGO_ERRORS:
+        breaker.failed()
+        raise
+    seconds = time.perf_counter() - start
+
+    metrics.add('mongo_seconds', seconds)
+    breaker.succeeded(seconds)
+    slowquery.check(seconds, findArg1, None, None, 1)
+
+    if msg != None:
+        metrics.add('documents_scanned', 1)
+
+    return msg
 
 def isoStringToDt(isoStr):
     """Convert ISO 8601 string into Datetime object.
@@ -263,6 +696,151 @@ def getStandardQueryItems(request):
     return hasError, errorString.strip(), dt, limitInt, \
         hasLatLong, latFloat, longFloat, hasHighLow, high, low
 
+def isSyncWorker(request):
+    """Check if the request is being answered by a worker that handles
+    one request at a time (such as gunicorn's sync worker).
+
+    Holding such a worker (``wait=``, ``/stream``) stops it answering
+    anyone else. Threaded and asynchronous gunicorn workers, the Flask
+    development server, and ``asgi.py`` all set ``wsgi.multithread``.
+
+    Args:
+        request (object): ``request`` object.
+
+    Returns:
+        bool: ``True`` if the worker handles one request at a time.
+    """
+    return not request.environ.get('wsgi.multithread', False)
+
+def getWaitQueryItem(request):
+    """Parse the ``wait=`` query string parameter.
+
+    ``wait=`` gives the maximum number of seconds to wait for new
+    results if there are none (long polling). It is only used by
+    queries that can return many results. Values above
+    ``cfg.LONG_POLL_MAX_WAIT`` are reduced to it. On a sync worker
+    (see ``isSyncWorker()``) the value is checked, but always
+    reduced to 0, so a few clients can't tie up every worker.
+
+    Args:
+        request (object): ``request`` object containing query string.
+
+    Returns:
+        tuple: Tuple containing:
+
+        1. (bool) ``True`` if there was an error. Else ``False``.
+        2. (str) Error message, or an empty string.
+        3. (float) Seconds to wait. ``0.0`` if not specified.
+    """
+    waitStr = request.args.get('wait')
+    if waitStr == None:
+        return False, '', 0.0
+
+    try:
+        wait = float(waitStr)
+
+        if not (wait >= 0.0):
+            raise Exception('')
+
+    except:
+        return True, 'Bad wait parameter.', 0.0
+
+    if isSyncWorker(request):
+        return False, '', 0.0
+
+    return False, '', min(wait, cfg.LONG_POLL_MAX_WAIT)
+
+def getNextQueryItem(request):
+    """Parse the ``next=`` query string parameter.
+
+    ``next=`` takes the ``"next"`` value of a previous response, and
+    continues from the last message of that response. Unlike
+    ``after=``, no messages are skipped or repeated when several have
+    the same ``insert_time``.
+
+    Args:
+        request (object): ``request`` object containing query string.
+
+    Returns:
+        tuple: Tuple containing:
+
+        1. (bool) ``True`` if there was an error. Else ``False``.
+        2. (str) Error message, or an empty string.
+        3. (tuple) ``insert_time`` and ``_id`` of the message to start
+           after, or ``None`` if not specified.
+    """
+    nextStr = request.args.get('next')
+    if nextStr == None:
+        return False, '', None
+
+    try:
+        nextKey = parseNextToken(nextStr)
+    except:
+        return True, 'Bad next parameter.', None
+
+    return False, '', nextKey
+
+def makeNextToken(msg):
+    """Make the ``"next"`` token for the last message of a response.
+
+    Args:
+        msg (dict): Message, before ``changeStandardFields()``.
+
+    Returns:
+        str: Token holding the message's ``insert_time`` and ``_id``.
+    """
+    data = bson.encode({'t': msg['insert_time'], 'i': msg['_id']})
+
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+def parseNextToken(nextStr):
+    """Decode a token made by ``makeNextToken()``.
+
+    Args:
+        nextStr (str): Token.
+
+    Returns:
+        tuple: ``insert_time`` and ``_id``.
+
+    Raises:
+        Exception: If the token is not valid, including a well formed
+        token whose ``insert_time`` isn't a timezone aware datetime or
+        whose ``_id`` isn't a string.
+    """
+    data = base64.urlsafe_b64decode(nextStr + '=' * (-len(nextStr) % 4))
+    key = bson.decode(data, codec_options=CodecOptions(tz_aware=True))
+
+    insertTime, msgId = key['t'], key['i']
+    if (not isinstance(insertTime, datetime.datetime)) or \
+            (insertTime.tzinfo is None) or (not isinstance(msgId, str)):
+        raise ValueError('Bad next token.')
+
+    return insertTime, msgId
+
+def startAfterKey(findArg1, filters, nextKey):
+    """Change a query to start after the message given by ``next=``.
+
+    The ``insert_time`` range is narrowed in ``findArg1``, so the index
+    is used, and a filter skips messages with the same ``insert_time``
+    and a lower or equal ``_id``. If ``findArg1`` already starts
+    after a later time (from ``after=``), that is kept.
+
+    Args:
+        findArg1 (dict): Query, which is altered.
+        filters (list): Filters for ``findMsgs()``, which is altered.
+        nextKey (tuple): Result of ``parseNextToken()``.
+    """
+    insertTime, msgId = nextKey
+
+    afterDt = findArg1.get('insert_time', {}).get('$gt')
+    if (afterDt is None) or (afterDt < insertTime):
+        findArg1['insert_time'] = {'$gte': insertTime}
+
+    filters.insert(0, (lambda msg: (msg['insert_time'] > insertTime) or \
+        (str(msg['_id']) > str(msgId)), \
+        lambda: {'$or': [{'insert_time': {'$gt': insertTime}}, \
+            {'_id': {'$gt': msgId}}]}))
+
 def addCrlCompleteField(msg):
     """For CRL messages, will check to see if all messages are complete
     and will add the field ``"complete"`` with a value of ``1`` if
@@ -330,6 +908,8 @@ def changeStandardFields(msg):
     Args:
         msg (object): Message to be checked.
     """
+    start = time.perf_counter()
+
     msg = convertMsgDtToIsoString(msg)
 
     msgType = msg['type']
@@ -356,6 +936,8 @@ def changeStandardFields(msg):
     if msgType == 'RSR':
         augmentRsr(msg)            
     
+    metrics.add('transform_seconds', time.perf_counter() - start)
+
     return msg
 
 def checkIfInPolygon(msg, lat, lon):
@@ -373,6 +955,11 @@ def checkIfInPolygon(msg, lat, lon):
     of the message may have arrived (and the standard states we need to
     send it), but the graphics portion has not arrived.
 
+    The polygons for each message are built once and kept in
+    ``spatialindex``, so repeated checks of the same message are cheap.
+    When checking many messages against the same point,
+    ``spatialindex.pointTest()`` is faster still.
+
     Args:
         msg (object): Message to be checked.
         lat (float): Latitude.
@@ -389,24 +976,7 @@ def checkIfInPolygon(msg, lat, lon):
         checked. Only one needs to satisfy the 
         requirements.
     """
-    if 'geojson' not in msg:
-        return True
-
-    point = Point(lon, lat)
-
-    geoList = msg['geojson']['features']
-    for x in geoList:
-        if x['geometry']['type'] != 'Polygon':
-            continue
-        coords = x['geometry']['coordinates']
-        shapelyCoords = [(xy[0], xy[1]) for xy in coords]
-
-        poly = Polygon(shapelyCoords)
-        if not poly.contains(point):
-            continue
-        return True
-
-    return False
+    return spatialindex.contains(msg, lat, lon)
 
 def checkIfInAltBounds(msg, high, low):
     """If the message has geometry and an ``"altitudes"`` field
@@ -457,6 +1027,30 @@ def checkIfInAltBounds(msg, high, low):
 
     return False
 
+def altBoundsQuery(high, low):
+    """Mongo query with the same meaning as ``checkIfInAltBounds()``.
+
+    A message matches if it has no geometry, or if any feature
+    has no ``"altitudes"`` field, is surface only (bottom and top
+    are both ``0``), or has an altitude range that overlaps the
+    high and low values.
+
+    Args:
+        high (int): High altitude value (feet).
+        low (int): Low altitude value (feet).
+
+    Returns:
+        dict: Query to be combined with the route's query using
+        ``$and``.
+    """
+    return {'$or': [ \
+        {'geojson': {'$exists': False}}, \
+        {'geojson.features': {'$elemMatch': {'$or': [ \
+            {'properties.altitudes': {'$exists': False}}, \
+            {'properties.altitudes.0': 0, 'properties.altitudes.2': 0}, \
+            {'properties.altitudes.2': {'$lte': high}, \
+             'properties.altitudes.0': {'$gte': low}}]}}}]}
+
 def returnStaticOne(findArg1, request):
     """Return zero to one message from Mongo collection ``STATIC_ITEMS``.
                                                                                 
@@ -474,18 +1068,39 @@ def returnStaticOne(findArg1, request):
         obj: Message containing zero or a single object in the
         ``"result"`` field.
     """
+    if isDescribing():
+        return ROUTE_STATIC_ONE, findArg1
+
     result = {}
     
-    hasError, errorString, _, _, \
-        hasLatLong, lat, lon, \
-        hasHighLow, high, low = getStandardQueryItems(request)
+    items = getStandardQueryItems(request)
+    hasError, errorString = items[0:2]
 
     if hasError:
         result['status'] = -1
         result['error'] = errorString
         return jsonify(result)
 
-    msg = dbConn.STATIC_ITEMS.find_one(findArg1)
+    msg = dbConn.STATIC_ITEMS.find_one(findArg1, max_time_ms=queryTimeoutMs())
+
+    return respondStaticOne(msg, request, items)
+
+def respondStaticOne(msg, request, items):
+    """Build the ``returnStaticOne()`` response for a message.
+
+    Args:
+        msg (dict): Message from ``STATIC_ITEMS``, or ``None``.
+        request (obj): Request object from Flask.
+        items (tuple): Result of ``getStandardQueryItems()``.
+
+    Returns:
+        obj: Flask response.
+    """
+    result = {}
+
+    _, _, _, _, \
+        hasLatLong, lat, lon, \
+        hasHighLow, high, low = items
 
     if hasLatLong and not checkIfInPolygon(msg, lat, lon):
         msg = None
@@ -493,17 +1108,22 @@ def returnStaticOne(findArg1, request):
     if hasHighLow and not checkIfInAltBounds(msg, high, low):
         msg = None
 
+    etag = httpcache.staticEtag(msg, 'json')
+    age = cfg.CACHE_MAX_AGE['STATIC']
+    if httpcache.isNotModified(request, etag):
+        return httpcache.notModified(etag, age)
+
     if msg == None:
         result['status'] = 0
         result['num_results'] = 0
-        return jsonify(result)
+        return httpcache.setHeaders(jsonify(result), etag, age)
 
     del msg['_id']
 
     result['status'] = 0
     result['result'] = msg
     result['num_results'] = 1
-    return jsonify(result)
+    return httpcache.setHeaders(jsonify(result), etag, age)
     
 def returnStaticMany(findArg1, request):
     """Return zero to many messages from Mongo collection ``STATIC_ITEMS``.
@@ -522,6 +1142,9 @@ def returnStaticMany(findArg1, request):
         obj: Message containing zero to many objects in the
         ``"results"`` field.
     """
+    if isDescribing():
+        return ROUTE_STATIC_MANY, findArg1
+
     result = {}
 
     hasError, errorString, _, limit, \
@@ -532,7 +1155,8 @@ def returnStaticMany(findArg1, request):
         result['error'] = errorString
         return jsonify(result)
 
-    cursor = dbConn.STATIC_ITEMS.find(findArg1).limit(limit)
+    cursor = dbConn.STATIC_ITEMS.find(findArg1).limit(limit) \
+        .max_time_ms(queryTimeoutMs())
     
     if cursor == None:
         result['status'] = 0
@@ -564,6 +1188,11 @@ def returnOne(findArg1, request):
                                                                                 
     Handles all query parameters and error checks.
 
+    If the route's id (``unique_name`` or ``station``) is a comma
+    separated list, such as ``/metar/KDEN,KCOS,KPUB``, each id is
+    looked up (with a single query) and the response's ``"results"``
+    field is an object with a ``returnOne()`` style result for each id.
+
     Args:
         findArg1 (dict): Dictionary to be used as the
             first argument to the ``find()`` call to Mongo.
@@ -573,11 +1202,18 @@ def returnOne(findArg1, request):
         obj: Message containing at most one internal object in the
         ``"result"`` field.
     """
+    if isDescribing():
+        return ROUTE_ONE, findArg1
+
     result = {}
     
-    hasError, errorString, afterDt, _, \
-        hasLatLong, lat, lon, \
-        hasHighLow, high, low = getStandardQueryItems(request)
+    items = getStandardQueryItems(request)
+    hasError, errorString, afterDt = items[0:3]
+
+    field, ids = splitIds(findArg1)
+    if (ids != None) and (len(ids) > cfg.BATCH_MAX_QUERIES):
+        hasError = True
+        errorString = (errorString + ' Too many ids.').strip()
 
     if hasError:
         result['status'] = -1
@@ -586,35 +1222,312 @@ def returnOne(findArg1, request):
 
     findArg1['insert_time'] = {'$gt': afterDt}
 
-    msg = dbConn.MSG.find_one(findArg1)
+    if ids != None:
+        msgs = findOneMsgs(findArg1, field, ids)
+        return respondMultiOne(msgs, findArg1, ids, request, items)
 
-    if hasLatLong and not checkIfInPolygon(msg, lat, lon):
-        msg = None
+    msg = findOneMsg(findArg1)
 
-    if hasHighLow and not checkIfInAltBounds(msg, high, low):
-        msg = None
+    return respondOne(msg, findArg1, request, items)
 
-    if msg == None:
-        result['status'] = 0
+def respondOne(msg, findArg1, request, items):
+    """Build the ``returnOne()`` response for a message.
+
+    Args:
+        msg (dict): Message from ``MSG``, or ``None``.
+        findArg1 (dict): Query used to find the message.
+        request (obj): Request object from Flask.
+        items (tuple): Result of ``getStandardQueryItems()``.
+
+    Returns:
+        obj: Flask response.
+    """
+    msg = filterOneMsg(msg, items)
+
+    etagBuilder = httpcache.EtagBuilder('one', (items[2],))
+    if msg != None:
+        etagBuilder.add(msg)
+    etag = etagBuilder.etag()
+    age = httpcache.maxAge(findArg1)
+
+    if httpcache.isNotModified(request, etag):
+        return httpcache.notModified(etag, age)
+
+    return httpcache.setHeaders(timedJsonify(oneResult(msg, items[2])), \
+        etag, age)
+
+def respondMultiOne(msgs, findArg1, ids, request, items):
+    """Build the ``returnOne()`` response for a list of ids.
+
+    Args:
+        msgs (dict): Messages found, keyed by id (see ``findOneMsgs()``).
+        findArg1 (dict): Query used to find the messages.
+        ids (list): Ids asked for.
+        request (obj): Request object from Flask.
+        items (tuple): Result of ``getStandardQueryItems()``.
+
+    Returns:
+        obj: Flask response. The ``"results"`` field is an object
+        with the ``returnOne()`` result for each id.
+    """
+    # Ids with no message are still keys of "results".
+    etagBuilder = httpcache.EtagBuilder('multi', (tuple(ids), items[2]))
+    found = {}
+
+    for id in ids:
+        msg = filterOneMsg(msgs.get(id), items)
+        if msg != None:
+            etagBuilder.add(msg)
+        found[id] = msg
+
+    etag = etagBuilder.etag()
+    age = httpcache.maxAge(findArg1)
+
+    if httpcache.isNotModified(request, etag):
+        return httpcache.notModified(etag, age)
+
+    results = {}
+    for id in ids:
+        results[id] = oneResult(found[id], items[2])
+
+    return httpcache.setHeaders(timedJsonify({'status': 0, \
+        'results': results}), etag, age)
+
+def filterOneMsg(msg, items):
+    """Apply the ``lat=``/``lon=`` and ``high=``/``low=`` tests to a
+    single message.
+
+    Args:
+        msg (dict): Message, or ``None``.
+        items (tuple): Result of ``getStandardQueryItems()``.
+
+    Returns:
+        dict: ``msg`` if it passes, else ``None``.
+    """
+    _, _, _, _, \
+        hasLatLong, lat, lon, \
+        hasHighLow, high, low = items
+
+    start = time.perf_counter()
+
+    if hasLatLong and (msg != None) and not checkIfInPolygon(msg, lat, lon):
+        msg = None
+
+    if hasHighLow and (msg != None) and not checkIfInAltBounds(msg, high, low):
+        msg = None
+
+    metrics.add('filter_seconds', time.perf_counter() - start)
+
+    return msg
+
+def oneResult(msg, afterDt):
+    """Build the ``returnOne()`` result object for a message.
+
+    Args:
+        msg (dict): Message (which is altered), or ``None``.
+        afterDt (datetime): Value of ``after=``, used for ``"after"``
+            if there is no message.
+
+    Returns:
+        dict: Result object.
+    """
+    result = {}
+
+    if msg == None:
+        result['status'] = 0
         result['num_results'] = 0
         result['after'] = dtToIsoString(afterDt)
-        return jsonify(result)
+        return result
 
     msg = changeStandardFields(msg)
     afterStr = msg['insert_time']
     del msg['insert_time']
 
+    metrics.add('documents_returned', 1)
+
     result['status'] = 0
     result['result'] = msg
     result['num_results'] = 1
     result['after'] = afterStr
-    return jsonify(result)
-    
+    return result
+
+def splitIds(findArg1):
+    """Find out if a single object route was given a list of ids.
+
+    Args:
+        findArg1 (dict): Query for the route.
+
+    Returns:
+        tuple: Tuple containing the id field (one of ``ID_FIELDS``) and a
+        list of the ids, without duplicates. ``(None, None)`` if the
+        id is not a comma separated list.
+    """
+    for field in ID_FIELDS:
+        value = findArg1.get(field)
+
+        if isinstance(value, str) and (',' in value):
+            ids = []
+            for id in value.split(','):
+                id = id.strip()
+                if (id != '') and (id not in ids):
+                    ids.append(id)
+
+            return field, ids
+
+    return None, None
+
+def findOneMsgs(findArg1, field, ids):
+    """Find a message for each of a list of ids, with a single query.
+
+    Args:
+        findArg1 (dict): Query for the route. The value of ``field``
+            is ignored.
+        field (str): Id field, such as ``'unique_name'``.
+        ids (list): Ids to look up.
+
+    Returns:
+        dict: Message found for each id. Ids with no message are left out.
+    """
+    query = dict(findArg1)
+    query[field] = {'$in': ids}
+
+    return oneMsgPerId(findMsgs(query, DEFAULT_LIMIT), field)
+
+def oneMsgPerId(msgs, field):
+    """Key messages by id, keeping the first message for each id.
+
+    Args:
+        msgs (obj): Iterable of messages.
+        field (str): Id field.
+
+    Returns:
+        dict: Message for each id.
+    """
+    msgsById = {}
+
+    for msg in msgs:
+        msgsById.setdefault(msg.get(field), msg)
+
+    return msgsById
+
+def returnBatch(request):
+    """Answer several single object queries in one request (``/batch``).
+
+    The request body is a JSON object whose ``"queries"`` field is a
+    list of paths to single object routes, with any query string,
+    such as ``"/metar/KDEN?after=2021-01-01T00:00:00Z"``. Queries for
+    the same route are answered with one database query.
+
+    Args:
+        request (obj): Request object from Flask.
+
+    Returns:
+        obj: Message whose ``"results"`` field is a list with the
+        response to each query, in order. Each is what a ``GET`` of
+        the path would return.
+    """
+    body = request.get_json(silent=True)
+    queries = body.get('queries') if isinstance(body, dict) else None
+
+    if (not isinstance(queries, list)) or \
+            (not all(isinstance(q, str) for q in queries)):
+        return jsonify({'status': -1, \
+            'error': 'Body must be an object with a "queries" list.'})
+
+    if len(queries) > cfg.BATCH_MAX_QUERIES:
+        return jsonify({'status': -1, 'error': 'Too many queries.'})
+
+    # For each query: [error, query, items, id field, ids]. Queries
+    # that differ only by id are grouped, keyed by the rest of the query.
+    parsed = []
+    groups = {}
+
+    for q in queries:
+        subRequest = Request.from_values(q)
+        described = describeRoute(current_app, subRequest.path)
+
+        if (described == None) or (described[0] != ROUTE_ONE):
+            parsed.append(['Not a single object route.', None, None, None, None])
+            continue
+
+        findArg1 = described[1]
+        items = getStandardQueryItems(subRequest)
+        hasError, errorString, afterDt = items[0:3]
+        if hasError:
+            parsed.append([errorString, None, None, None, None])
+            continue
+
+        findArg1['insert_time'] = {'$gt': afterDt}
+
+        field, ids = splitIds(findArg1)
+        if field == None:
+            field = next((f for f in ID_FIELDS if f in findArg1), None)
+            if field != None:
+                ids = [findArg1[field]]
+
+        parsed.append([None, findArg1, items, field, ids])
+
+        if field != None:
+            base = dict(findArg1)
+            del base[field]
+            group = groups.setdefault((field, repr(sorted(base.items()))), \
+                [base, []])
+            group[1].extend([id for id in ids if id not in group[1]])
+
+    found = {}
+    for (field, key), (base, ids) in groups.items():
+        found[(field, key)] = findOneMsgs(base, field, ids)
+
+    results = []
+    for errorString, findArg1, items, field, ids in parsed:
+        if errorString != None:
+            results.append({'status': -1, 'error': errorString})
+            continue
+
+        if field == None:
+            msg = filterOneMsg(findOneMsg(findArg1), items)
+            results.append(oneResult(msg, items[2]))
+            continue
+
+        base = dict(findArg1)
+        del base[field]
+        msgs = found[(field, repr(sorted(base.items())))]
+
+        # Messages may be shared by several queries, so use copies.
+        subResults = {}
+        for id in ids:
+            msg = filterOneMsg(msgs.get(id), items)
+            if msg != None:
+                msg = copy.deepcopy(msg)
+            subResults[id] = oneResult(msg, items[2])
+
+        if ',' in str(findArg1[field]):
+            results.append({'status': 0, 'results': subResults})
+        else:
+            results.append(subResults[ids[0]])
+
+    return timedJsonify({'status': 0, 'results': results})
+
 def returnMany(findArg1, request):
     """Return zero to many messages from Mongo collection ``MSG``.                            
                                                                                 
     Handles all query parameters and error checks.
 
+    If the request has an ``Accept`` header preferring
+    ``application/x-ndjson``, or ``cfg.STREAM_RESPONSES`` is ``True``,
+    the response is streamed (see ``streamMany()``).
+
+    If there are no results and the request has a ``wait=`` parameter,
+    the response is held until results arrive or ``wait`` seconds pass.
+
+    Identical requests in flight at the same time share one response
+    (see ``coalesce``). If Mongo fails, the last good response to the
+    same request is sent, marked as stale (see ``lastgood``).
+
+    The ``"next"`` field holds a token for the last message returned
+    (see ``getNextQueryItem()``). If there are no results, it is the
+    ``next=`` value of the request, if any.
+
     Args:
         findArg1 (dict): Dictionary to be used as the
             first argument to the ``find()`` call to Mongo.
@@ -624,38 +1537,237 @@ def returnMany(findArg1, request):
         obj: Message containing at most one internal object in the
         ``"results"`` field.
     """
+    if isDescribing():
+        return ROUTE_MANY, findArg1
+
     result = {}
 
-    hasError, errorString, afterDt, limit, \
-        hasLatLong, lat, lon, \
-        hasHighLow, high, low = getStandardQueryItems(request)
+    items = getStandardQueryItems(request)
+    hasError, errorString, afterDt, limit = items[0:4]
+
+    waitError, waitErrorString, wait = getWaitQueryItem(request)
+    if waitError:
+        hasError = True
+        errorString = (errorString + ' ' + waitErrorString).strip()
+
+    nextError, nextErrorString, nextKey = getNextQueryItem(request)
+    if nextError:
+        hasError = True
+        errorString = (errorString + ' ' + nextErrorString).strip()
+
     if hasError:
         result['status'] = -1
         result['error'] = errorString
-        return jsonify(result)
+        return varyOnAccept(jsonify(result))
+
+    _, streaming, variant = responseVariant(request)
+    key = coalesce.requestKey(findArg1, items, request.args.get('next'), \
+        variant)
 
     findArg1['insert_time'] = {'$gt': afterDt}
+    filters = queryFilters(items)
+
+    if nextKey != None:
+        startAfterKey(findArg1, filters, nextKey)
+
+    try:
+        return varyOnAccept(manyResponse(findArg1, request, items, filters, \
+            wait, streaming, variant, key))
+    except breaker.MONGO_ERRORS:
+        stale = None if streaming else lastgood.staleResponse(key)
+        if stale is None:
+            raise
+
+        return varyOnAccept(stale)
+
+def manyResponse(findArg1, request, items, filters, wait, streaming, \
+        variant, key):
+    """Find the messages for ``returnMany()`` and build the response.
+
+    Args:
+        findArg1 (dict): Query for ``findMsgs()``.
+        request (obj): Request object from Flask.
+        items (tuple): Result of ``getStandardQueryItems()``.
+        filters (list): Filters for ``findMsgs()``.
+        wait (float): ``wait=`` value of the request.
+        streaming (bool): ``True`` if the response will be streamed.
+        variant (str): Name of the representation.
+        key (tuple): Key from ``coalesce.requestKey()``.
+
+    Returns:
+        obj: Flask response.
+    """
+    limit = items[3]
+
+    if wait > 0.0:
+        waitForMsgs(findArg1, filters, wait)
+
+    useFragments = fragcache.isEnabled()
+    etag = None
+
+    # Conditional requests should be answered without building the
+    # body. This costs a query for keys only. The tag sent with a body
+    # is computed from the messages in it, since they may have
+    # changed since.
+    if request.if_none_match:
+        etag = msgsEtag(findArg1, limit, filters, \
+            manyEtagBuilder(variant, items, request))
+
+        if httpcache.isNotModified(request, etag):
+            return httpcache.notModified(etag, httpcache.maxAge(findArg1))
+
+    def build():
+        cursor = findMsgs(findArg1, limit, filters, not useFragments)
+        return lastgood.keep(key, \
+            respondMany(cursor, findArg1, request, items, etag))
+
+    if streaming or not coalesce.isEnabled():
+        return build()
+
+    return coalesce.run(key, build)
+
+def queryFilters(items):
+    """Return the ``findMsgs()`` filters for the query string.
+
+    Args:
+        items (tuple): Result of ``getStandardQueryItems()``.
+
+    Returns:
+        list: Filters for ``lat=``/``lon=`` and ``high=``/``low=``.
+    """
+    _, _, _, _, \
+        hasLatLong, lat, lon, \
+        hasHighLow, high, low = items
+
+    filters = []
+    if hasLatLong:
+        filters.append(pointFilter(lat, lon))
+    if hasHighLow:
+        filters.append(altFilter(high, low))
+
+    return filters
+
+def responseVariant(request):
+    """Decide how a ``returnMany()`` response will be sent.
+
+    Args:
+        request (obj): Request object from Flask.
+
+    Returns:
+        tuple: Tuple containing:
+
+        1. (bool) ``True`` if NDJSON was asked for.
+        2. (bool) ``True`` if the response will be streamed.
+        3. (str) Name of the representation for ``ETag`` purposes:
+           ``'ndjson'``, ``'stream'``, or ``'json'``.
+    """
+    ndjson = wantsNdjson(request)
+    streaming = ndjson or cfg.STREAM_RESPONSES
+
+    if ndjson:
+        variant = 'ndjson'
+    elif streaming:
+        variant = 'stream'
+    else:
+        variant = 'json'
+
+    return ndjson, streaming, variant
+
+def varyOnAccept(response):
+    """Add ``Accept`` to the ``Vary`` header of a response.
+
+    ``returnMany()`` responses are JSON or NDJSON depending on the
+    ``Accept`` header, so shared caches must not send one to a
+    client that asked for the other.
+
+    Args:
+        response (obj): Flask response.
+
+    Returns:
+        obj: ``response``.
+    """
+    response.vary.add('Accept')
+
+    return response
+
+def respondMany(cursor, findArg1, request, items, etag=None):
+    """Build the ``returnMany()`` response from the messages found.
+
+    Args:
+        cursor (obj): Iterable of messages from ``findMsgs()``, or a
+            list of messages. If it is a list and ``etag`` is ``None``,
+            ``If-None-Match`` is checked before building the response.
+        findArg1 (dict): Query used to find the messages.
+        request (obj): Request object from Flask.
+        items (tuple): Result of ``getStandardQueryItems()``.
+        etag (str): ``ETag`` already checked against ``If-None-Match``,
+            if any. The tag sent is always computed from the messages
+            (streamed responses have none).
+
+    Returns:
+        obj: Flask response.
+    """
+    result = {}
+    afterDt = items[2]
+    nextStr = request.args.get('next')
+
+    ndjson, streaming, variant = responseVariant(request)
+    useFragments = fragcache.isEnabled()
+    age = httpcache.maxAge(findArg1)
+
+    if (etag is None) and isinstance(cursor, list):
+        etagBuilder = manyEtagBuilder(variant, items, request)
+        for msg in cursor:
+            etagBuilder.add(msg)
+        etag = etagBuilder.etag()
+
+        if httpcache.isNotModified(request, etag):
+            return httpcache.notModified(etag, age)
 
-    cursor = dbConn.MSG.find(findArg1).sort('insert_time', 1).limit(limit)
-    
     if cursor == None:
         result['status'] = 0
         result['num_results'] = 0
         result['after'] = dtToIsoString(afterDt)
+        if nextStr != None:
+            result['next'] = nextStr
         return jsonify(result)
 
     numResults = 0
     messages = []
     afterStr = dtToIsoString(afterDt)
 
-    for msg in cursor:
-        if hasLatLong and not checkIfInPolygon(msg, lat, lon):
-            continue
+    if streaming:
+        response = Response(stream_with_context( \
+            streamMany(cursor, afterStr, nextStr, ndjson, useFragments)), \
+            mimetype=NDJSON_MIMETYPE if ndjson else 'application/json')
+        return httpcache.setHeaders(response, None, age)
 
-        if hasHighLow and not checkIfInAltBounds(msg, high, low):
-            continue
+    etagBuilder = manyEtagBuilder(variant, items, request)
+
+    if useFragments:
+        fragments = []
+        for msg in cursor:
+            etagBuilder.add(msg)
+            nextStr = makeNextToken(msg)
+            fragment, afterStr = msgFragment(msg, True)
+            fragments.append(fragment)
+
+        metrics.add('documents_returned', len(fragments))
 
+        nextField = b''
+        if nextStr != None:
+            nextField = b',"next":' + encodeJson(nextStr)
+
+        body = b''.join([b'{"after":', encodeJson(afterStr), nextField, \
+            b',"num_results":', str(len(fragments)).encode(), \
+            b',"results":[', b','.join(fragments), b'],"status":0}\n'])
+        return httpcache.setHeaders(Response(body, \
+            mimetype='application/json'), etagBuilder.etag(), age)
+
+    for msg in cursor:
+        etagBuilder.add(msg)
         numResults += 1
+        nextStr = makeNextToken(msg)
         msg = changeStandardFields(msg)
 
         afterStr = msg['insert_time']
@@ -663,8 +1775,252 @@ def returnMany(findArg1, request):
 
         messages.append(msg)
 
+    metrics.add('documents_returned', numResults)
+
     result['status'] = 0
     result['results'] = messages
     result['num_results'] = numResults
     result['after'] = afterStr
-    return jsonify(result)
+    if nextStr != None:
+        result['next'] = nextStr
+    return httpcache.setHeaders(timedJsonify(result), etagBuilder.etag(), age)
+
+def waitForMsgs(findArg1, filters, wait):
+    """Wait until there is at least one message matching a query.
+
+    Returns at once if there already is one. Otherwise, waits for
+    ``notifier`` to report new messages and checks again, until
+    ``wait`` seconds have passed.
+
+    Args:
+        findArg1 (dict): Query for ``findMsgs()``.
+        filters (list): Filters for ``findMsgs()``.
+        wait (float): Maximum seconds to wait.
+    """
+    notifier.start(dbConn)
+    deadline = time.monotonic() + wait
+
+    while True:
+        gen = notifier.generation()
+
+        for _ in findMsgs(findArg1, 1, filters, False, True):
+            return
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0.0:
+            return
+
+        notifier.waitFor(gen, remaining)
+
+def manyEtagBuilder(variant, items, request):
+    """Make the ``EtagBuilder`` for a ``returnMany()`` response.
+
+    The ``after=`` and ``next=`` values are mixed in, since they
+    show up in the body when there are no messages.
+
+    Args:
+        variant (str): Name of the representation, from
+            ``responseVariant()``.
+        items (tuple): Result of ``getStandardQueryItems()``.
+        request (obj): Request object from Flask.
+
+    Returns:
+        obj: ``httpcache.EtagBuilder`` with no messages added.
+    """
+    return httpcache.EtagBuilder('many-' + variant, \
+        (items[2], request.args.get('next')))
+
+def msgsEtag(findArg1, limit, filters, etagBuilder):
+    """Compute the ``ETag`` for a ``returnMany()`` response.
+
+    Only the keys of the matching messages are read, so this is
+    much cheaper than building the response.
+
+    Args:
+        findArg1 (dict): Query for ``findMsgs()``.
+        limit (int): Maximum number of messages.
+        filters (list): Filters for ``findMsgs()``.
+        etagBuilder (obj): Result of ``manyEtagBuilder()``.
+
+    Returns:
+        str: Tag, without quotes.
+    """
+    for msg in findMsgs(findArg1, limit, filters, False, True):
+        etagBuilder.add(msg)
+
+    return etagBuilder.etag()
+
+def wantsNdjson(request):
+    """Check if the client asked for newline delimited JSON.
+
+    Args:
+        request (obj): Request object from Flask.
+
+    Returns:
+        bool: ``True`` if the ``Accept`` header prefers
+        ``application/x-ndjson`` over ``application/json``.
+    """
+    return request.accept_mimetypes.best_match( \
+        ['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+def encodeJson(x):
+    """Encode an object as compact JSON, the same way ``jsonify()`` would.
+
+    Args:
+        x (obj): Object to encode.
+
+    Returns:
+        bytes: UTF-8 encoded JSON.
+    """
+    start = time.perf_counter()
+    data = current_app.json.dumps(x, separators=(',', ':')).encode('utf-8')
+    metrics.add('serialize_seconds', time.perf_counter() - start)
+
+    return data
+
+def timedJsonify(x):
+    """Return ``jsonify(x)``, adding the time taken to the
+    ``serialize_seconds`` metric.
+
+    Args:
+        x (obj): Object to return as JSON.
+
+    Returns:
+        obj: Flask response.
+    """
+    start = time.perf_counter()
+    response = jsonify(x)
+    metrics.add('serialize_seconds', time.perf_counter() - start)
+
+    return response
+
+def msgFragment(msg, copyMsg):
+    """Return a message transformed and encoded as JSON.
+
+    This is what ``changeStandardFields()`` followed by encoding would
+    produce, minus the ``insert_time`` field. If ``fragcache`` is
+    enabled, results are cached and reused. Messages from
+    ``sharedsnapshot`` are already encoded.
+
+    Args:
+        msg (dict): Message from ``findMsgs()``.
+        copyMsg (bool): ``True`` if ``msg`` must not be altered.
+
+    Returns:
+        tuple: Tuple containing:
+
+        1. (bytes) Encoded message (a ``memoryview`` for messages
+           from ``sharedsnapshot``).
+        2. (str) ISO-8601 string of the message's ``insert_time``
+           (used for the ``after`` field).
+    """
+    afterStr = dtToIsoString(msg['insert_time'])
+
+    if isinstance(msg, sharedsnapshot.SharedMsg):
+        return msg.fragment(), afterStr
+
+    if fragcache.isEnabled():
+        key = (msg['_id'], msg.get('digest'), msg['insert_time'])
+        fragment = fragcache.get(key)
+        if fragment is not None:
+            return fragment, afterStr
+
+    if copyMsg:
+        msg = copy.deepcopy(msg)
+
+    fragment = encodeFragment(msg)
+
+    if fragcache.isEnabled():
+        fragcache.put(key, fragment)
+
+    return fragment, afterStr
+
+def encodeFragment(msg):
+    """Transform and encode a message, as ``msgFragment()`` does,
+    without the cache.
+
+    Args:
+        msg (dict): Message. It is altered.
+
+    Returns:
+        bytes: Encoded message.
+    """
+    msg = changeStandardFields(msg)
+    del msg['insert_time']
+
+    return encodeJson(msg)
+
+def streamMany(cursor, afterStr, nextStr, ndjson, copyMsgs):
+    """Generate a ``returnMany()`` response a piece at a time.
+
+    Messages are transformed and encoded as the cursor is read, and
+    written out in pieces of about ``cfg.STREAM_CHUNK_SIZE`` bytes,
+    so memory use does not depend on the size of the result.
+
+    For JSON, the result is the same object ``returnMany()`` would
+    otherwise return, with the fields in the order ``"status"``,
+    ``"results"``, ``"num_results"``, ``"after"``, ``"next"``.
+
+    For NDJSON, each message is written on its own line. The last
+    line is an object with ``"status"``, ``"num_results"``,
+    ``"after"``, and ``"next"`` fields (but no ``"results"``).
+
+    Args:
+        cursor (obj): Iterable of messages from ``findMsgs()``.
+        afterStr (str): ``after`` value to return if there are no
+            messages.
+        nextStr (str): ``next`` value to return if there are no
+            messages, or ``None``.
+        ndjson (bool): ``True`` for NDJSON, ``False`` for JSON.
+        copyMsgs (bool): ``True`` if messages from ``cursor`` must
+            not be altered.
+
+    Yields:
+        bytes: Pieces of the response.
+    """
+    numResults = 0
+    chunk = []
+    chunkSize = 0
+
+    if not ndjson:
+        chunk.append(b'{"status":0,"results":[')
+
+    for msg in cursor:
+        nextStr = makeNextToken(msg)
+        fragment, afterStr = msgFragment(msg, copyMsgs)
+
+        if ndjson:
+            chunk.append(fragment)
+            chunk.append(b'\n')
+        elif numResults == 0:
+            chunk.append(fragment)
+        else:
+            chunk.append(b',')
+            chunk.append(fragment)
+
+        numResults += 1
+        chunkSize += len(fragment) + 1
+
+        if chunkSize >= cfg.STREAM_CHUNK_SIZE:
+            yield b''.join(chunk)
+            chunk = []
+            chunkSize = 0
+
+    metrics.add('documents_returned', numResults)
+
+    trailer = {'status': 0, 'num_results': numResults, 'after': afterStr}
+    if nextStr != None:
+        trailer['next'] = nextStr
+
+    if ndjson:
+        chunk.append(encodeJson(trailer) + b'\n')
+    else:
+        nextField = b''
+        if nextStr != None:
+            nextField = b',"next":' + encodeJson(nextStr)
+
+        chunk.append(b''.join([b'],"num_results":', \
+            str(numResults).encode(), b',"after":', encodeJson(afterStr), \
+            nextField, b'}']))
+
+    yield b''.join(chunk)